@@ -12,7 +12,9 @@ class DermalConfig(AppConfig):
 
     def ready(self):
         """
-        Pre-load model when Django starts up (only in production/server mode).
+        Pre-load the inference backend when Django starts up (only in
+        production/server mode). ``settings.INFERENCE_BACKEND`` picks the
+        remote Gradio Space or a local quantized model (Dermal/inference.py).
         
         This prevents timeout issues on Render free tier where:
         1. Instance spins down with inactivity (~50s cold start)
@@ -26,7 +28,7 @@ class DermalConfig(AppConfig):
         - Skip during tests (not needed)
         - Skip during shell/other management commands
         - Prevent duplicate loads (ready() can be called multiple times)
-        - Handle TensorFlow + Gunicorn fork() issues
+        - Handle Gunicorn fork() (each worker rebuilds its clients/sessions)
         """
         
         # Prevent duplicate pre-loading (ready() can be called multiple times)
@@ -94,36 +96,14 @@ class DermalConfig(AppConfig):
             # Not a server process, skip pre-loading
             return
         
-        # All checks passed, proceed with pre-loading
-        print("🚀 Pre-loading AI model to avoid timeout on first request...")
-        
-        try:
-            # IMPORTANT: For Gunicorn with multiple workers, we need to be careful
-            # about TensorFlow + fork() issues. 
-            # With --preload-app, model loads before fork → all workers share memory (GOOD)
-            # Without --preload-app, each worker loads separately (uses more RAM but safer)
-            
-            from . import AI_detection
-            
-            # Load the model into memory
-            model = AI_detection.get_model()
-            
-            # Mark as successfully pre-loaded
-            DermalConfig._model_preloaded = True
-            
-            print(f"✅ Model pre-loaded successfully: {type(model).__name__}")
-            
-            # Optional: Print memory usage if psutil available
-            try:
-                import psutil
-                process = psutil.Process()
-                mem_mb = process.memory_info().rss / (1024 * 1024)
-                print(f"📊 Memory usage after model load: {mem_mb:.1f} MB")
-            except ImportError:
-                pass
-                
-        except Exception as e:
-            print(f"⚠️ Failed to pre-load model: {e}")
-            print("   Model will be lazy-loaded on first request instead.")
-            import traceback
-            traceback.print_exc()
+        # Preload the configured inference backend (settings.INFERENCE_BACKEND)
+        # so the first upload doesn't pay for it: the Space config fetch +
+        # handshake for "gradio", loading the model file for "local".
+        # With --preload-app this runs in the gunicorn master, so warm the
+        # forked worker again (clients and runtime sessions never survive a fork).
+        from . import inference
+        print(f"🚀 Pre-loading '{inference.get_backend().name}' inference backend...")
+        inference.warm_up()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=inference.warm_up)
+        DermalConfig._model_preloaded = True
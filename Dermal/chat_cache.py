@@ -0,0 +1,68 @@
+"""Cache of chatbot replies keyed by normalized prompt and model.
+
+Users keep asking the same FAQ-style questions ("bệnh chàm là gì?"). A hit
+returns the stored raw reply together with its already rendered and
+sanitized ``reply_html``, skipping both the Gemini call and the
+Markdown/bleach work.
+
+Entries live in the ``chatbot`` cache alias (``settings.CACHES``), which
+bounds size and expiry; the default file-based backend is shared by every
+worker on the instance. Set ``CHATBOT_CACHE_ENABLED=false`` to turn it off.
+"""
+import hashlib
+import os
+import re
+import unicodedata
+
+from django.core.cache import caches
+
+CHATBOT_CACHE_ENABLED = os.getenv('CHATBOT_CACHE_ENABLED', 'true').lower() in ('true', '1', 'yes')
+CHATBOT_CACHE_ALIAS = 'chatbot'
+KEY_VERSION = 1
+
+HIT = 'HIT'
+MISS = 'MISS'
+BYPASS = 'BYPASS'
+
+_WHITESPACE_RE = re.compile(r'\s+')
+# Trailing punctuation does not change the question ("là gì?" == "là gì")
+_TRAILING_PUNCT_RE = re.compile(r'[\s?!.,;:…]+$')
+
+
+def normalize_prompt(prompt):
+    """Canonical form of a prompt: NFC, case-folded, single spaces, no trailing punctuation."""
+    text = unicodedata.normalize('NFC', prompt or '').casefold()
+    text = _WHITESPACE_RE.sub(' ', text).strip()
+    return _TRAILING_PUNCT_RE.sub('', text)
+
+
+def cache_key(prompt, model):
+    digest = hashlib.sha256(f'{model}\0{normalize_prompt(prompt)}'.encode('utf-8')).hexdigest()
+    return f'chatbot:v{KEY_VERSION}:{digest}'
+
+
+def _cache():
+    return caches[CHATBOT_CACHE_ALIAS]
+
+
+def lookup(prompt, model):
+    """Return ``{'reply': ..., 'reply_html': ...}`` or ``None``."""
+    if not CHATBOT_CACHE_ENABLED:
+        return None
+    return _cache().get(cache_key(prompt, model))
+
+
+def store(prompt, model, reply, reply_html):
+    if CHATBOT_CACHE_ENABLED:
+        _cache().set(cache_key(prompt, model), {'reply': reply, 'reply_html': reply_html})
+
+
+async def alookup(prompt, model):
+    if not CHATBOT_CACHE_ENABLED:
+        return None
+    return await _cache().aget(cache_key(prompt, model))
+
+
+async def astore(prompt, model, reply, reply_html):
+    if CHATBOT_CACHE_ENABLED:
+        await _cache().aset(cache_key(prompt, model), {'reply': reply, 'reply_html': reply_html})
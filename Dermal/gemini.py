@@ -0,0 +1,789 @@
+"""Gemini access for the chatbot.
+
+Connections are reused: each worker process keeps one ``genai.Client`` and
+one ``requests.Session`` (keep-alive pool of ``GEMINI_POOL_SIZE``
+connections for the HTTP fallback) instead of building them per call.
+
+Calls are bounded: transient failures (timeouts, connection errors, HTTP 429
+and 5xx) are retried with jittered exponential backoff. One reply gets
+``GEMINI_MAX_RETRIES + 1`` attempts and ``GEMINI_TOTAL_TIMEOUT`` seconds in
+total, shared by the SDK and the HTTP fallback (``CallBudget``). A ``CircuitBreaker`` opens after
+``GEMINI_BREAKER_THRESHOLD`` consecutive failed calls and, for
+``GEMINI_BREAKER_RESET`` seconds, answers with ``GEMINI_FALLBACK_REPLY``
+straight away instead of making every user wait out the timeouts. ``stats``
+counts calls, retries, failures, short-circuits and latency (to the first
+chunk for streams).
+
+``generate_reply()`` returns a whole reply; ``stream_reply()`` yields it as
+text chunks as soon as the model produces them, so the chatbot can show the
+first words after one round trip. Both use the SDK when ``google-genai`` is
+installed and fall back to a POST to ``GEMINI_API_URL``; in development (no
+API configured) they return a canned placeholder.
+
+``agenerate_reply()`` and ``astream_reply()`` are the same calls for async
+views: they await the SDK's ``aio`` API or an ``httpx.AsyncClient`` (up to
+``GEMINI_ASYNC_POOL_SIZE`` connections) so that, under ASGI, one process can
+wait on many replies at once without a thread per request. Async clients
+are bound to an event loop, so they are kept per loop and closed with it;
+under WSGI every async view gets a throwaway loop, so views use the sync
+calls there.
+
+``CHATBOT_STREAM_BACKEND=fake`` swaps in ``FakeStreamingBackend``, which
+replays fixed chunks with a configurable delay; tests and
+``manage.py chatbot_ttfb`` use it to measure streaming without network.
+Point ``GEMINI_API_URL`` at a local HTTP server to test the client layer.
+"""
+import asyncio
+import json
+import logging
+import os
+import random
+import threading
+import time
+import weakref
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Basic canned fallback reply (useful for local dev)
+GEMINI_FALLBACK_REPLY = (
+    "Xin chào! Mình hiện đang chạy ở môi trường phát triển nên chưa kết nối được với dịch vụ Gemini.")
+
+CHATBOT_STREAM_BACKEND = os.getenv('CHATBOT_STREAM_BACKEND', '')
+CHATBOT_FAKE_STREAM_DELAY = float(os.getenv('CHATBOT_FAKE_STREAM_DELAY', '0.05'))
+
+# 'auto' uses the google-genai SDK when installed; 'http' always POSTs to GEMINI_API_URL
+GEMINI_TRANSPORT = os.getenv('GEMINI_TRANSPORT', 'auto')
+GEMINI_POOL_SIZE = int(os.getenv('GEMINI_POOL_SIZE', '4'))
+GEMINI_ASYNC_POOL_SIZE = int(os.getenv('GEMINI_ASYNC_POOL_SIZE', '50'))
+GEMINI_CONNECT_TIMEOUT = float(os.getenv('GEMINI_CONNECT_TIMEOUT', '3'))
+GEMINI_READ_TIMEOUT = float(os.getenv('GEMINI_READ_TIMEOUT', '15'))
+GEMINI_MAX_RETRIES = int(os.getenv('GEMINI_MAX_RETRIES', '2'))
+# Wall-clock budget of one reply, across every attempt and transport
+GEMINI_TOTAL_TIMEOUT = float(os.getenv('GEMINI_TOTAL_TIMEOUT', '20'))
+GEMINI_RETRY_BACKOFF = float(os.getenv('GEMINI_RETRY_BACKOFF', '0.5'))
+GEMINI_BREAKER_THRESHOLD = int(os.getenv('GEMINI_BREAKER_THRESHOLD', '5'))
+GEMINI_BREAKER_RESET = float(os.getenv('GEMINI_BREAKER_RESET', '30'))
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+class GeminiUnavailable(Exception):
+    """Raised when Gemini could not produce a reply."""
+
+
+class StreamInterrupted(GeminiUnavailable):
+    """Raised by ``stream_reply()`` when the stream fails after text was sent."""
+
+
+def gemini_model():
+    return os.getenv('GEMINI_MODEL') or os.getenv('GEMINI_DEFAULT_MODEL') or 'gemini-2.5-flash-lite'
+
+
+def gemini_configured():
+    return bool(os.getenv('GEMINI_API_URL') and os.getenv('GEMINI_API_KEY'))
+
+
+def dev_reply(prompt):
+    return f"[DEV REPLY] Mình đã nhận: {prompt[:400]}"
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker.
+
+    Closed: calls go through. After ``threshold`` consecutive failures it
+    opens and ``allow()`` is False for ``reset_timeout`` seconds. Then one
+    trial call is let through (half-open); its success closes the breaker,
+    its failure opens it again.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold=GEMINI_BREAKER_THRESHOLD, reset_timeout=GEMINI_BREAKER_RESET):
+        self.threshold = max(1, threshold)
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self._opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def allow(self):
+        with self._lock:
+            state = self._state()
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_running or self._failures >= self.threshold:
+                self._opened_at = time.monotonic()
+            self._trial_running = False
+
+    def release(self):
+        """End a call without a verdict; a half-open breaker lets another trial through."""
+        with self._lock:
+            self._trial_running = False
+
+    def reset(self):
+        self.record_success()
+
+
+breaker = CircuitBreaker()
+stats = {'calls': 0, 'successes': 0, 'failures': 0, 'retries': 0, 'short_circuited': 0,
+         'last_latency': None, 'total_latency': 0.0}
+_stats_lock = threading.Lock()
+
+
+def _count(key, amount=1):
+    with _stats_lock:
+        stats[key] += amount
+    if key != 'calls':
+        metrics.remote_calls.inc(amount, service='gemini', outcome=key)
+
+
+def _record_latency(seconds):
+    with _stats_lock:
+        stats['last_latency'] = seconds
+        stats['total_latency'] += seconds
+    metrics.remote_call_duration.observe(seconds, service='gemini')
+
+
+_pid = os.getpid()
+_clients_lock = threading.Lock()
+_session = None
+_sdk_client = None
+_sdk_client_key = None
+_loop_clients = weakref.WeakKeyDictionary()
+
+
+def _check_fork():
+    # Sessions and SDK clients hold sockets that must not cross a fork()
+    # (gunicorn --preload-app), so a forked worker starts from scratch.
+    global _pid, _session, _sdk_client, _sdk_client_key
+    if _pid != os.getpid():
+        _pid = os.getpid()
+        _session = _sdk_client = _sdk_client_key = None
+
+
+def get_session():
+    """This process's keep-alive ``requests.Session`` for the HTTP fallback."""
+    global _session
+    _check_fork()
+    if _session is None:
+        with _clients_lock:
+            if _session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=GEMINI_POOL_SIZE, max_retries=0)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _session = session
+    return _session
+
+
+def get_sdk_client(api_key):
+    """This process's ``genai.Client`` (rebuilt only if the API key changes)."""
+    global _sdk_client, _sdk_client_key
+    _check_fork()
+    if _sdk_client is None or _sdk_client_key != api_key:
+        with _clients_lock:
+            if _sdk_client is None or _sdk_client_key != api_key:
+                _sdk_client = _build_sdk_client(api_key)
+                _sdk_client_key = api_key
+    return _sdk_client
+
+
+def _build_sdk_client(api_key):
+    from google import genai  # type: ignore
+    from google.genai import types  # type: ignore
+
+    return genai.Client(api_key=api_key, http_options=types.HttpOptions(
+        timeout=int((GEMINI_CONNECT_TIMEOUT + GEMINI_READ_TIMEOUT) * 1000)))
+
+
+def reset_clients():
+    """Drop the pooled session and SDK client; the next call rebuilds them."""
+    global _session, _sdk_client, _sdk_client_key
+    with _clients_lock:
+        if _session is not None:
+            _session.close()
+        _session = _sdk_client = _sdk_client_key = None
+
+
+class _LoopClients:
+    """Async clients bound to one event loop, closed when that loop shuts down.
+
+    A task parked on the loop is cancelled by ``asyncio.run()`` (which both
+    uvicorn and asgiref's ``async_to_sync`` use) before the loop closes; its
+    cleanup awaits ``aclose()`` on each client while the loop still runs.
+    """
+
+    def __init__(self, loop):
+        self.clients = {}
+        self._closer = loop.create_task(self._close_at_shutdown(loop))
+
+    async def _close_at_shutdown(self, loop):
+        try:
+            await loop.create_future()
+        finally:
+            _loop_clients.pop(loop, None)
+            for client in self.clients.values():
+                try:
+                    await client.aclose()
+                except Exception as exc:
+                    logger.warning('Closing a Gemini async client failed: %r', exc)
+
+
+def _clients_for_running_loop():
+    loop = asyncio.get_running_loop()
+    clients = _loop_clients.get(loop)
+    if clients is None:
+        clients = _loop_clients[loop] = _LoopClients(loop)
+    return clients.clients
+
+
+def get_async_client():
+    """The ``httpx.AsyncClient`` for the running event loop.
+
+    Async clients are bound to the loop they were created on, so one is
+    kept per loop (uvicorn runs a single loop per process) and closed with it.
+    """
+    import httpx
+
+    clients = _clients_for_running_loop()
+    if 'http' not in clients:
+        clients['http'] = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=GEMINI_ASYNC_POOL_SIZE,
+                                max_keepalive_connections=GEMINI_ASYNC_POOL_SIZE),
+            timeout=httpx.Timeout(GEMINI_READ_TIMEOUT, connect=GEMINI_CONNECT_TIMEOUT),
+        )
+    return clients['http']
+
+
+def get_async_sdk_client(api_key):
+    """The SDK's async client (``genai.Client(...).aio``) for the running event loop.
+
+    Its transport is bound to a loop like ``get_async_client()``'s, so it is
+    not shared through the process-wide ``get_sdk_client()``.
+    """
+    clients = _clients_for_running_loop()
+    key = ('sdk', api_key)
+    if key not in clients:
+        clients[key] = _build_sdk_client(api_key).aio
+    return clients[key]
+
+
+def _is_closed_loop_error(exc):
+    return isinstance(exc, RuntimeError) and 'Event loop is closed' in str(exc)
+
+
+def _is_retryable(exc):
+    import requests
+
+    if isinstance(exc, (requests.ConnectionError, requests.Timeout, ConnectionError, TimeoutError)):
+        return True
+    status = getattr(exc, 'code', None)
+    response = getattr(exc, 'response', None)
+    if not isinstance(status, int) and response is not None:
+        status = getattr(response, 'status_code', None)
+    if status in RETRYABLE_STATUS:
+        return True
+    try:
+        import httpx
+    except ImportError:
+        return False
+    return isinstance(exc, httpx.TransportError)
+
+
+def _backoff(attempt):
+    """Full-jitter exponential backoff: uniform(0, base * 2**attempt) seconds."""
+    return random.uniform(0, GEMINI_RETRY_BACKOFF * (2 ** attempt))
+
+
+class CallBudget:
+    """Attempts and time left for one reply, shared by every transport it tries.
+
+    Without it each transport would retry on its own, and a reply could
+    take ``2 * (GEMINI_MAX_RETRIES + 1)`` timeouts before falling back.
+    """
+
+    def __init__(self, attempts=None, seconds=None):
+        self.attempts = GEMINI_MAX_RETRIES + 1 if attempts is None else attempts
+        self.deadline = time.monotonic() + (GEMINI_TOTAL_TIMEOUT if seconds is None else seconds)
+
+    def remaining(self):
+        return max(0.0, self.deadline - time.monotonic())
+
+    def allows(self, delay=0.0):
+        """True if another attempt may start after sleeping ``delay`` seconds."""
+        return self.attempts > 0 and self.remaining() > delay
+
+    def start_attempt(self):
+        if not self.allows():
+            raise GeminiUnavailable('Call budget exhausted')
+        self.attempts -= 1
+
+    def timeout(self):
+        """Read timeout for the next attempt: the configured one, cut to the time left."""
+        return min(GEMINI_READ_TIMEOUT, self.remaining())
+
+
+def _with_retries(call, budget):
+    attempt = 0
+    while True:
+        budget.start_attempt()
+        try:
+            return call()
+        except Exception as exc:
+            delay = _backoff(attempt)
+            if not _is_retryable(exc) or not budget.allows(delay):
+                raise
+            _count('retries')
+            time.sleep(delay)
+            attempt += 1
+
+
+async def _awith_retries(call, budget):
+    attempt = 0
+    while True:
+        budget.start_attempt()
+        try:
+            return await call()
+        except Exception as exc:
+            delay = _backoff(attempt)
+            if not _is_retryable(exc) or not budget.allows(delay):
+                raise
+            _count('retries')
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+def _text_from_payload(data):
+    """Pull reply text out of a (streamed or whole) JSON response."""
+    if isinstance(data, dict):
+        for key in ('reply', 'text', 'output', 'message', 'delta'):
+            if isinstance(data.get(key), str):
+                return data[key]
+        choices = data.get('choices')
+        if isinstance(choices, list) and choices and isinstance(choices[0], dict):
+            first = choices[0]
+            delta = first.get('delta')
+            if isinstance(delta, dict):
+                return delta.get('content') or delta.get('text') or ''
+            message = first.get('message')
+            if isinstance(message, dict):
+                message = message.get('content')
+            text = first.get('text') or message
+            return text if isinstance(text, str) else ''
+    return ''
+
+
+def _reply_text(data):
+    # A response without reply text is a failed call: its JSON is never shown or cached
+    text = _text_from_payload(data)
+    if not text:
+        raise GeminiUnavailable('No reply text in response')
+    return text
+
+
+def _http_headers(api_key, stream=False):
+    headers = {
+        'Authorization': f'Bearer {api_key}',
+        'Content-Type': 'application/json',
+    }
+    if stream:
+        headers['Accept'] = 'text/event-stream'
+    return headers
+
+
+def _sdk_config(budget):
+    from google.genai import types  # type: ignore
+
+    return types.GenerateContentConfig(http_options=types.HttpOptions(timeout=int(budget.timeout() * 1000)))
+
+
+def _generate_sdk(prompt, api_key, model, budget):
+    response = get_sdk_client(api_key).models.generate_content(model=model, contents=prompt,
+                                                               config=_sdk_config(budget))
+    text = getattr(response, 'text', None)
+    if not text:
+        raise GeminiUnavailable('Empty reply')
+    return text
+
+
+def _generate_http(prompt, api_url, api_key, model, budget):
+    payload = {'prompt': prompt, 'max_tokens': 512, 'model': model}
+    resp = get_session().post(api_url, headers=_http_headers(api_key), json=payload,
+                              timeout=(GEMINI_CONNECT_TIMEOUT, budget.timeout()))
+    resp.raise_for_status()
+    return _reply_text(resp.json())
+
+
+async def _agenerate_sdk(prompt, api_key, model, budget):
+    response = await get_async_sdk_client(api_key).models.generate_content(model=model, contents=prompt,
+                                                                           config=_sdk_config(budget))
+    text = getattr(response, 'text', None)
+    if not text:
+        raise GeminiUnavailable('Empty reply')
+    return text
+
+
+def _httpx_timeout(budget):
+    import httpx
+
+    return httpx.Timeout(budget.timeout(), connect=GEMINI_CONNECT_TIMEOUT)
+
+
+async def _agenerate_http(prompt, api_url, api_key, model, budget):
+    payload = {'prompt': prompt, 'max_tokens': 512, 'model': model}
+    resp = await get_async_client().post(api_url, headers=_http_headers(api_key), json=payload,
+                                         timeout=_httpx_timeout(budget))
+    resp.raise_for_status()
+    return _reply_text(resp.json())
+
+
+def _stream_sdk(prompt, api_key, model, budget):
+    for chunk in get_sdk_client(api_key).models.generate_content_stream(model=model, contents=prompt,
+                                                                        config=_sdk_config(budget)):
+        text = getattr(chunk, 'text', None)
+        if text:
+            yield text
+
+
+_STREAM_DONE = object()
+
+
+def _parse_stream_line(line):
+    """Text carried by one line of a streamed response ('' for none, ``_STREAM_DONE`` at the end)."""
+    if not line:
+        return ''
+    if line.startswith('data:'):
+        line = line[5:].strip()
+        if line == '[DONE]':
+            return _STREAM_DONE
+    try:
+        return _text_from_payload(json.loads(line))
+    except ValueError:
+        return line + '\n'
+
+
+def _stream_payload(prompt, model):
+    return {'prompt': prompt, 'max_tokens': 512, 'model': model, 'stream': True}
+
+
+def _stream_http(prompt, api_url, api_key, model, budget):
+    with get_session().post(api_url, headers=_http_headers(api_key, stream=True),
+                            json=_stream_payload(prompt, model),
+                            timeout=(GEMINI_CONNECT_TIMEOUT, budget.timeout()), stream=True) as resp:
+        resp.raise_for_status()
+        for line in resp.iter_lines(decode_unicode=True):
+            text = _parse_stream_line(line)
+            if text is _STREAM_DONE:
+                break
+            if text:
+                yield text
+
+
+async def _astream_sdk(prompt, api_key, model, budget):
+    stream = await get_async_sdk_client(api_key).models.generate_content_stream(model=model, contents=prompt,
+                                                                                config=_sdk_config(budget))
+    async for chunk in stream:
+        text = getattr(chunk, 'text', None)
+        if text:
+            yield text
+
+
+async def _astream_http(prompt, api_url, api_key, model, budget):
+    async with get_async_client().stream('POST', api_url, headers=_http_headers(api_key, stream=True),
+                                         json=_stream_payload(prompt, model),
+                                         timeout=_httpx_timeout(budget)) as resp:
+        resp.raise_for_status()
+        async for line in resp.aiter_lines():
+            text = _parse_stream_line(line)
+            if text is _STREAM_DONE:
+                break
+            if text:
+                yield text
+
+
+def _sdk_available():
+    if GEMINI_TRANSPORT == 'http':
+        return False
+    try:
+        from google import genai  # type: ignore  # noqa: F401
+    except Exception:
+        return False
+    return True
+
+
+def generate_reply(prompt):
+    """Return Gemini's reply to ``prompt``, or ``GEMINI_FALLBACK_REPLY`` if it is unavailable."""
+    api_url = os.getenv('GEMINI_API_URL')
+    api_key = os.getenv('GEMINI_API_KEY')
+    if not api_url or not api_key:
+        return dev_reply(prompt)
+    if not breaker.allow():
+        _count('short_circuited')
+        return GEMINI_FALLBACK_REPLY
+
+    model = gemini_model()
+    budget = CallBudget()
+    transports = []
+    if _sdk_available():
+        transports.append(lambda: _generate_sdk(prompt, api_key, model, budget))
+    transports.append(lambda: _generate_http(prompt, api_url, api_key, model, budget))
+
+    _count('calls')
+    started = time.monotonic()
+    for transport in transports:
+        if not budget.allows():
+            break
+        try:
+            reply = _with_retries(transport, budget)
+        except Exception as exc:
+            logger.warning('Gemini call failed: %r', exc)
+            continue
+        _record_latency(time.monotonic() - started)
+        _count('successes')
+        breaker.record_success()
+        return reply
+    _record_latency(time.monotonic() - started)
+    _count('failures')
+    breaker.record_failure()
+    return GEMINI_FALLBACK_REPLY
+
+
+async def agenerate_reply(prompt):
+    """Async ``generate_reply()``: waits on the network without holding a thread."""
+    api_url = os.getenv('GEMINI_API_URL')
+    api_key = os.getenv('GEMINI_API_KEY')
+    if not api_url or not api_key:
+        return dev_reply(prompt)
+    if not breaker.allow():
+        _count('short_circuited')
+        return GEMINI_FALLBACK_REPLY
+
+    model = gemini_model()
+    budget = CallBudget()
+    transports = []
+    if _sdk_available():
+        transports.append(lambda: _agenerate_sdk(prompt, api_key, model, budget))
+    transports.append(lambda: _agenerate_http(prompt, api_url, api_key, model, budget))
+
+    _count('calls')
+    started = time.monotonic()
+    for transport in transports:
+        if not budget.allows():
+            break
+        try:
+            reply = await _awith_retries(transport, budget)
+        except Exception as exc:
+            if _is_closed_loop_error(exc):
+                # A client outlived its event loop: a bug here, not a Gemini outage
+                raise
+            logger.warning('Gemini call failed: %r', exc)
+            continue
+        _record_latency(time.monotonic() - started)
+        _count('successes')
+        breaker.record_success()
+        return reply
+    _record_latency(time.monotonic() - started)
+    _count('failures')
+    breaker.record_failure()
+    return GEMINI_FALLBACK_REPLY
+
+
+class FakeStreamingBackend:
+    """Replays ``chunks`` (or the prompt echoed word by word), sleeping ``delay`` seconds before each."""
+
+    def __init__(self, chunks=None, delay=0.0):
+        self.chunks = chunks
+        self.delay = delay
+
+    def _chunks(self, prompt):
+        if self.chunks is not None:
+            return self.chunks
+        words = dev_reply(prompt).split(' ')
+        return [word + ' ' for word in words[:-1]] + words[-1:]
+
+    def __call__(self, prompt):
+        for chunk in self._chunks(prompt):
+            if self.delay:
+                time.sleep(self.delay)
+            yield chunk
+
+    async def astream(self, prompt):
+        for chunk in self._chunks(prompt):
+            if self.delay:
+                await asyncio.sleep(self.delay)
+            yield chunk
+
+
+fake_backend = FakeStreamingBackend(delay=CHATBOT_FAKE_STREAM_DELAY)
+
+
+def _stream_finished():
+    _count('successes')
+    breaker.record_success()
+
+
+def _stream_abandoned():
+    # The client went away mid-reply: the upstream call neither succeeded nor failed
+    breaker.release()
+
+
+def _stream_interrupted(exc):
+    logger.warning('Gemini stream interrupted: %r', exc)
+    _count('failures')
+    breaker.record_failure()
+    return StreamInterrupted('Stream interrupted')
+
+
+def stream_reply(prompt):
+    """Yield the reply to ``prompt`` as text chunks.
+
+    Errors before the first chunk fall through to the next transport; the
+    last resort is ``GEMINI_FALLBACK_REPLY``. An error after text has been
+    sent raises ``StreamInterrupted``: the caller holds a partial reply. A
+    stream counts as a success only once it has ended; one the caller stops
+    reading counts as neither.
+    """
+    if CHATBOT_STREAM_BACKEND == 'fake':
+        yield from fake_backend(prompt)
+        return
+
+    api_url = os.getenv('GEMINI_API_URL')
+    api_key = os.getenv('GEMINI_API_KEY')
+    if not api_url or not api_key:
+        yield dev_reply(prompt)
+        return
+    if not breaker.allow():
+        _count('short_circuited')
+        yield GEMINI_FALLBACK_REPLY
+        return
+
+    model = gemini_model()
+    budget = CallBudget()
+    transports = []
+    if _sdk_available():
+        transports.append(lambda: _stream_sdk(prompt, api_key, model, budget))
+    transports.append(lambda: _stream_http(prompt, api_url, api_key, model, budget))
+
+    _count('calls')
+    started = time.monotonic()
+    for transport in transports:
+        if not budget.allows():
+            break
+        budget.start_attempt()
+        streamed = False
+        stream = transport()
+        try:
+            for text in stream:
+                if not streamed:
+                    streamed = True
+                    _record_latency(time.monotonic() - started)
+                yield text
+        except GeneratorExit:
+            stream.close()
+            _stream_abandoned()
+            raise
+        except Exception as exc:
+            if streamed:
+                raise _stream_interrupted(exc) from exc
+            logger.warning('Gemini streaming failed: %r', exc)
+            continue
+        if streamed:
+            _stream_finished()
+            return
+    _count('failures')
+    breaker.record_failure()
+    yield GEMINI_FALLBACK_REPLY
+
+
+async def astream_reply(prompt):
+    """Async ``stream_reply()``."""
+    if CHATBOT_STREAM_BACKEND == 'fake':
+        if hasattr(fake_backend, 'astream'):
+            async for text in fake_backend.astream(prompt):
+                yield text
+        else:
+            for text in fake_backend(prompt):
+                yield text
+        return
+
+    api_url = os.getenv('GEMINI_API_URL')
+    api_key = os.getenv('GEMINI_API_KEY')
+    if not api_url or not api_key:
+        yield dev_reply(prompt)
+        return
+    if not breaker.allow():
+        _count('short_circuited')
+        yield GEMINI_FALLBACK_REPLY
+        return
+
+    model = gemini_model()
+    budget = CallBudget()
+    transports = []
+    if _sdk_available():
+        transports.append(lambda: _astream_sdk(prompt, api_key, model, budget))
+    transports.append(lambda: _astream_http(prompt, api_url, api_key, model, budget))
+
+    _count('calls')
+    started = time.monotonic()
+    for transport in transports:
+        if not budget.allows():
+            break
+        budget.start_attempt()
+        streamed = False
+        stream = transport()
+        try:
+            async for text in stream:
+                if not streamed:
+                    streamed = True
+                    _record_latency(time.monotonic() - started)
+                yield text
+        except GeneratorExit:
+            _stream_abandoned()
+            await stream.aclose()
+            raise
+        except Exception as exc:
+            if _is_closed_loop_error(exc):
+                raise
+            if streamed:
+                raise _stream_interrupted(exc) from exc
+            logger.warning('Gemini streaming failed: %r', exc)
+            continue
+        if streamed:
+            _stream_finished()
+            return
+    _count('failures')
+    breaker.record_failure()
+    yield GEMINI_FALLBACK_REPLY
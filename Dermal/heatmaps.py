@@ -0,0 +1,171 @@
+"""Grad-CAM heatmaps stored as media files.
+
+The Space returns the heatmap as a base64 PNG. Keeping that text in
+``Dermal_image`` made every row several hundred KB and forced result.html to
+inline it as a ``data:`` URI. Heatmaps are now decoded once and written to
+storage under a name derived from their content hash, so identical heatmaps
+share one file and a given URL never changes content (safe to cache
+forever).
+
+Uploads only classify. Grad-CAM needs a second, much more expensive pass,
+so ``ensure_heatmap`` computes it the first time someone opens it, then
+persists the file on the row and in the prediction cache: other uploads of
+the same photo, and every later view, reuse it.
+
+``request_heatmap`` runs that pass on its own ``PredictionQueue`` of
+``HEATMAP_WORKERS`` threads (``HEATMAP_QUEUE_MAX`` jobs) and answers
+``PENDING`` until it is done, so a Grad-CAM call never holds a request
+thread for up to ``PREDICTION_TIMEOUT``. With one worker, heatmaps take at
+most one of the ``GRADIO_POOL_SIZE`` Space clients and uploads keep the rest.
+"""
+import base64
+import hashlib
+import os
+import re
+import threading
+import zlib
+from collections import OrderedDict
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db.models import Q
+from django.utils import timezone
+
+HEATMAP_DIR = 'heatmaps'
+HEATMAP_WORKERS = int(os.getenv('HEATMAP_WORKERS', '1'))
+HEATMAP_QUEUE_MAX = int(os.getenv('HEATMAP_QUEUE_MAX', '10'))
+
+PENDING = 'pending'
+
+_DATA_URL_PREFIX = re.compile(r'^data:image/[\w.+-]+;base64,')
+
+
+def heatmap_name(png_bytes):
+    digest = hashlib.sha256(png_bytes).hexdigest()
+    return f'{HEATMAP_DIR}/{digest[:2]}/{digest}.png'
+
+
+def save_heatmap_bytes(png_bytes):
+    """Write ``png_bytes`` to storage (once) and return the storage name."""
+    name = heatmap_name(png_bytes)
+    if not default_storage.exists(name):
+        name = default_storage.save(name, ContentFile(png_bytes))
+    return name
+
+
+def save_heatmap_base64(heatmap_base64):
+    """Decode a base64 (or ``data:`` URL) heatmap and store it; ``None`` if empty."""
+    if not heatmap_base64:
+        return None
+    png_bytes = base64.b64decode(_DATA_URL_PREFIX.sub('', heatmap_base64.strip()))
+    return save_heatmap_bytes(png_bytes)
+
+
+# Striped locks so two requests for the same photo compute its heatmap once
+_LOCKS = [threading.Lock() for _ in range(16)]
+
+
+def _lock_for(key):
+    return _LOCKS[zlib.crc32(str(key).encode()) % len(_LOCKS)]
+
+
+def ensure_heatmap(image, timeout=None):
+    """Return the heatmap storage name of ``image``, computing it if needed.
+
+    ``None`` when the inference backend cannot explain predictions. Errors
+    from the backend (timeouts, an unavailable Space) propagate.
+    """
+    from . import inference, prediction_cache
+    from .models import Dermal_image
+
+    if image.heatmap:
+        return image.heatmap.name
+    with _lock_for(image.digest or image.id):
+        name = Dermal_image.objects.filter(id=image.id).values_list('heatmap', flat=True).first()
+        if not name and image.digest:
+            cached = prediction_cache.lookup(image.digest, record=False)
+            name = cached[1] if cached is not None else None
+        if not name:
+            with image.image.open('rb') as fh:
+                img_bytes = fh.read()
+            name = save_heatmap_base64(inference.explain(img_bytes, timeout=timeout))
+            if not name:
+                return None
+            if image.digest:
+                prediction_cache.store(image.digest, image.result, name)
+        # Every upload of this photo shares the heatmap file
+        rows = Q(id=image.id)
+        if image.digest:
+            rows |= Q(digest=image.digest) & (Q(heatmap='') | Q(heatmap__isnull=True))
+        Dermal_image.objects.filter(rows).update(heatmap=name, updated_at=timezone.now())
+    image.heatmap = name
+    return name
+
+
+# Outcome of each finished background job, kept until the page polls for it:
+# the storage name or the exception raised. Backends that cannot explain
+# (``can_explain``) are answered by the view and never get a job.
+_OUTCOMES_MAX = 256
+_outcomes = OrderedDict()
+_outcomes_lock = threading.Lock()
+
+
+def run_heatmap(image_id):
+    """Compute the heatmap of one image on a heatmap worker and record the outcome."""
+    from . import inference, jobs
+    from .models import Dermal_image
+
+    image = Dermal_image.objects.filter(id=image_id).only('id', 'image', 'digest', 'result', 'heatmap').first()
+    if image is None:
+        return
+    try:
+        outcome = ensure_heatmap(image, timeout=jobs.PREDICTION_TIMEOUT)
+        if outcome is None:
+            raise inference.InferenceUnavailable('The backend returned no heatmap')
+    except Exception as e:
+        outcome = e
+    with _outcomes_lock:
+        _outcomes[image_id] = outcome
+        while len(_outcomes) > _OUTCOMES_MAX:
+            _outcomes.popitem(last=False)
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue():
+    """Return the process-wide heatmap queue, creating it on first use."""
+    global _queue
+    if _queue is None:
+        from .jobs import PredictionQueue
+
+        with _queue_lock:
+            if _queue is None:
+                _queue = PredictionQueue(run_heatmap, workers=HEATMAP_WORKERS, maxsize=HEATMAP_QUEUE_MAX,
+                                         name='heatmap')
+    return _queue
+
+
+def request_heatmap(image):
+    """Heatmap storage name of ``image``, or ``PENDING`` while a worker computes it.
+
+    Only for backends that ``can_explain``. The error of a failed background
+    attempt is raised once; the next request retries. ``jobs.QueueFull``
+    when the heatmap queue cannot take the job.
+    """
+    from . import jobs
+
+    if image.heatmap:
+        return image.heatmap.name
+    if jobs.PREDICTION_EAGER:
+        run_heatmap(image.id)
+    with _outcomes_lock:
+        outcome = _outcomes.pop(image.id, PENDING)
+    if outcome is PENDING:
+        # A no-op while the job is still queued or running
+        get_queue().submit(image.id)
+        return PENDING
+    if isinstance(outcome, Exception):
+        raise outcome
+    return outcome
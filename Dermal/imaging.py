@@ -0,0 +1,209 @@
+"""Preprocessing of uploaded skin photos before storage and inference.
+
+Phone cameras produce 4-12 MP JPEGs, and camera captures arrive as base64.
+The classifier only looks at a small square, so shipping the raw upload to
+the Space wastes bandwidth on every call and disk space on every row.
+Each upload is therefore:
+
+- checked against the magic bytes of the formats we accept (the file name
+  and the ``data:`` header are client-controlled and not trusted),
+- rotated upright from its EXIF orientation (the model never sees EXIF),
+- downscaled so its longest side is at most ``IMAGE_MAX_SIDE``,
+- re-encoded as a baseline JPEG without metadata (this also drops GPS tags).
+
+Large JPEGs are decoded with ``Image.draft`` so libjpeg scales them down
+during decoding instead of materialising every pixel first.
+
+Set ``IMAGE_KEEP_ORIGINAL=true`` to also store the untouched upload.
+
+Pillow is imported by the functions that decode, so importing this module
+(which models.py does) stays cheap for requests that never touch an image.
+
+Pages that list images (history, community avatars) show them at 50-300 px,
+so ``make_variants`` also renders a ``thumb`` and a ``medium`` copy once at
+upload time; templates pick between them with ``srcset``. The width of
+each stored file is kept on the row when it is written, so rendering a
+``srcset`` never opens a file. Rows created before that are filled in by
+``manage.py backfill_image_variants``.
+"""
+import io
+import os
+
+from django.core.files.base import ContentFile
+
+# Longest side after downscaling; above the classifier's input size, so its own
+# resize stays the last one, and still sharp enough for the result page.
+IMAGE_MAX_SIDE = int(os.getenv('IMAGE_MAX_SIDE', '768'))
+IMAGE_QUALITY = int(os.getenv('IMAGE_QUALITY', '85'))
+IMAGE_KEEP_ORIGINAL = os.getenv('IMAGE_KEEP_ORIGINAL', 'false').lower() in ('true', '1', 'yes')
+# Refuse decompression bombs before any pixels are decoded
+IMAGE_MAX_PIXELS = int(os.getenv('IMAGE_MAX_PIXELS', str(50 * 1000 * 1000)))
+
+# Display variants (longest side in px) rendered once per upload, see make_variants()
+IMAGE_VARIANTS = {
+    'medium': int(os.getenv('IMAGE_MEDIUM_SIDE', '600')),
+    'thumb': int(os.getenv('IMAGE_THUMB_SIDE', '200')),
+}
+VARIANT_QUALITY = int(os.getenv('IMAGE_VARIANT_QUALITY', '80'))
+
+_EXIF_ORIENTATION = 0x0112
+
+OUTPUT_FORMAT = 'JPEG'
+OUTPUT_EXTENSION = '.jpg'
+
+_SIGNATURES = (
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+)
+
+
+class InvalidImage(ValueError):
+    pass
+
+
+def sniff_format(data):
+    """Return ``'jpeg'``, ``'png'`` or ``'webp'`` from the header bytes, else ``None``."""
+    for signature, name in _SIGNATURES:
+        if data.startswith(signature):
+            return name
+    if len(data) >= 12 and data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+def _open(data):
+    from PIL import Image, UnidentifiedImageError
+
+    if sniff_format(data) is None:
+        raise InvalidImage('Định dạng ảnh không được hỗ trợ (chỉ nhận JPEG, PNG, WebP)')
+    try:
+        img = Image.open(io.BytesIO(data))
+        if img.width * img.height > IMAGE_MAX_PIXELS:
+            raise InvalidImage('Ảnh quá lớn')
+        return img
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, SyntaxError):
+        raise InvalidImage('Không đọc được ảnh')
+
+
+def _to_rgb(img):
+    from PIL import Image
+
+    if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+        # Flatten transparency onto white rather than the black JPEG would give
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel('A'))
+        return background
+    return img.convert('RGB') if img.mode != 'RGB' else img
+
+
+def _decode(data, max_side):
+    """Decode ``data`` into an upright RGB image no larger than ``max_side``."""
+    from PIL import Image, ImageOps
+
+    img = _open(data)
+    try:
+        orientation = img.getexif().get(_EXIF_ORIENTATION, 1)
+        if img.format == 'JPEG':
+            # Rotations by 90/270 swap the sides, so ask for max_side on both
+            img.draft('RGB', (max_side, max_side))
+        img.load()
+        if orientation != 1:
+            img = ImageOps.exif_transpose(img)
+        img = _to_rgb(img)
+        img.thumbnail((max_side, max_side), Image.LANCZOS, reducing_gap=3.0)
+    except (OSError, SyntaxError, ValueError):
+        raise InvalidImage('Không đọc được ảnh')
+    return img
+
+
+def _encode(img, quality):
+    out = io.BytesIO()
+    img.save(out, OUTPUT_FORMAT, quality=quality)
+    return out.getvalue()
+
+
+def preprocess(data, max_side=None):
+    """Return upright, downscaled JPEG bytes for the upload ``data``.
+
+    Raises ``InvalidImage`` for anything that is not a readable JPEG, PNG or
+    WebP image.
+    """
+    return _encode(_decode(data, max_side or IMAGE_MAX_SIDE), IMAGE_QUALITY)
+
+
+def image_width(data):
+    """Width in px of the encoded image ``data``; only the header is parsed."""
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as img:
+        return img.width
+
+
+def make_variants(data):
+    """Return ``{variant: (jpeg_bytes, width)}`` for every entry of ``IMAGE_VARIANTS``.
+
+    ``data`` is decoded once; each variant is resized from the next larger one.
+    """
+    from PIL import Image
+
+    img = _decode(data, max(IMAGE_VARIANTS.values()))
+    variants = {}
+    for variant, side in sorted(IMAGE_VARIANTS.items(), key=lambda item: -item[1]):
+        img = img.copy()
+        img.thumbnail((side, side), Image.LANCZOS, reducing_gap=3.0)
+        variants[variant] = (_encode(img, VARIANT_QUALITY), img.width)
+    return variants
+
+
+def save_variants(instance, source_field, targets, widths_field, data=None):
+    """Render the variants of ``instance.<source_field>`` into its variant fields.
+
+    ``targets`` maps a variant name to the field that stores it, e.g.
+    ``{'thumb': 'image_thumb'}``; the width of each file is recorded under
+    that field name in the ``widths_field`` dict. Pass ``data`` when the
+    source bytes are already in memory. The files are written to storage;
+    saving the row is left to the caller. Returns the names of the fields
+    that were set.
+    """
+    source = getattr(instance, source_field)
+    if data is None:
+        with source.open('rb') as fh:
+            data = fh.read()
+    variants = make_variants(data)
+    widths = dict(getattr(instance, widths_field) or {})
+    for variant, field in targets.items():
+        variant_data, widths[field] = variants[variant]
+        getattr(instance, field).save(variant_name(source.name, variant),
+                                      ContentFile(variant_data), save=False)
+    setattr(instance, widths_field, widths)
+    return [*targets.values(), widths_field]
+
+
+def variant_name(file_name, variant):
+    """``skin.jpg`` -> ``skin_thumb.jpg``."""
+    stem = os.path.splitext(os.path.basename(file_name or ''))[0] or 'skin'
+    return f'{stem}_{variant}{OUTPUT_EXTENSION}'
+
+
+def srcset(*candidates):
+    """``srcset`` attribute value from ``(field_file, width)`` pairs, smallest first.
+
+    ``width`` is the stored width of the file: variants bound the longest
+    side and small uploads are not upscaled, so the nominal sizes would be
+    wrong for portrait or small images. Empty files and unknown widths are
+    skipped, and so is a file no wider than the one before it.
+    """
+    entries = []
+    widest = 0
+    for field_file, width in candidates:
+        if field_file and width and width > widest:
+            entries.append(f'{field_file.url} {width}w')
+            widest = width
+    return ', '.join(entries)
+
+
+def processed_name(file_name):
+    """``file_name`` with the extension of the re-encoded image."""
+    stem = os.path.splitext(os.path.basename(file_name or ''))[0] or 'skin'
+    return stem + OUTPUT_EXTENSION
@@ -0,0 +1,539 @@
+"""Skin classifier backends and the shared Gradio client layer.
+
+Every prediction goes through an ``InferenceBackend`` whose
+``predict(img_bytes) -> (result, heatmap_base64)`` returns the ranked
+classes (``[{'class': ..., 'probability': <percent>}]``, best first) and a
+base64 PNG Grad-CAM overlay, or ``None`` when the backend cannot explain its
+prediction. The two halves are also available on their own: uploads only
+``classify``, and ``explain`` runs when a user opens the heatmap (see
+``heatmaps.ensure_heatmap``). ``settings.INFERENCE_BACKEND`` selects the
+implementation:
+
+- ``gradio`` (default): the Hugging Face Space, over the network,
+- ``local``: an int8-quantized ``.onnx`` (onnxruntime) or ``.tflite``
+  (tflite-runtime) export of the same classifier at
+  ``settings.INFERENCE_MODEL_PATH``, run on this CPU with no network hop.
+  Quantized runtimes have no gradients, so it returns no heatmap.
+
+``DermalConfig.ready()`` preloads whichever backend is configured.
+
+Building a ``gradio_client.Client`` fetches the Space config and does a
+handshake before any prediction can run, so the views must never create one
+per request. Instead each worker process keeps a small bounded pool of ready
+clients:
+
+- clients are built lazily (or warmed up from ``DermalConfig.ready()``) and
+  reused across requests,
+- a client that raises a transport error is thrown away and rebuilt,
+- at most ``GRADIO_POOL_SIZE`` predictions run at once; extra callers wait up
+  to ``GRADIO_ACQUIRE_TIMEOUT`` seconds instead of piling up handshakes.
+
+Point ``GRADIO_SPACE_URL`` at a local Gradio app to test against a stand-in
+server, or pass ``client_factory`` to ``GradioClientPool`` in unit tests.
+"""
+import io
+import logging
+import math
+import os
+import queue
+import threading
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+
+from django.core.exceptions import ImproperlyConfigured
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+GRADIO_SPACE_URL = os.getenv('GRADIO_SPACE_URL', 'https://codedr-skin-detection.hf.space')
+GRADIO_POOL_SIZE = int(os.getenv('GRADIO_POOL_SIZE', '2'))
+GRADIO_ACQUIRE_TIMEOUT = float(os.getenv('GRADIO_ACQUIRE_TIMEOUT', '30'))
+# Space endpoint that only classifies (no gradients); Grad-CAM is "predict_with_gradcam"
+GRADIO_CLASSIFY_API = os.getenv('GRADIO_CLASSIFY_API', 'predict')
+
+
+class InferenceUnavailable(Exception):
+    """Raised when no client could be obtained for a prediction."""
+
+
+def _is_transport_error(exc):
+    """True for network-level failures, which mean the client itself is bad."""
+    if isinstance(exc, (ConnectionError, TimeoutError, OSError)):
+        return True
+    try:
+        import httpx
+    except ImportError:
+        return False
+    return isinstance(exc, httpx.TransportError)
+
+
+class GradioClientPool:
+    """Bounded pool of reusable ``gradio_client.Client`` instances."""
+
+    def __init__(self, src=GRADIO_SPACE_URL, size=GRADIO_POOL_SIZE,
+                 acquire_timeout=GRADIO_ACQUIRE_TIMEOUT, client_factory=None):
+        self.src = src
+        self.size = max(1, size)
+        self.acquire_timeout = acquire_timeout
+        self._client_factory = client_factory
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.size)
+        self._pid = os.getpid()
+        self._built_pid = None
+        # Endpoint names the Space reports in view_api() (None until a client is built)
+        self.endpoints = None
+        self.stats = {'built': 0, 'discarded': 0, 'predictions': 0, 'errors': 0}
+        self._stats_lock = threading.Lock()
+
+    def _count(self, key, latency=None):
+        # Borrowers run on gunicorn threads and queue workers at once
+        with self._stats_lock:
+            self.stats[key] += 1
+            if latency is not None:
+                self.stats['last_latency'] = latency
+
+    def _build(self):
+        if self._client_factory is not None:
+            client = self._client_factory(self.src)
+        else:
+            from gradio_client import Client
+            client = Client(self.src, verbose=False)
+        self._count('built')
+        if self.endpoints is None:
+            self.endpoints = self._endpoints(client)
+        self._built_pid = os.getpid()
+        return client
+
+    @staticmethod
+    def _endpoints(client):
+        try:
+            api = client.view_api(print_info=False, return_format='dict')
+        except Exception as e:
+            logger.warning('Could not list the endpoints of the Space: %r', e)
+            return None
+        return {name.lstrip('/') for name in (api or {}).get('named_endpoints', {})}
+
+    def has_endpoint(self, api_name):
+        """False only once the Space is known not to serve ``api_name``."""
+        return self.endpoints is None or api_name.lstrip('/') in self.endpoints
+
+    def _check_fork(self):
+        # Clients hold sockets and threads that must not cross a fork()
+        # (gunicorn --preload-app), so a forked worker starts from scratch.
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._idle = queue.LifoQueue()
+            self._slots = threading.BoundedSemaphore(self.size)
+
+    @property
+    def idle_count(self):
+        return self._idle.qsize()
+
+    @property
+    def is_warm(self):
+        """True once this process has completed a handshake with the Space."""
+        return self._built_pid == os.getpid()
+
+    def warm_up(self):
+        """Build one client ahead of time so the first upload skips the handshake."""
+        self._check_fork()
+        if self._idle.qsize() == 0:
+            self._idle.put(self._build())
+
+    def reset(self):
+        """Drop all idle clients; the next prediction rebuilds one."""
+        self._idle = queue.LifoQueue()
+
+    @contextmanager
+    def client(self):
+        """Borrow a client for the duration of the ``with`` block."""
+        self._check_fork()
+        if not self._slots.acquire(timeout=self.acquire_timeout):
+            raise InferenceUnavailable('Hệ thống đang bận, vui lòng thử lại sau')
+        try:
+            try:
+                client = self._idle.get_nowait()
+            except queue.Empty:
+                client = self._build()
+            healthy = True
+            try:
+                yield client
+            except Exception as exc:
+                if _is_transport_error(exc):
+                    healthy = False
+                raise
+            finally:
+                if healthy:
+                    self._idle.put(client)
+                else:
+                    self._count('discarded')
+        finally:
+            self._slots.release()
+
+    def predict(self, *args, api_name, retries=1, timeout=None, **kwargs):
+        """Run ``Client.predict`` on a pooled client.
+
+        A transport failure discards the client and is retried on a freshly
+        built one up to ``retries`` times; other errors propagate unchanged.
+        With ``timeout`` the call goes through ``Client.submit`` and raises
+        ``TimeoutError`` (without retrying) if no result arrives in time.
+        """
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            try:
+                with self.client() as client:
+                    if timeout is None:
+                        result = client.predict(*args, api_name=api_name, **kwargs)
+                    else:
+                        job = client.submit(*args, api_name=api_name, **kwargs)
+                        try:
+                            result = job.result(timeout=timeout)
+                        except FutureTimeoutError:
+                            job.cancel()
+                            raise TimeoutError(f'Prediction timed out after {timeout}s')
+                self._count('predictions', latency=time.monotonic() - started)
+                self._record('successes', started)
+                return result
+            except InferenceUnavailable:
+                self._count('errors')
+                metrics.remote_calls.inc(service='gradio', outcome='short_circuited')
+                raise
+            except TimeoutError:
+                self._count('errors')
+                self._record('failures', started)
+                raise
+            except Exception as exc:
+                self._count('errors')
+                if attempt >= retries or not _is_transport_error(exc):
+                    self._record('failures', started)
+                    raise
+                self._record('retries', started)
+                attempt += 1
+
+    @staticmethod
+    def _record(outcome, started):
+        metrics.remote_call_duration.observe(time.monotonic() - started, service='gradio')
+        metrics.remote_calls.inc(service='gradio', outcome=outcome)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Return the process-wide client pool, creating it on first use."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = GradioClientPool()
+    return _pool
+
+
+def predict_with_gradcam(img_bytes, timeout=None):
+    """Classify ``img_bytes`` and return the Space output (result + heatmap)."""
+    return get_pool().predict(img_bytes, api_name="predict_with_gradcam", timeout=timeout)
+
+
+# Output order of the classifier (EfficientNetV2, 300x300 RGB input)
+SKIN_CLASSES = (
+    'Acne and Rosacea Photos',
+    'Eczema Photos',
+    'Heathy',
+    'Psoriasis pictures Lichen Planus and related diseases',
+    'Scabies Lyme Disease and other Infestations and Bites',
+    'Seborrheic Keratoses and other Benign Tumors',
+    'Warts Molluscum and other Viral Infections',
+)
+LOCAL_INPUT_SIZE = 300
+
+
+class InferenceBackend:
+    """``predict(img_bytes, timeout=None) -> (result, heatmap_base64)``.
+
+    ``classify`` and ``explain`` are the two halves of ``predict``; uploads
+    only classify, the heatmap is explained when someone opens it.
+    ``classify`` also returns ``(result, heatmap_base64)``: the heatmap is
+    ``None`` unless the backend got it at no extra cost.
+    """
+
+    name = None
+    # Whether ``explain`` can produce a heatmap at all
+    can_explain = False
+
+    @property
+    def is_warm(self):
+        """True once the first prediction will not pay for connecting or loading."""
+        return False
+
+    def warm_up(self):
+        """Get ready for the first prediction (connect, load the model)."""
+
+    def classify(self, img_bytes, timeout=None):
+        raise NotImplementedError
+
+    def explain(self, img_bytes, timeout=None):
+        """Base64 PNG Grad-CAM overlay, or ``None`` if this backend has none."""
+        return None
+
+    def predict(self, img_bytes, timeout=None):
+        result, heatmap = self.classify(img_bytes, timeout=timeout)
+        return result, heatmap or self.explain(img_bytes, timeout=timeout)
+
+
+class GradioBackend(InferenceBackend):
+    """The classifier Space, called through the process-wide client pool."""
+
+    name = 'gradio'
+    can_explain = True
+
+    @property
+    def is_warm(self):
+        return get_pool().is_warm
+
+    def warm_up(self):
+        get_pool().warm_up()
+
+    def classify(self, img_bytes, timeout=None):
+        pool = get_pool()
+        if not pool.has_endpoint(GRADIO_CLASSIFY_API):
+            # Older Spaces only serve Grad-CAM; its output carries the ranked list
+            # too, and the heatmap is kept rather than computed again later
+            return self.predict(img_bytes, timeout=timeout)
+        output = pool.predict(img_bytes, api_name=GRADIO_CLASSIFY_API, timeout=timeout)
+        # The plain endpoint answers with the ranked list, possibly wrapped like Grad-CAM's output
+        return (output['result'] if isinstance(output, dict) else output), None
+
+    def explain(self, img_bytes, timeout=None):
+        return predict_with_gradcam(img_bytes, timeout=timeout).get('heatmap_base64')
+
+    def predict(self, img_bytes, timeout=None):
+        # One round trip when both halves are wanted
+        output = predict_with_gradcam(img_bytes, timeout=timeout)
+        return output['result'], output.get('heatmap_base64')
+
+
+def _probabilities(values):
+    """``values`` as probabilities: kept if they already are, else softmaxed."""
+    values = [float(v) for v in values]
+    if all(0.0 <= v <= 1.0 for v in values) and abs(sum(values) - 1.0) < 1e-2:
+        return values
+    peak = max(values)
+    exps = [math.exp(v - peak) for v in values]
+    total = sum(exps)
+    return [e / total for e in exps]
+
+
+def rank(scores, labels=SKIN_CLASSES):
+    """Classifier output -> ``[{'class', 'probability'}]`` in percent, best first."""
+    ranked = [{'class': label, 'probability': round(p * 100, 2)}
+              for label, p in zip(labels, _probabilities(scores))]
+    return sorted(ranked, key=lambda item: item['probability'], reverse=True)
+
+
+class _OnnxRunner:
+    """onnxruntime session; ``InferenceSession.run`` is thread-safe."""
+
+    def __init__(self, path, threads):
+        import numpy as np
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        self._np = np
+        self._session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        spec = self._session.get_inputs()[0]
+        self._input = spec.name
+        # Exports from PyTorch-style graphs take NCHW instead of Keras' NHWC
+        self._channels_first = len(spec.shape) == 4 and spec.shape[1] == 3
+
+    def __call__(self, img):
+        batch = self._np.asarray(img, dtype=self._np.float32)[None]
+        if self._channels_first:
+            batch = batch.transpose(0, 3, 1, 2)
+        return self._session.run(None, {self._input: batch})[0][0]
+
+
+class _TfliteRunner:
+    """TFLite interpreter; not thread-safe, so calls are serialized."""
+
+    def __init__(self, path, threads):
+        import numpy as np
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            from tensorflow.lite import Interpreter
+
+        self._np = np
+        self._lock = threading.Lock()
+        self._interpreter = Interpreter(model_path=path, num_threads=threads)
+        self._interpreter.allocate_tensors()
+        self._input = self._interpreter.get_input_details()[0]
+        self._output = self._interpreter.get_output_details()[0]
+
+    def __call__(self, img):
+        np = self._np
+        batch = np.asarray(img, dtype=np.float32)[None]
+        dtype = self._input['dtype']
+        if dtype in (np.int8, np.uint8):
+            # Fully int8 models take quantized pixels: q = x / scale + zero_point
+            scale, zero_point = self._input['quantization']
+            info = np.iinfo(dtype)
+            batch = np.clip(np.round(batch / scale + zero_point), info.min, info.max).astype(dtype)
+        with self._lock:
+            self._interpreter.set_tensor(self._input['index'], batch)
+            self._interpreter.invoke()
+            scores = self._interpreter.get_tensor(self._output['index'])[0]
+        if self._output['dtype'] in (np.int8, np.uint8):
+            scale, zero_point = self._output['quantization']
+            scores = (scores.astype(np.float32) - zero_point) * scale
+        return scores
+
+
+_RUNNERS = {'.onnx': _OnnxRunner, '.tflite': _TfliteRunner}
+
+
+class LocalBackend(InferenceBackend):
+    """Quantized classifier run in-process on the CPU.
+
+    The model is loaded once per process (again after fork); ``timeout`` is
+    ignored since nothing waits on the network. Pass ``runner_factory`` in
+    unit tests to skip onnxruntime/tflite.
+    """
+
+    name = 'local'
+
+    def __init__(self, model_path, threads=1, labels=SKIN_CLASSES, input_size=LOCAL_INPUT_SIZE,
+                 runner_factory=None):
+        self.model_path = str(model_path)
+        self.threads = max(1, threads)
+        self.labels = labels
+        self.input_size = input_size
+        self._runner_factory = runner_factory
+        self._runner = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.stats = {'predictions': 0, 'last_latency': None}
+        self._stats_lock = threading.Lock()
+
+    def _load(self):
+        if self._runner_factory is not None:
+            return self._runner_factory(self.model_path, self.threads)
+        suffix = os.path.splitext(self.model_path)[1].lower()
+        if suffix not in _RUNNERS:
+            raise InferenceUnavailable(f'Unsupported model format {suffix!r} (expected .onnx or .tflite)')
+        if not os.path.exists(self.model_path):
+            raise InferenceUnavailable(f'Model file not found: {self.model_path}')
+        try:
+            return _RUNNERS[suffix](self.model_path, self.threads)
+        except ImportError as e:
+            raise InferenceUnavailable(f'Runtime for {suffix} models is not installed: {e}')
+
+    def _get_runner(self):
+        with self._lock:
+            if self._runner is None or self._pid != os.getpid():
+                self._runner = self._load()
+                self._pid = os.getpid()
+            return self._runner
+
+    @property
+    def is_warm(self):
+        return self._runner is not None and self._pid == os.getpid()
+
+    def warm_up(self):
+        self._get_runner()
+
+    def _pixels(self, img_bytes):
+        from PIL import Image
+
+        img = Image.open(io.BytesIO(img_bytes))
+        img.draft('RGB', (self.input_size, self.input_size))
+        return img.convert('RGB').resize((self.input_size, self.input_size), Image.BILINEAR)
+
+    def classify(self, img_bytes, timeout=None):
+        runner = self._get_runner()
+        started = time.monotonic()
+        scores = runner(self._pixels(img_bytes))
+        latency = time.monotonic() - started
+        with self._stats_lock:
+            self.stats['predictions'] += 1
+            self.stats['last_latency'] = latency
+        return rank(scores, self.labels), None
+
+
+def build_backend(name=None):
+    """Instantiate the backend named by ``name`` or ``settings.INFERENCE_BACKEND``."""
+    from django.conf import settings
+
+    name = name or settings.INFERENCE_BACKEND
+    if name == GradioBackend.name:
+        return GradioBackend()
+    if name == LocalBackend.name:
+        return LocalBackend(settings.INFERENCE_MODEL_PATH, threads=settings.INFERENCE_THREADS)
+    raise ImproperlyConfigured(f'Unknown INFERENCE_BACKEND {name!r} (expected "gradio" or "local")')
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """Return the process-wide configured backend, creating it on first use."""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = build_backend()
+    return _backend
+
+
+def predict(img_bytes, timeout=None):
+    """Classify and explain ``img_bytes`` with the configured backend: ``(result, heatmap_base64)``."""
+    return get_backend().predict(img_bytes, timeout=timeout)
+
+
+def classify(img_bytes, timeout=None):
+    """``(result, heatmap_base64)`` for ``img_bytes``, without the cost of a heatmap.
+
+    The heatmap is ``None`` unless the backend produced it anyway.
+    """
+    return get_backend().classify(img_bytes, timeout=timeout)
+
+
+def explain(img_bytes, timeout=None):
+    """Grad-CAM heatmap (base64 PNG) for ``img_bytes``, or ``None`` if unsupported."""
+    return get_backend().explain(img_bytes, timeout=timeout)
+
+
+_warm_thread = None
+
+
+def warm_up(background=True):
+    """Preload the configured backend for this process; runs in a thread by default.
+
+    A warm-up already running in the background is returned instead of
+    starting another one (the readiness probe calls this repeatedly).
+    """
+    global _warm_thread
+
+    def _warm():
+        try:
+            backend = get_backend()
+            backend.warm_up()
+            print(f"✅ '{backend.name}' inference backend ready")
+        except Exception as e:
+            print(f"⚠️ Failed to warm up inference backend: {e}")
+
+    if not background:
+        _warm()
+        return None
+    with _backend_lock:
+        if _warm_thread is not None and _warm_thread.is_alive():
+            return _warm_thread
+        _warm_thread = threading.Thread(target=_warm, name='inference-warmup', daemon=True)
+        _warm_thread.start()
+        return _warm_thread
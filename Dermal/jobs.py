@@ -0,0 +1,225 @@
+"""Background prediction queue for uploaded skin images.
+
+Upload views save the ``Dermal_image`` row as ``pending`` and return straight
+away; the prediction runs on a small pool of worker threads inside the
+gunicorn worker so slow Space calls no longer hold request threads.
+
+The database row is the source of truth for job state:
+
+- a worker claims a row by flipping ``pending`` -> ``processing`` with a
+  conditional UPDATE, so a job is never run twice,
+- each attempt is bounded by ``PREDICTION_TIMEOUT`` and failed attempts are
+  retried up to ``PREDICTION_MAX_RETRIES`` times with exponential backoff,
+- the queue holds at most ``PREDICTION_QUEUE_MAX`` jobs; uploads are refused
+  with 503 when it is full,
+- jobs lost when the worker process recycles (``--max-requests``) are picked
+  up again by ``ensure_queued`` when the result page polls for them.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import timedelta
+
+from django.db import close_old_connections
+from django.db.models import F
+from django.utils import timezone
+
+from . import heatmaps, inference, prediction_cache
+
+logger = logging.getLogger(__name__)
+
+PREDICTION_WORKERS = int(os.getenv('PREDICTION_WORKERS', '2'))
+PREDICTION_QUEUE_MAX = int(os.getenv('PREDICTION_QUEUE_MAX', '20'))
+PREDICTION_MAX_RETRIES = int(os.getenv('PREDICTION_MAX_RETRIES', '2'))
+PREDICTION_RETRY_BACKOFF = float(os.getenv('PREDICTION_RETRY_BACKOFF', '2'))
+PREDICTION_TIMEOUT = float(os.getenv('PREDICTION_TIMEOUT', '120'))
+# Run jobs inline in the request thread (tests / debugging)
+PREDICTION_EAGER = os.getenv('PREDICTION_EAGER', 'false').lower() in ('true', '1', 'yes')
+
+
+class QueueFull(Exception):
+    """Raised when the prediction queue cannot take another job."""
+
+
+class PredictionQueue:
+    """Bounded FIFO of image ids drained by daemon worker threads."""
+
+    def __init__(self, handler, workers=PREDICTION_WORKERS, maxsize=PREDICTION_QUEUE_MAX, name='prediction'):
+        self.handler = handler
+        self.name = name
+        self.workers = max(1, workers)
+        self.maxsize = maxsize
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._queued = set()
+        self._lock = threading.Lock()
+        # Notified whenever a job leaves _queued (see wait_for)
+        self._finished = threading.Condition(self._lock)
+        self._threads = []
+        self._pid = None
+
+    @property
+    def depth(self):
+        return self._queue.qsize()
+
+    def is_full(self):
+        return self._queue.full()
+
+    def is_queued(self, image_id):
+        return image_id in self._queued
+
+    def _start(self):
+        # Threads don't survive fork(), so (re)start them in each process.
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._threads = []
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'{self.name}-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, image_id):
+        """Queue ``image_id``; a no-op if it is already waiting or running."""
+        with self._lock:
+            self._start()
+            if image_id in self._queued:
+                return
+            try:
+                self._queue.put_nowait(image_id)
+            except queue.Full:
+                raise QueueFull('Hệ thống đang bận, vui lòng thử lại sau')
+            self._queued.add(image_id)
+
+    def wait_for(self, image_ids, timeout=None):
+        """Block until none of ``image_ids`` is waiting or running; ``False`` on timeout."""
+        image_ids = set(image_ids)
+        with self._finished:
+            return self._finished.wait_for(lambda: not self._queued & image_ids, timeout)
+
+    def join(self):
+        """Block until every queued job has been processed."""
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            image_id = self._queue.get()
+            try:
+                self.handler(image_id)
+            except Exception:
+                logger.exception('%s job %s crashed', self.name.capitalize(), image_id)
+            finally:
+                with self._finished:
+                    self._queued.discard(image_id)
+                    self._finished.notify_all()
+                close_old_connections()
+                self._queue.task_done()
+
+
+def run_prediction(image_id):
+    """Claim one pending image, call the classifier and store the outcome."""
+    from .models import Dermal_image
+
+    Status = Dermal_image.Status
+    claimed = Dermal_image.objects.filter(id=image_id, status=Status.PENDING).update(
+        status=Status.PROCESSING, job_started_at=timezone.now(), updated_at=timezone.now())
+    if not claimed:
+        return
+
+    image = Dermal_image.objects.get(id=image_id)
+    # An identical upload may have finished while this one was queued
+    cached = prediction_cache.lookup(image.digest, record=False)
+    if cached is not None:
+        result, heatmap = cached
+        Dermal_image.objects.filter(id=image_id).update(
+            result=result, heatmap=heatmap, status=Status.DONE, error=None, updated_at=timezone.now())
+        return
+
+    with image.image.open('rb') as fh:
+        img_bytes = fh.read()
+
+    last_error = None
+    for attempt in range(PREDICTION_MAX_RETRIES + 1):
+        Dermal_image.objects.filter(id=image_id).update(attempts=F('attempts') + 1)
+        try:
+            # Classification only; the heatmap is computed when someone opens it,
+            # unless the backend had to produce it anyway
+            result, heatmap_base64 = inference.classify(img_bytes, timeout=PREDICTION_TIMEOUT)
+        except Exception as e:
+            last_error = e
+            logger.warning('Prediction for image %s failed (attempt %d): %s', image_id, attempt + 1, e)
+            if attempt < PREDICTION_MAX_RETRIES:
+                time.sleep(PREDICTION_RETRY_BACKOFF * (2 ** attempt))
+            continue
+        try:
+            heatmap = heatmaps.save_heatmap_base64(heatmap_base64)
+        except (ValueError, OSError) as e:
+            # Not worth failing the prediction: it is computed again on first view
+            logger.warning('Heatmap of image %s not stored: %s', image_id, e)
+            heatmap = None
+        Dermal_image.objects.filter(id=image_id).update(
+            result=result,
+            heatmap=heatmap,
+            status=Status.DONE,
+            error=None,
+            updated_at=timezone.now(),
+        )
+        prediction_cache.store(image.digest, result, heatmap)
+        return
+
+    Dermal_image.objects.filter(id=image_id).update(
+        status=Status.FAILED, error=str(last_error) or type(last_error).__name__, updated_at=timezone.now())
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue():
+    """Return the process-wide prediction queue, creating it on first use."""
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                _queue = PredictionQueue(run_prediction)
+    return _queue
+
+
+def is_saturated():
+    return not PREDICTION_EAGER and get_queue().is_full()
+
+
+def enqueue(image_id):
+    """Hand ``image_id`` to the background workers (or run it inline when eager)."""
+    if PREDICTION_EAGER:
+        run_prediction(image_id)
+    else:
+        get_queue().submit(image_id)
+
+
+def ensure_queued(image):
+    """Re-queue a job that was lost with a recycled worker process.
+
+    A ``pending`` row that this process isn't tracking is simply queued
+    again. A ``processing`` row is only reset once it has been running for
+    longer than every attempt could take, so a job that is still alive in
+    another thread is left alone.
+    """
+    Status = type(image).Status
+    if PREDICTION_EAGER or get_queue().is_queued(image.id):
+        return
+    if image.status == Status.PROCESSING:
+        budget = (PREDICTION_TIMEOUT + PREDICTION_RETRY_BACKOFF * 2 ** PREDICTION_MAX_RETRIES) \
+            * (PREDICTION_MAX_RETRIES + 1)
+        started = image.job_started_at
+        if started and started > timezone.now() - timedelta(seconds=budget):
+            return
+        type(image).objects.filter(id=image.id, status=Status.PROCESSING).update(
+            status=Status.PENDING, updated_at=timezone.now())
+    elif image.status != Status.PENDING:
+        return
+    try:
+        get_queue().submit(image.id)
+    except QueueFull:
+        pass
@@ -0,0 +1,58 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from Dermal import imaging
+from Dermal.models import Dermal_image, Profile
+
+# (model, source field) of every image that has display variants
+_SOURCES = (
+    (Dermal_image, 'image'),
+    (Profile, 'avatar'),
+)
+
+
+class Command(BaseCommand):
+    help = ("Render the missing thumb/medium variants of skin images and avatars uploaded before they existed, "
+            "and record the stored widths their srcset needs.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--dry-run', action='store_true', help="Only count the rows that need variants.")
+
+    def handle(self, *args, **options):
+        for model, source in _SOURCES:
+            missing = Q(**{model.WIDTHS_FIELD: {}})
+            for field in model.VARIANT_FIELDS.values():
+                missing |= Q(**{field: ''}) | Q(**{f'{field}__isnull': True})
+            rows = model.objects.exclude(**{source: ''}).exclude(**{f'{source}__isnull': True}).filter(missing)
+            if options['dry_run']:
+                self.stdout.write(f"{model.__name__}: {rows.count()} row(s) without variants")
+                continue
+            done = failed = 0
+            loaded = ('pk', source, model.WIDTHS_FIELD, *model.VARIANT_FIELDS.values())
+            for obj in rows.only(*loaded).iterator(chunk_size=options['batch_size']):
+                try:
+                    fields = self._backfill(obj, source)
+                except (OSError, imaging.InvalidImage) as e:
+                    failed += 1
+                    self.stderr.write(f"{model.__name__} {obj.pk}: {e}")
+                    continue
+                if model is Dermal_image:
+                    # The result page shows the new srcset: bump its content version
+                    fields.append('updated_at')
+                obj.save(update_fields=fields)
+                done += 1
+            self.stdout.write(f"{model.__name__}: {done} row(s) backfilled, {failed} skipped")
+
+    def _backfill(self, obj, source):
+        """Fill in the variants and widths ``obj`` lacks; returns the fields to save."""
+        model = type(obj)
+        fields = [model.WIDTHS_FIELD]
+        if not all(getattr(obj, field) for field in model.VARIANT_FIELDS.values()):
+            fields = imaging.save_variants(obj, source, model.VARIANT_FIELDS, model.WIDTHS_FIELD)
+        widths = getattr(obj, model.WIDTHS_FIELD)
+        for field in model.SRCSET_FIELDS:
+            if field not in widths:
+                # Files written before widths were recorded: read the header once
+                widths[field] = getattr(obj, field).width
+        return fields
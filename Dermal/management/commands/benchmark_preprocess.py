@@ -0,0 +1,69 @@
+import io
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from PIL import Image
+
+from Dermal import imaging
+
+# Typical uploads: phone photos (often rotated by EXIF), a screenshot and a webcam capture
+_SAMPLES = (
+    ('12 MP phone photo', (4000, 3000), 'JPEG', 6),
+    ('8 MP phone photo', (3264, 2448), 'JPEG', 8),
+    ('4 MP phone photo', (2304, 1728), 'JPEG', 1),
+    ('PNG screenshot', (1080, 2340), 'PNG', 1),
+    ('webcam capture', (1280, 720), 'JPEG', 1),
+)
+
+
+def _sample(size, fmt, orientation):
+    """A photo-like image: smooth gradient with sensor-like noise on top."""
+    gradient = Image.linear_gradient('L').resize(size)
+    noise = Image.effect_noise(size, 24)
+    img = Image.merge('RGB', (gradient, Image.blend(gradient, noise, 0.5), noise))
+    out = io.BytesIO()
+    if fmt == 'JPEG':
+        exif = Image.Exif()
+        exif[0x0112] = orientation
+        img.save(out, fmt, quality=92, exif=exif)
+    else:
+        img.save(out, fmt)
+    return out.getvalue()
+
+
+class Command(BaseCommand):
+    help = "Time upload preprocessing (validate, rotate, downscale, re-encode) and report the bytes saved."
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*', help="Image files to use instead of the generated samples.")
+        parser.add_argument('--iterations', type=int, default=3)
+        parser.add_argument('--max-side', type=int, default=imaging.IMAGE_MAX_SIDE)
+
+    def _samples(self, paths):
+        if not paths:
+            return [(label, _sample(size, fmt, orientation)) for label, size, fmt, orientation in _SAMPLES]
+        samples = []
+        for path in paths:
+            try:
+                with open(path, 'rb') as fh:
+                    samples.append((path, fh.read()))
+            except OSError as e:
+                raise CommandError(str(e))
+        return samples
+
+    def handle(self, *args, **options):
+        iterations, max_side = options['iterations'], options['max_side']
+        total_in = total_out = total_ms = 0
+        self.stdout.write(f"max side {max_side}px, quality {imaging.IMAGE_QUALITY}, {iterations} iteration(s)")
+        for label, data in self._samples(options['paths']):
+            out = imaging.preprocess(data, max_side=max_side)
+            started = time.perf_counter()
+            for _ in range(iterations):
+                imaging.preprocess(data, max_side=max_side)
+            ms = (time.perf_counter() - started) / iterations * 1000
+            size = Image.open(io.BytesIO(out)).size
+            total_in, total_out, total_ms = total_in + len(data), total_out + len(out), total_ms + ms
+            self.stdout.write(f"{label:<20} {len(data) / 1024:9.0f} KB -> {len(out) / 1024:6.0f} KB "
+                              f"{size[0]}x{size[1]:<5} {ms:7.1f} ms")
+        self.stdout.write(f"{'total':<20} {total_in / 1024:9.0f} KB -> {total_out / 1024:6.0f} KB "
+                          f"({total_in / max(total_out, 1):.0f}x smaller) {total_ms:7.1f} ms")
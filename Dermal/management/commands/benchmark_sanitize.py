@@ -0,0 +1,55 @@
+import time
+
+import bleach
+from django.core.management.base import BaseCommand
+
+from Dermal import sanitize
+
+# A paragraph as TinyMCE produces it: inline formatting, a bare URL to linkify
+# and an existing link, followed by a list and a small pasted image.
+_TINYMCE_BLOCK = (
+    '<h2>Chăm sóc da {n}</h2>'
+    '<p>Da <strong>khô</strong> và <em>ngứa</em> kéo dài, xem thêm tại https://example.com/da/{n} '
+    'hoặc <a href="https://dermai.example/bai-viet/{n}" target="_blank">bài viết này</a>.</p>'
+    '<ul><li>Dưỡng ẩm 2 lần/ngày</li><li>Tránh xà phòng mạnh</li><li onclick="x()">Uống đủ nước</li></ul>'
+    '<p><img src="data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8'
+    'z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg==" alt="ảnh {n}"></p>'
+    '<script>alert({n})</script>'
+)
+
+
+def _legacy_clean_post(html):
+    """Per-request sanitizing as views.py did before sanitize.py existed."""
+    html = sanitize.TEMPLATE_TAG_RE.sub('', html)
+    options = sanitize.PROFILES['post']
+    html = bleach.clean(html, tags=options['tags'], attributes=options['attributes'],
+                        protocols=options['protocols'])
+    return bleach.linkify(html)
+
+
+class Command(BaseCommand):
+    help = "Time sanitizing large TinyMCE posts: shared prebuilt cleaner vs. per-call bleach.clean + linkify."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--blocks', type=int, default=200,
+                            help="Repeated TinyMCE blocks per post (200 is roughly 100 KB).")
+        parser.add_argument('--iterations', type=int, default=20)
+
+    def _time(self, func, html, iterations):
+        func(html)  # warm-up
+        started = time.perf_counter()
+        for _ in range(iterations):
+            func(html)
+        return (time.perf_counter() - started) / iterations * 1000
+
+    def handle(self, *args, **options):
+        html = ''.join(_TINYMCE_BLOCK.format(n=n) for n in range(options['blocks']))
+        iterations = options['iterations']
+        if sanitize.clean_post(html) != _legacy_clean_post(html):
+            self.stderr.write("warning: shared cleaner output differs from the legacy pipeline")
+
+        legacy = self._time(_legacy_clean_post, html, iterations)
+        shared = self._time(sanitize.clean_post, html, iterations)
+        self.stdout.write(f"post size: {len(html) / 1024:.1f} KB, {iterations} iteration(s)")
+        self.stdout.write(f"legacy clean+linkify: {legacy:8.2f} ms/post")
+        self.stdout.write(f"shared cleaner:       {shared:8.2f} ms/post ({legacy / shared:.2f}x)")
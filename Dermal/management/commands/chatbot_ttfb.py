@@ -0,0 +1,56 @@
+import json
+import statistics
+import time
+
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+
+from Dermal import chat_cache, gemini, views
+
+
+class Command(BaseCommand):
+    help = ("Report time-to-first-byte of the streaming chatbot endpoint against the full reply time "
+            "(what the blocking chatbot_api makes the user wait), using the fake streaming backend.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunks', type=int, default=40, help="Chunks in the fake reply.")
+        parser.add_argument('--delay', type=float, default=0.05, help="Seconds the fake model takes per chunk.")
+        parser.add_argument('--runs', type=int, default=3)
+
+    def _measure(self, request):
+        started = time.perf_counter()
+        response = async_to_sync(views.chatbot_stream)(request)
+        chunks = iter(response.streaming_content)
+        next(chunks)
+        first = time.perf_counter() - started
+        for _ in chunks:
+            pass
+        return first, time.perf_counter() - started
+
+    def handle(self, *args, **options):
+        chunks = [f'Phần {n} của câu trả lời. ' for n in range(options['chunks'])]
+        request = RequestFactory().post('/chatbot/stream/', json.dumps({'message': 'bệnh chàm là gì'}),
+                                        content_type='application/json')
+        request.user = User(username='ttfb')  # unsaved; the view only needs an authenticated user
+
+        async def auser():
+            return request.user
+        request.auser = auser
+
+        saved = gemini.CHATBOT_STREAM_BACKEND, gemini.fake_backend, chat_cache.CHATBOT_CACHE_ENABLED
+        gemini.CHATBOT_STREAM_BACKEND = 'fake'
+        gemini.fake_backend = gemini.FakeStreamingBackend(chunks, delay=options['delay'])
+        chat_cache.CHATBOT_CACHE_ENABLED = False
+        try:
+            runs = [self._measure(request) for _ in range(options['runs'])]
+        finally:
+            gemini.CHATBOT_STREAM_BACKEND, gemini.fake_backend, chat_cache.CHATBOT_CACHE_ENABLED = saved
+
+        ttfb = statistics.median(first for first, _ in runs) * 1000
+        total = statistics.median(full for _, full in runs) * 1000
+        self.stdout.write(f"fake reply: {options['chunks']} chunks x {options['delay'] * 1000:.0f} ms, "
+                          f"{options['runs']} run(s), median")
+        self.stdout.write(f"streaming (chatbot/stream/) first byte: {ttfb:8.1f} ms")
+        self.stdout.write(f"blocking  (chatbot/api/)    first byte: {total:8.1f} ms (whole reply)")
@@ -0,0 +1,84 @@
+import asyncio
+import json
+import os
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.test import AsyncRequestFactory
+
+from Dermal import chat_cache, gemini, views
+from Dermal.stubs import StubGeminiServer
+
+
+class Command(BaseCommand):
+    help = ("Load-test chatbot_api against a local stand-in Gemini server: the async view on one "
+            "event loop vs. the blocking call on a gthread-sized thread pool.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=50, help="Concurrent chat requests.")
+        parser.add_argument('--delay', type=float, default=0.5, help="Seconds the stand-in model takes per reply.")
+        parser.add_argument('--threads', type=int, default=2, help="Threads of the sync baseline (gunicorn --threads).")
+
+    def _report(self, label, wall, latencies):
+        latencies = sorted(latencies)
+        p95 = latencies[max(0, int(len(latencies) * 0.95) - 1)]
+        self.stdout.write(f"{label:<28} wall {wall:7.2f} s  {len(latencies) / wall:7.1f} req/s  "
+                          f"p50 {statistics.median(latencies) * 1000:7.0f} ms  p95 {p95 * 1000:7.0f} ms")
+
+    def _sync_baseline(self, prompts, threads):
+        def call(prompt):
+            started = time.perf_counter()
+            gemini.generate_reply(prompt)
+            return time.perf_counter() - started
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            latencies = list(pool.map(call, prompts))
+        return time.perf_counter() - started, latencies
+
+    async def _async_views(self, prompts):
+        factory = AsyncRequestFactory()
+        user = User(username='loadtest')  # unsaved; the view only needs an authenticated user
+
+        async def auser():
+            return user
+
+        async def call(prompt):
+            request = factory.post('/chatbot/api/', json.dumps({'message': prompt}),
+                                   content_type='application/json')
+            request.user, request.auser = user, auser
+            started = time.perf_counter()
+            response = await views.chatbot_api(request)
+            assert response.status_code == 200, response.content
+            return time.perf_counter() - started
+
+        started = time.perf_counter()
+        latencies = await asyncio.gather(*(call(prompt) for prompt in prompts))
+        return time.perf_counter() - started, latencies
+
+    def handle(self, *args, **options):
+        stub = StubGeminiServer(delay=options['delay'], reply='Chàm là bệnh viêm da.')
+        prompts = [f'câu hỏi số {n}' for n in range(options['requests'])]
+        env = {'GEMINI_API_URL': stub.url, 'GEMINI_API_KEY': 'loadtest'}
+        saved_env = {key: os.environ.get(key) for key in env}
+        saved = gemini.GEMINI_TRANSPORT, gemini.breaker, chat_cache.CHATBOT_CACHE_ENABLED
+        os.environ.update(env)
+        gemini.GEMINI_TRANSPORT = 'http'
+        gemini.breaker = gemini.CircuitBreaker(threshold=10 ** 6)
+        chat_cache.CHATBOT_CACHE_ENABLED = False
+        try:
+            self.stdout.write(f"{options['requests']} requests, stand-in model delay {options['delay'] * 1000:.0f} ms")
+            self._report(f"sync, {options['threads']} threads", *self._sync_baseline(prompts, options['threads']))
+            self._report("async view, 1 event loop", *async_to_sync(self._async_views)(prompts))
+        finally:
+            gemini.GEMINI_TRANSPORT, gemini.breaker, chat_cache.CHATBOT_CACHE_ENABLED = saved
+            for key, value in saved_env.items():
+                if value is None:
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = value
+            stub.close()
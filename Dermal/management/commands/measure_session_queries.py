@@ -0,0 +1,62 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from Dermal.models import Profile
+
+ENGINES = (
+    ('db', 'django.contrib.sessions.backends.db'),
+    ('cached_db', 'django.contrib.sessions.backends.cached_db'),
+    ('signed_cookies', 'django.contrib.sessions.backends.signed_cookies'),
+)
+DEFAULT_URLS = ('/', '/community/', '/api/feed/', '/profile/', '/chatbot/')
+_USERNAME = '__measure_session_queries__'
+
+
+def measure(engine, urls, requests):
+    """Average ``(queries, session_queries)`` per authenticated GET of each url with ``engine``."""
+    results = {}
+    with override_settings(SESSION_ENGINE=engine):
+        client = Client()
+        client.force_login(User.objects.get(username=_USERNAME))
+        for url in urls:
+            client.get(url)  # warm up: first-use imports, cache fill
+            total = session = 0
+            for _ in range(requests):
+                with CaptureQueriesContext(connection) as queries:
+                    client.get(url)
+                total += len(queries)
+                session += sum('django_session' in query['sql'] for query in queries)
+            results[url] = (total / requests, session / requests)
+        client.logout()
+    return results
+
+
+class Command(BaseCommand):
+    help = ("Count DB queries per authenticated request with each session engine, to show "
+            "what cache-backed sessions save. Runs in a transaction that is rolled back.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('urls', nargs='*', default=DEFAULT_URLS)
+        parser.add_argument('--requests', type=int, default=5, help="Requests per url and engine.")
+
+    def handle(self, *args, **options):
+        urls, requests = options['urls'], options['requests']
+        with transaction.atomic():
+            user = User.objects.create_user(username=_USERNAME)
+            Profile.objects.create(user=user)
+            measured = {label: measure(engine, urls, requests) for label, engine in ENGINES}
+            transaction.set_rollback(True)
+
+        self.stdout.write(f"{'url':<16}" + ''.join(f"{label:>16}" for label, _ in ENGINES) + f"{'saved':>8}")
+        saved_total = 0
+        for url in urls:
+            row = [measured[label][url] for label, _ in ENGINES]
+            saved = row[0][0] - row[1][0]
+            saved_total += saved
+            self.stdout.write(f"{url:<16}" + ''.join(f"{total:>10.1f} ({session:.0f} s)" for total, session in row)
+                              + f"{saved:>8.1f}")
+        self.stdout.write(f"queries per request, (n s) = of which on django_session; "
+                          f"cached_db saves {saved_total / len(urls):.1f} query/request on average")
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from Dermal import votes
+from Dermal.models import Comment, Post
+
+
+class Command(BaseCommand):
+    help = "Recompute the stored up/down vote counters of posts and comments from the vote tables."
+
+    def handle(self, *args, **options):
+        for model in (Post, Comment):
+            fixed = votes.reconcile(model)
+            self.stdout.write(f"{model.__name__}: {fixed} row(s) corrected")
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from Dermal import sanitize
+from Dermal.models import Comment, Post
+
+
+class Command(BaseCommand):
+    help = ("Re-run the write-time sanitizer over stored posts and comments. "
+            "Only needed once for rows saved before content was sanitized on write.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Report changes without saving them.")
+
+    def handle(self, *args, **options):
+        for model, clean in ((Post, sanitize.clean_post), (Comment, sanitize.clean_comment)):
+            changed = 0
+            for pk, content in model.objects.values_list('pk', 'content').iterator(chunk_size=200):
+                cleaned = clean(content)
+                if cleaned != (content or ''):
+                    changed += 1
+                    if not options['dry_run']:
+                        model.objects.filter(pk=pk).update(content=cleaned)
+            self.stdout.write(f"{model.__name__}: {changed} row(s) {'would change' if options['dry_run'] else 'updated'}")
@@ -0,0 +1,118 @@
+import os
+import statistics
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connections, transaction
+
+ALIAS = 'sqlite_concurrency'
+ROWS = 100
+
+
+def tuned_options():
+    """The OPTIONS of the SQLite production profile in settings.py."""
+    return {
+        'init_command': ';'.join(settings.SQLITE_PRAGMAS),
+        'transaction_mode': 'IMMEDIATE',
+        'timeout': settings.SQLITE_BUSY_TIMEOUT_MS / 1000,
+    }
+
+
+def run_workload(path, options, readers=4, writers=2, seconds=2.0, hold=0.002):
+    """Hammer a fresh SQLite file at ``path`` from threads through Django connections.
+
+    Writers repeat a vote-like transaction (read a counter, hold the
+    transaction for ``hold`` seconds, write it back); readers repeat an
+    aggregate over the table. Returns the counts, errors and read latencies.
+    """
+    connections.settings[ALIAS] = dict(connections.settings['default'], NAME=str(path), OPTIONS=options,
+                                       CONN_MAX_AGE=0, TEST={})
+    stats = {'writes': 0, 'reads': 0, 'errors': 0, 'read_latencies': []}
+    lock = threading.Lock()
+    try:
+        with connections[ALIAS].cursor() as cursor:
+            cursor.execute('CREATE TABLE counter (id integer PRIMARY KEY, n integer NOT NULL)')
+            cursor.executemany('INSERT INTO counter (id, n) VALUES (%s, 0)', [(i,) for i in range(ROWS)])
+            cursor.execute('PRAGMA journal_mode')
+            stats['journal_mode'] = cursor.fetchone()[0]
+        deadline = time.perf_counter() + seconds
+
+        def write(worker):
+            row = worker
+            while time.perf_counter() < deadline:
+                row = (row + writers) % ROWS
+                try:
+                    with transaction.atomic(using=ALIAS), connections[ALIAS].cursor() as cursor:
+                        cursor.execute('SELECT n FROM counter WHERE id = %s', [row])
+                        n = cursor.fetchone()[0]
+                        time.sleep(hold)
+                        cursor.execute('UPDATE counter SET n = %s WHERE id = %s', [n + 1, row])
+                    key = 'writes'
+                except OperationalError as e:
+                    if 'locked' not in str(e):
+                        raise
+                    key = 'errors'
+                with lock:
+                    stats[key] += 1
+
+        def read(worker):
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                try:
+                    with connections[ALIAS].cursor() as cursor:
+                        cursor.execute('SELECT COUNT(*), SUM(n) FROM counter')
+                        cursor.fetchone()
+                except OperationalError as e:
+                    if 'locked' not in str(e):
+                        raise
+                    with lock:
+                        stats['errors'] += 1
+                    continue
+                with lock:
+                    stats['reads'] += 1
+                    stats['read_latencies'].append(time.perf_counter() - started)
+
+        def run(target, worker):
+            try:
+                target(worker)
+            finally:
+                connections[ALIAS].close()
+
+        threads = ([threading.Thread(target=run, args=(write, n)) for n in range(writers)]
+                   + [threading.Thread(target=run, args=(read, n)) for n in range(readers)])
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        connections[ALIAS].close()
+        del connections[ALIAS]
+        del connections.settings[ALIAS]
+    return stats
+
+
+class Command(BaseCommand):
+    help = ("Run concurrent SQLite readers and writers against a scratch database, with default "
+            "pragmas and with the production profile from settings.py, and compare.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--readers', type=int, default=4)
+        parser.add_argument('--writers', type=int, default=2)
+        parser.add_argument('--seconds', type=float, default=3.0)
+        parser.add_argument('--hold', type=float, default=0.002, help="Seconds each write transaction stays open.")
+
+    def handle(self, *args, **options):
+        workload = {key: options[key] for key in ('readers', 'writers', 'seconds', 'hold')}
+        self.stdout.write(f"{options['readers']} readers, {options['writers']} writers, {options['seconds']:g} s")
+        for label, sqlite_options in (('default pragmas', {}), ('production profile', tuned_options())):
+            with tempfile.TemporaryDirectory() as tmp:
+                stats = run_workload(os.path.join(tmp, 'bench.sqlite3'), sqlite_options, **workload)
+            latencies = sorted(stats['read_latencies']) or [0]
+            self.stdout.write(
+                f"{label:<20} journal={stats['journal_mode']:<8} writes/s {stats['writes'] / options['seconds']:7.0f}  "
+                f"reads/s {stats['reads'] / options['seconds']:8.0f}  "
+                f"read p50 {statistics.median(latencies) * 1000:6.2f} ms  max {latencies[-1] * 1000:7.1f} ms  "
+                f"'database is locked' {stats['errors']}")
@@ -0,0 +1,116 @@
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+BUDGET_FILE = Path(__file__).resolve().parents[2] / 'startup_budget.json'
+
+# Runs in a fresh interpreter: load the WSGI app as gunicorn does, then serve one request
+_PROBE = '''
+import json, sys, time
+started = time.perf_counter()
+from django.core.wsgi import get_wsgi_application
+application = get_wsgi_application()
+loaded = time.perf_counter()
+status = []
+environ = {
+    'REQUEST_METHOD': 'GET', 'PATH_INFO': sys.argv[1], 'QUERY_STRING': '', 'SERVER_NAME': 'localhost',
+    'SERVER_PORT': '80', 'HTTP_HOST': 'localhost', 'wsgi.url_scheme': 'http', 'wsgi.input': sys.stdin.buffer,
+    'wsgi.errors': sys.stderr,
+}
+b''.join(application(environ, lambda s, headers, exc_info=None: status.append(s)))
+served = time.perf_counter()
+print(json.dumps({
+    'status': status[0], 'app_ms': (loaded - started) * 1000, 'first_request_ms': (served - loaded) * 1000,
+    'total_ms': (served - started) * 1000, 'modules': sorted(sys.modules),
+}))
+'''
+
+
+def load_budget():
+    with open(BUDGET_FILE) as fh:
+        return json.load(fh)
+
+
+def _parse_importtime(stderr):
+    """``[(module, self_us, cumulative_us, depth)]`` from ``python -X importtime`` output."""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        rows.append((name.strip(), int(self_us), int(cumulative_us), (len(name) - len(name.lstrip()) - 1) // 2))
+    return rows
+
+
+def measure(url='/health/'):
+    """Start the app in a new interpreter and time it up to the first response.
+
+    ``PRELOAD_MODEL`` is off in the probe: the backend warm-up runs on a
+    background thread in production and is not part of time-to-first-request.
+    """
+    env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get('DJANGO_SETTINGS_MODULE', 'dermai.settings'),
+               PRELOAD_MODEL='false', PYTHONDONTWRITEBYTECODE='1')
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', _PROBE, url], cwd=settings.BASE_DIR,
+                          env=env, capture_output=True, text=True, stdin=subprocess.DEVNULL, timeout=120)
+    if proc.returncode != 0:
+        raise CommandError(f"Startup probe failed:\n{proc.stderr[-2000:]}")
+    report = json.loads(proc.stdout.strip().splitlines()[-1])
+    report['imports'] = _parse_importtime(proc.stderr)
+    return report
+
+
+def budget_violations(report, budget, timing=True):
+    """Budget problems of ``report``; ``timing=False`` checks only the deferred imports."""
+    problems = []
+    if timing and report['total_ms'] > budget['time_to_first_request_ms']:
+        problems.append(f"time to first request {report['total_ms']:.0f} ms > budget "
+                        f"{budget['time_to_first_request_ms']} ms")
+    loaded = set(report['modules'])
+    for module in budget['deferred_modules']:
+        if module in loaded:
+            problems.append(f"{module} is imported before the first request is served")
+    return problems
+
+
+class Command(BaseCommand):
+    help = ("Report per-module import time and time-to-first-request of a fresh worker, "
+            "and check them against Dermal/startup_budget.json.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default=None, help="Path of the first request (default from the budget).")
+        parser.add_argument('--top', type=int, default=15, help="Slowest imports to list.")
+        parser.add_argument('--check', action='store_true', help="Fail when the budget is exceeded.")
+        parser.add_argument('--skip-timing', action='store_true',
+                            help="Check only the deferred imports, not the wall-clock budget (noisy on shared CI).")
+
+    def handle(self, *args, **options):
+        budget = load_budget()
+        report = measure(options['url'] or budget['url'])
+        imports = report['imports']
+
+        self.stdout.write("Slowest imports (cumulative, top-level):")
+        for name, _, cumulative_us, _ in sorted((row for row in imports if row[3] == 0),
+                                                key=lambda row: -row[2])[:options['top']]:
+            self.stdout.write(f"  {cumulative_us / 1000:8.1f} ms  {name}")
+        self.stdout.write("Slowest imports (self time):")
+        for name, self_us, _, _ in sorted(imports, key=lambda row: -row[1])[:options['top']]:
+            self.stdout.write(f"  {self_us / 1000:8.1f} ms  {name}")
+        self.stdout.write("Project modules (cumulative):")
+        for name, _, cumulative_us, _ in sorted((row for row in imports if row[0].split('.')[0] in ('Dermal', 'dermai')),
+                                                key=lambda row: -row[2]):
+            self.stdout.write(f"  {cumulative_us / 1000:8.1f} ms  {name}")
+
+        self.stdout.write(
+            f"load app {report['app_ms']:.0f} ms + first request ({report['status']}) "
+            f"{report['first_request_ms']:.0f} ms = {report['total_ms']:.0f} ms "
+            f"(budget {budget['time_to_first_request_ms']} ms), {len(report['modules'])} modules")
+        problems = budget_violations(report, budget, timing=not options['skip_timing'])
+        for problem in problems:
+            self.stderr.write(problem)
+        if options['check'] and problems:
+            raise CommandError(f"Startup budget exceeded ({len(problems)} problem(s))")
@@ -0,0 +1,254 @@
+"""Prometheus metrics for capacity planning of the single gunicorn worker.
+
+A few counters and histograms kept in process memory and exposed at
+``/metrics`` in the Prometheus text format (version 0.0.4):
+
+- ``dermai_http_request_duration_seconds{view,method}``: time to produce a
+  response (for streamed replies, until the first byte is ready),
+- ``dermai_http_requests_total{view,method,status}``,
+- ``dermai_db_queries_per_request{view}``: SQL statements per request,
+- ``dermai_remote_call_duration_seconds{service}`` and
+  ``dermai_remote_calls_total{service,outcome}`` for the Gradio Space and
+  Gemini (``outcome`` is successes, failures, retries or short_circuited),
+- gauges for resident memory, prediction queue depth and whether the
+  inference backend is warm.
+
+Values are per process: with more than one worker, scrape each one or sum
+them. There is no dependency on ``prometheus_client``; the format is small
+enough to write out directly.
+"""
+import os
+import sys
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.db import connection
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+REGISTRY = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} takes labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def samples(self):
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield f'{self.name}{self._labels(key)} {_format_value(value)}'
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(float(bound) for bound in buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state['buckets'][i] += 1
+                    break
+            state['sum'] += value
+            state['count'] += 1
+
+    def count(self, **labels):
+        state = self._values.get(self._key(labels))
+        return state['count'] if state else 0
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, dict(state, buckets=list(state['buckets'])))
+                            for key, state in self._values.items())
+        for key, state in values:
+            cumulative = 0
+            for bound, n in zip(self.buckets, state['buckets']):
+                cumulative += n
+                yield f'{self.name}_bucket{self._labels(key, [("le", _format_value(bound))])} {cumulative}'
+            yield f'{self.name}_sum{self._labels(key)} {_format_value(state["sum"])}'
+            yield f'{self.name}_count{self._labels(key)} {state["count"]}'
+
+
+class Gauge(_Metric):
+    """A value read from ``func`` at scrape time."""
+
+    type = 'gauge'
+
+    def __init__(self, name, documentation, func):
+        super().__init__(name, documentation)
+        self.func = func
+
+    def samples(self):
+        try:
+            value = self.func()
+        except Exception:
+            return
+        yield f'{self.name} {_format_value(value)}'
+
+
+def render():
+    """All registered metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        lines.extend(metric.samples())
+    return '\n'.join(lines) + '\n'
+
+
+def reset():
+    """Forget every recorded value (tests)."""
+    for metric in REGISTRY:
+        metric.reset()
+
+
+def resident_memory_bytes():
+    """Current RSS of this process (peak RSS where /proc is missing)."""
+    try:
+        with open('/proc/self/statm') as fh:
+            return int(fh.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _queue_depth():
+    from . import jobs
+    return jobs.get_queue().depth
+
+
+def _backend_warm():
+    from . import inference
+    return int(inference.get_backend().is_warm)
+
+
+request_duration = Histogram(
+    'dermai_http_request_duration_seconds', 'Time to produce a response, per view.', ('view', 'method'))
+requests_total = Counter(
+    'dermai_http_requests_total', 'Responses by view, method and status code.', ('view', 'method', 'status'))
+db_queries = Histogram(
+    'dermai_db_queries_per_request', 'SQL statements executed per request.', ('view',), buckets=QUERY_BUCKETS)
+remote_call_duration = Histogram(
+    'dermai_remote_call_duration_seconds', 'Latency of calls to remote services.', ('service',))
+remote_calls = Counter(
+    'dermai_remote_calls_total', 'Remote service calls by outcome.', ('service', 'outcome'))
+Gauge('dermai_process_resident_memory_bytes', 'Resident memory of this worker process.', resident_memory_bytes)
+Gauge('dermai_prediction_queue_depth', 'Prediction jobs waiting in this process.', _queue_depth)
+Gauge('dermai_inference_backend_warm', '1 once the inference backend is ready in this process.', _backend_warm)
+
+
+class _QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self):
+        connection.execute_wrappers.append(self)
+
+    def remove(self):
+        connection.execute_wrappers.remove(self)
+
+
+class MetricsMiddleware:
+    """Record latency, status and SQL statement count of every request."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def _record(self, request, response, seconds, queries):
+        match = getattr(request, 'resolver_match', None)
+        view = (match.view_name if match else None) or '<unmatched>'
+        request_duration.observe(seconds, view=view, method=request.method)
+        requests_total.inc(view=view, method=request.method, status=response.status_code)
+        db_queries.observe(queries, view=view)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        counter = _QueryCounter()
+        started = time.perf_counter()
+        with connection.execute_wrapper(counter):
+            response = self.get_response(request)
+        self._record(request, response, time.perf_counter() - started, counter.count)
+        return response
+
+    async def __acall__(self, request):
+        counter = _QueryCounter()
+        started = time.perf_counter()
+        # The ORM never runs on the event loop: async views and adapted sync
+        # middleware reach it through sync_to_async, whose thread-sensitive
+        # calls share one worker thread per request. Count on that thread's
+        # connection (thread_sensitive=False calls are not counted).
+        await sync_to_async(counter.install)()
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(counter.remove)()
+        self._record(request, response, time.perf_counter() - started, counter.count)
+        return response
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.6 on 2026-10-18 18:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Dermal', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dermal_image',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='dermal_image',
+            name='error',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='dermal_image',
+            name='job_started_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        # Rows that already exist were predicted synchronously, so they are done.
+        migrations.AddField(
+            model_name='dermal_image',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Đang chờ'), ('processing', 'Đang phân tích'), ('done', 'Hoàn tất'), ('failed', 'Lỗi')], default='done', max_length=16),
+        ),
+        migrations.AlterField(
+            model_name='dermal_image',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Đang chờ'), ('processing', 'Đang phân tích'), ('done', 'Hoàn tất'), ('failed', 'Lỗi')], default='pending', max_length=16),
+        ),
+    ]
@@ -0,0 +1,70 @@
+# Generated by Django 5.2.6 on 2026-10-18 18:47
+
+import base64
+import hashlib
+import re
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import migrations, models
+
+DATA_URL_PREFIX = re.compile(r'^data:image/[\w.+-]+;base64,')
+
+
+def _store(heatmap_base64):
+    """Decode a base64 heatmap into a content-addressed PNG file."""
+    try:
+        png_bytes = base64.b64decode(DATA_URL_PREFIX.sub('', heatmap_base64.strip()))
+    except (ValueError, TypeError):
+        return None
+    digest = hashlib.sha256(png_bytes).hexdigest()
+    name = f'heatmaps/{digest[:2]}/{digest}.png'
+    if not default_storage.exists(name):
+        name = default_storage.save(name, ContentFile(png_bytes))
+    return name
+
+
+def heatmaps_to_files(apps, schema_editor):
+    for model_name in ('Dermal_image', 'PredictionCache'):
+        model = apps.get_model('Dermal', model_name)
+        rows = model.objects.exclude(heatmap__isnull=True).exclude(heatmap='') \
+            .only('id', 'heatmap').iterator(chunk_size=50)
+        for row in rows:
+            if row.heatmap.startswith('heatmaps/'):
+                continue
+            model.objects.filter(id=row.id).update(heatmap=_store(row.heatmap))
+
+
+def files_to_heatmaps(apps, schema_editor):
+    for model_name in ('Dermal_image', 'PredictionCache'):
+        model = apps.get_model('Dermal', model_name)
+        rows = model.objects.filter(heatmap__startswith='heatmaps/') \
+            .only('id', 'heatmap').iterator(chunk_size=50)
+        for row in rows:
+            try:
+                with default_storage.open(row.heatmap, 'rb') as fh:
+                    encoded = base64.b64encode(fh.read()).decode('ascii')
+            except OSError:
+                encoded = None
+            model.objects.filter(id=row.id).update(heatmap=encoded)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Dermal', '0003_prediction_cache'),
+    ]
+
+    operations = [
+        migrations.RunPython(heatmaps_to_files, files_to_heatmaps),
+        migrations.AlterField(
+            model_name='dermal_image',
+            name='heatmap',
+            field=models.ImageField(blank=True, null=True, upload_to='heatmaps/'),
+        ),
+        migrations.AlterField(
+            model_name='predictioncache',
+            name='heatmap',
+            field=models.CharField(blank=True, max_length=100, null=True),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.2.6 on 2026-10-18 18:50
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_vote_counts(apps, schema_editor):
+    for model_name, fk in (('Post', 'post'), ('Comment', 'comment')):
+        model = apps.get_model('Dermal', model_name)
+        counts = {}
+        for field in ('upvotes', 'downvotes'):
+            through = getattr(model, field).through
+            counted = through.objects.filter(**{fk: OuterRef('pk')}).order_by() \
+                .values(fk).annotate(n=Count('*')).values('n')
+            counts[field[:-1] + '_count'] = Coalesce(Subquery(counted), 0)
+        model.objects.update(**counts)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Dermal', '0004_heatmap_files'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='downvote_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='upvote_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='downvote_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='upvote_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_vote_counts, migrations.RunPython.noop),
+    ]
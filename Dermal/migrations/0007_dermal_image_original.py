@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-18 19:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Dermal', '0006_post_feed_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dermal_image',
+            name='original',
+            field=models.FileField(blank=True, null=True, upload_to='originals/'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.6 on 2026-10-18 19:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Dermal', '0007_dermal_image_original'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dermal_image',
+            name='image_medium',
+            field=models.ImageField(blank=True, null=True, upload_to='images/medium/'),
+        ),
+        migrations.AddField(
+            model_name='dermal_image',
+            name='image_thumb',
+            field=models.ImageField(blank=True, null=True, upload_to='images/thumb/'),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='avatar_medium',
+            field=models.ImageField(blank=True, null=True, upload_to='avatars/medium/'),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='avatar_thumb',
+            field=models.ImageField(blank=True, null=True, upload_to='avatars/thumb/'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.6 on 2026-10-18 20:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Dermal', '0010_dermal_image_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dermal_image',
+            name='image_widths',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='avatar_widths',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -1,7 +1,10 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.urls import reverse
 from tinymce.models import HTMLField
 
+from . import imaging
+
 # Create your models here.
 
 
@@ -11,30 +14,129 @@ class Profile(models.Model):
     title = models.CharField(max_length=100, blank=True)
     location = models.CharField(max_length=100, blank=True)
     avatar = models.ImageField(upload_to='avatars/', blank=True, null=True)
+    # Display variants of the avatar (see Dermal/imaging.py)
+    avatar_thumb = models.ImageField(upload_to='avatars/thumb/', blank=True, null=True)
+    avatar_medium = models.ImageField(upload_to='avatars/medium/', blank=True, null=True)
+    # Stored width in px of each variant, by field name, so srcset opens no file
+    avatar_widths = models.JSONField(default=dict, blank=True)
     birth_date = models.DateField(null=True, blank=True)
 
+    VARIANT_FIELDS = {'thumb': 'avatar_thumb', 'medium': 'avatar_medium'}
+    # Candidates of avatar_srcset, smallest first
+    SRCSET_FIELDS = ('avatar_thumb', 'avatar_medium')
+    WIDTHS_FIELD = 'avatar_widths'
+
     def __str__(self):
         return f"{self.user.username}'s profile"
 
+    @property
+    def avatar_thumb_url(self):
+        if not self.avatar:
+            return None
+        return (self.avatar_thumb or self.avatar).url
+
+    @property
+    def avatar_srcset(self):
+        if not self.avatar_thumb:
+            return ''
+        return imaging.srcset(*((getattr(self, field), self.avatar_widths.get(field))
+                                for field in self.SRCSET_FIELDS))
+
 
 class Dermal_image(models.Model):
+    class Status(models.TextChoices):
+        PENDING = 'pending', 'Đang chờ'
+        PROCESSING = 'processing', 'Đang phân tích'
+        DONE = 'done', 'Hoàn tất'
+        FAILED = 'failed', 'Lỗi'
+
+    # Downscaled, upright JPEG (see Dermal/imaging.py)
     image = models.ImageField(upload_to='images/')
+    # Untouched upload, only kept with IMAGE_KEEP_ORIGINAL=true
+    original = models.FileField(upload_to='originals/', blank=True, null=True)
+    image_thumb = models.ImageField(upload_to='images/thumb/', blank=True, null=True)
+    image_medium = models.ImageField(upload_to='images/medium/', blank=True, null=True)
+    # Stored width in px of image and its variants, by field name, so srcset opens no file
+    image_widths = models.JSONField(default=dict, blank=True)
     uploaded_at = models.DateTimeField(auto_now_add=True)
     user = models.ForeignKey(Profile, on_delete=models.CASCADE)
     result = models.JSONField(blank=True, null=True)
     drug_history = models.TextField(blank=True, null=True)
     illness_history = models.TextField(blank=True, null=True)
     age = models.IntegerField(blank=True, null=True)
-    heatmap = models.TextField(blank=True, null=True)
+    # Grad-CAM PNG in media storage, content-addressed; computed on first view (see Dermal/heatmaps.py)
+    heatmap = models.ImageField(upload_to='heatmaps/', blank=True, null=True)
     more_predict = models.TextField(blank=True, null=True)
     symptom = models.TextField(blank=True, null=True)
     gender = models.TextField(blank=True, null=True)
-    # heatmap = models.TextField(blank=True, null=True)  # base64 string
     explain = models.TextField(blank=True, null=True)
+    # Background prediction job state (see Dermal/jobs.py)
+    status = models.CharField(
+        max_length=16, choices=Status.choices, default=Status.PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.TextField(blank=True, null=True)
+    job_started_at = models.DateTimeField(blank=True, null=True)
+    # sha256 of the preprocessed image bytes, key into PredictionCache
+    digest = models.CharField(max_length=64, blank=True, db_index=True)
+    # Version of what the result page shows: ETag and fragment cache key
+    # (see result_view). Bulk .update() calls must set it too.
+    updated_at = models.DateTimeField(auto_now=True)
+
+    VARIANT_FIELDS = {'thumb': 'image_thumb', 'medium': 'image_medium'}
+    # Candidates of image_srcset, smallest first
+    SRCSET_FIELDS = ('image_thumb', 'image_medium', 'image')
+    WIDTHS_FIELD = 'image_widths'
+
+    class Meta:
+        indexes = [
+            # A user's classification history, newest first (profile page)
+            models.Index(fields=['user', '-uploaded_at'], name='image_user_recent_idx'),
+        ]
 
     def __str__(self):
         return f"Image {self.id} uploaded at {self.uploaded_at}"
 
+    @property
+    def thumbnail_url(self):
+        return (self.image_thumb or self.image).url
+
+    @property
+    def image_srcset(self):
+        if not self.image_thumb:
+            return ''
+        return imaging.srcset(*((getattr(self, field), self.image_widths.get(field))
+                                for field in self.SRCSET_FIELDS))
+
+    @property
+    def is_pending(self):
+        return self.status in (self.Status.PENDING, self.Status.PROCESSING)
+
+    @property
+    def content_version(self):
+        return f'{self.id}.{self.updated_at.timestamp():.6f}'
+
+    @property
+    def heatmap_url(self):
+        """Cache-friendly URL of the heatmap, versioned by its content hash."""
+        if not self.heatmap:
+            return None
+        version = self.heatmap.name.rsplit('/', 1)[-1].split('.')[0][:16]
+        return f"{reverse('heatmap', args=[self.id])}?v={version}"
+
+
+class PredictionCache(models.Model):
+    """Persistent classifier output keyed by the hash of the image bytes."""
+    digest = models.CharField(max_length=64, unique=True)
+    result = models.JSONField()
+    # storage name of the heatmap file shared with the Dermal_image rows
+    heatmap = models.CharField(max_length=100, blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    hits = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"Prediction {self.digest[:12]} ({self.hits} hits)"
+
 
 class Post(models.Model):
     author = models.ForeignKey(Profile, on_delete=models.CASCADE)
@@ -44,9 +146,20 @@ class Post(models.Model):
         Profile, related_name='upvoted_posts', blank=True)
     downvotes = models.ManyToManyField(
         Profile, related_name='downvoted_posts', blank=True)
+    # Denormalized from upvotes/downvotes, maintained by Dermal/votes.py
+    upvote_count = models.PositiveIntegerField(default=0)
+    downvote_count = models.PositiveIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        # Keyset pagination of the community feed (see Dermal/pagination.py)
+        indexes = [
+            models.Index(fields=['-created_at', '-id'], name='post_feed_idx'),
+            # An author's posts, newest first (profile page)
+            models.Index(fields=['author', '-created_at'], name='post_author_recent_idx'),
+        ]
+
     def __str__(self):
         return self.title
 
@@ -60,7 +173,17 @@ class Comment(models.Model):
         Profile, related_name='upvoted_comments', blank=True)
     downvotes = models.ManyToManyField(
         Profile, related_name='downvoted_comments', blank=True)
+    upvote_count = models.PositiveIntegerField(default=0)
+    downvote_count = models.PositiveIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # Keyset pagination of a post's comments (post_comments)
+            models.Index(fields=['post', '-created_at', '-id'], name='comment_post_recent_idx'),
+            # An author's comments, newest first (profile page)
+            models.Index(fields=['author', '-created_at'], name='comment_author_recent_idx'),
+        ]
+
     def __str__(self):
         return f"Comment by {self.author.user.username} on {self.post.title}"
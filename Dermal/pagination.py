@@ -0,0 +1,69 @@
+"""Keyset (cursor) pagination over ``(created_at, id)``.
+
+OFFSET pagination gets slower the deeper you page because the database still
+walks every skipped row. A keyset page instead resumes strictly after the
+last row of the previous page, so every page costs one index range scan no
+matter how large the table is.
+
+Cursors are opaque to clients: a urlsafe-base64 ``"<iso timestamp>|<id>"``.
+"""
+import base64
+import binascii
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 50
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(obj):
+    raw = f'{obj.created_at.isoformat()}|{obj.pk}'
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    """Return ``(created_at, id)`` for a cursor produced by ``encode_cursor``."""
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        created_at, pk = base64.urlsafe_b64decode(padded).decode().rsplit('|', 1)
+        parsed = parse_datetime(created_at)
+        if parsed is None:
+            raise ValueError(created_at)
+        return parsed, int(pk)
+    except (ValueError, binascii.Error, UnicodeDecodeError):
+        raise InvalidCursor('Cursor không hợp lệ')
+
+
+def page_size(value, default=DEFAULT_PAGE_SIZE):
+    """Clamp a ``?limit=`` query value to ``1..MAX_PAGE_SIZE``."""
+    try:
+        return max(1, min(int(value), MAX_PAGE_SIZE))
+    except (TypeError, ValueError):
+        return default
+
+
+def keyset_page(queryset, cursor=None, limit=DEFAULT_PAGE_SIZE, newest_first=True):
+    """Return ``(items, next_cursor)`` for one page of ``queryset``.
+
+    ``next_cursor`` is ``None`` on the last page. Raises ``InvalidCursor``
+    for a malformed cursor.
+    """
+    if newest_first:
+        queryset = queryset.order_by('-created_at', '-id')
+    else:
+        queryset = queryset.order_by('created_at', 'id')
+    if cursor:
+        created_at, pk = decode_cursor(cursor)
+        if newest_first:
+            after = Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk)
+        else:
+            after = Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=pk)
+        queryset = queryset.filter(after)
+    items = list(queryset[:limit + 1])
+    next_cursor = encode_cursor(items[limit - 1]) if len(items) > limit else None
+    return items[:limit], next_cursor
@@ -0,0 +1,155 @@
+"""Content-addressed cache of classifier output.
+
+The same photo is often uploaded more than once (retries after a timeout, or
+the same file through both upload views). Each upload is keyed by the sha256
+of its bytes; a repeat upload reuses the stored ``result`` + heatmap file
+name (once someone has asked for the heatmap) instead of paying for
+another remote inference.
+
+Entries live in the ``PredictionCache`` table so they survive gunicorn
+recycling the worker (``--max-requests``), with a small in-process LRU in
+front of it. The table is bounded by ``PREDICTION_CACHE_MAX_ENTRIES``
+(least-recently-used rows are evicted first) and entries expire after
+``PREDICTION_CACHE_TTL`` seconds.
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.db.models import F, Sum
+from django.utils import timezone
+
+PREDICTION_CACHE_ENABLED = os.getenv('PREDICTION_CACHE_ENABLED', 'true').lower() in ('true', '1', 'yes')
+PREDICTION_CACHE_MAX_ENTRIES = int(os.getenv('PREDICTION_CACHE_MAX_ENTRIES', '500'))
+PREDICTION_CACHE_TTL = int(os.getenv('PREDICTION_CACHE_TTL', str(30 * 24 * 3600)))
+PREDICTION_CACHE_MEMORY_ENTRIES = int(os.getenv('PREDICTION_CACHE_MEMORY_ENTRIES', '128'))
+
+
+def image_digest(img_bytes):
+    """Cache key for an uploaded image."""
+    return hashlib.sha256(img_bytes).hexdigest()
+
+
+class PredictionResultCache:
+    """Two-level (process LRU + database) cache of ``(result, heatmap)``."""
+
+    def __init__(self, max_entries=PREDICTION_CACHE_MAX_ENTRIES, ttl=PREDICTION_CACHE_TTL,
+                 memory_entries=PREDICTION_CACHE_MEMORY_ENTRIES):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.memory_entries = memory_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _remember(self, digest, value):
+        with self._lock:
+            self._memory[digest] = (time.monotonic() + self.ttl, value)
+            self._memory.move_to_end(digest)
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+
+    def _from_memory(self, digest):
+        with self._lock:
+            entry = self._memory.get(digest)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._memory[digest]
+                return None
+            self._memory.move_to_end(digest)
+            return value
+
+    def get(self, digest, record=True):
+        """Return ``(result, heatmap)`` for ``digest`` or ``None`` on a miss.
+
+        ``record=False`` peeks without touching the hit/miss counters.
+        """
+        from .models import PredictionCache
+
+        value = self._from_memory(digest)
+        if value is None:
+            cutoff = timezone.now() - timedelta(seconds=self.ttl)
+            row = PredictionCache.objects.filter(digest=digest, created_at__gte=cutoff) \
+                .values_list('result', 'heatmap').first()
+            if row is not None:
+                value = tuple(row)
+                self._remember(digest, value)
+        if not record:
+            return value
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if value is None:
+            return None
+        PredictionCache.objects.filter(digest=digest).update(
+            hits=F('hits') + 1, last_used_at=timezone.now())
+        return value
+
+    def set(self, digest, result, heatmap):
+        from .models import PredictionCache
+
+        now = timezone.now()
+        PredictionCache.objects.update_or_create(
+            digest=digest,
+            defaults={'result': result, 'heatmap': heatmap, 'created_at': now, 'last_used_at': now})
+        self._remember(digest, (result, heatmap))
+        self.evict()
+
+    def evict(self):
+        """Drop expired rows, then the least recently used beyond the size bound."""
+        from .models import PredictionCache
+
+        PredictionCache.objects.filter(
+            created_at__lt=timezone.now() - timedelta(seconds=self.ttl)).delete()
+        stale = PredictionCache.objects.order_by('-last_used_at') \
+            .values_list('id', flat=True)[self.max_entries:]
+        stale_ids = list(stale)
+        if stale_ids:
+            PredictionCache.objects.filter(id__in=stale_ids).delete()
+
+    def clear(self):
+        from .models import PredictionCache
+
+        PredictionCache.objects.all().delete()
+        with self._lock:
+            self._memory.clear()
+        self.hits = self.misses = 0
+
+    def stats(self):
+        """Hit/miss counters for this process plus the persisted totals."""
+        from .models import PredictionCache
+
+        lifetime_hits = PredictionCache.objects.aggregate(total=Sum('hits'))['total']
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'memory_entries': len(self._memory),
+            'entries': PredictionCache.objects.count(),
+            'lifetime_hits': lifetime_hits or 0,
+        }
+
+
+_cache = PredictionResultCache()
+
+
+def get_cache():
+    return _cache
+
+
+def lookup(digest, record=True):
+    if not PREDICTION_CACHE_ENABLED or not digest:
+        return None
+    return _cache.get(digest, record=record)
+
+
+def store(digest, result, heatmap):
+    if PREDICTION_CACHE_ENABLED and digest:
+        _cache.set(digest, result, heatmap)
@@ -0,0 +1,186 @@
+"""Opt-in per-request profiling, to find the slow and query-heavy views.
+
+With ``PROFILING_ENABLED=true`` every request records its wall time, SQL
+statement count, total SQL time and the ``PROFILING_TOP_QUERIES`` slowest
+statements. Some requests additionally run under ``cProfile``:
+
+- a random ``PROFILING_SAMPLE_RATE`` fraction of them (0 by default),
+- requests from staff users that send ``X-Profile: 1``.
+
+Records go into a ring buffer of the last ``PROFILING_BUFFER_SIZE`` requests
+in this process and are shown on the staff-only page ``/profiling/``.
+
+When disabled the middleware removes itself at startup (``MiddlewareNotUsed``)
+and costs nothing. When enabled but not sampling, the cost is one timer call
+per SQL statement. ``cProfile`` only runs when the middleware chain is sync
+(gunicorn/WSGI): under ASGI a request shares its thread with every other
+coroutine on the event loop, so async records carry no cProfile capture.
+Their SQL is still accounted for on the ``sync_to_async`` worker thread that
+runs the ORM calls of the request.
+"""
+import cProfile
+import heapq
+import io
+import itertools
+import os
+import pstats
+import random
+import threading
+import time
+from collections import deque
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django.utils import timezone
+
+PROFILING_ENABLED = os.getenv('PROFILING_ENABLED', 'false').lower() in ('true', '1', 'yes')
+PROFILING_SAMPLE_RATE = float(os.getenv('PROFILING_SAMPLE_RATE', '0'))
+PROFILING_BUFFER_SIZE = int(os.getenv('PROFILING_BUFFER_SIZE', '200'))
+PROFILING_TOP_QUERIES = int(os.getenv('PROFILING_TOP_QUERIES', '5'))
+# Functions kept from each cProfile capture, by cumulative time
+PROFILING_STATS_LINES = int(os.getenv('PROFILING_STATS_LINES', '40'))
+
+PROFILE_HEADER = 'X-Profile'
+
+_records = deque(maxlen=max(1, PROFILING_BUFFER_SIZE))
+_ids = itertools.count(1)
+_lock = threading.Lock()
+
+
+def records():
+    """The buffered request records, newest first."""
+    with _lock:
+        return list(reversed(_records))
+
+
+def get_record(record_id):
+    for record in records():
+        if record['id'] == record_id:
+            return record
+    return None
+
+
+def clear():
+    with _lock:
+        _records.clear()
+
+
+def _add(record):
+    with _lock:
+        record['id'] = next(_ids)
+        _records.append(record)
+
+
+class _QueryTimer:
+    """``execute_wrapper`` that counts and times SQL, keeping the slowest statements."""
+
+    def __init__(self, keep):
+        self.keep = keep
+        self.count = 0
+        self.seconds = 0.0
+        self._slowest = []  # min-heap of (seconds, n, sql)
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.count += 1
+            self.seconds += elapsed
+            if self.keep:
+                entry = (elapsed, self.count, sql)
+                if len(self._slowest) < self.keep:
+                    heapq.heappush(self._slowest, entry)
+                elif elapsed > self._slowest[0][0]:
+                    heapq.heapreplace(self._slowest, entry)
+
+    def install(self):
+        connection.execute_wrappers.append(self)
+
+    def remove(self):
+        connection.execute_wrappers.remove(self)
+
+    def slowest(self):
+        return [{'ms': round(seconds * 1000, 2), 'sql': sql}
+                for seconds, _, sql in sorted(self._slowest, reverse=True)]
+
+
+def _stats_text(profiler):
+    out = io.StringIO()
+    stats = pstats.Stats(profiler, stream=out)
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(PROFILING_STATS_LINES)
+    return out.getvalue()
+
+
+class ProfilingMiddleware:
+    """Record per-request timings into the ring buffer; see the module docstring."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not PROFILING_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def _sampled(self, request):
+        if request.headers.get(PROFILE_HEADER) == '1':
+            user = getattr(request, 'user', None)
+            if user is not None and user.is_staff:
+                return 'header'
+        if PROFILING_SAMPLE_RATE > 0 and random.random() < PROFILING_SAMPLE_RATE:
+            return 'sampled'
+        return None
+
+    def _record(self, request, response, seconds, timer, trigger=None, profiler=None):
+        match = getattr(request, 'resolver_match', None)
+        _add({
+            'at': timezone.now(),
+            'method': request.method,
+            'path': request.path,
+            'view': (match.view_name if match else None) or '<unmatched>',
+            'status': response.status_code,
+            'ms': round(seconds * 1000, 1),
+            'queries': timer.count,
+            'sql_ms': round(timer.seconds * 1000, 1),
+            'slowest': timer.slowest(),
+            'trigger': trigger,
+            'profile': _stats_text(profiler) if profiler is not None else None,
+        })
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        timer = _QueryTimer(PROFILING_TOP_QUERIES)
+        started = time.perf_counter()
+        with connection.execute_wrapper(timer):
+            trigger = self._sampled(request)
+            if trigger is None:
+                response = self.get_response(request)
+                profiler = None
+            else:
+                profiler = cProfile.Profile()
+                profiler.enable()
+                try:
+                    response = self.get_response(request)
+                finally:
+                    profiler.disable()
+        self._record(request, response, time.perf_counter() - started, timer, trigger, profiler)
+        return response
+
+    async def __acall__(self, request):
+        timer = _QueryTimer(PROFILING_TOP_QUERIES)
+        started = time.perf_counter()
+        # Time SQL on the connection of the thread-sensitive worker thread that
+        # runs the request's ORM calls, not on the event loop's (see metrics.py)
+        await sync_to_async(timer.install)()
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(timer.remove)()
+        self._record(request, response, time.perf_counter() - started, timer)
+        return response
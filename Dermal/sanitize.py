@@ -0,0 +1,98 @@
+"""HTML sanitization for user posts, comments and chatbot replies.
+
+Each content profile gets one ``bleach.Cleaner`` with linkification built in
+as a filter, so a document is parsed and serialized once instead of once for
+``clean()`` and again for ``linkify()``. Content is sanitized when it is
+written; stored HTML is rendered as-is, so reads never rewrite it.
+
+``Cleaner`` instances are not thread-safe (the html5lib parser keeps state),
+and gunicorn serves requests from several threads, so each thread builds its
+own cleaner per profile on first use and reuses it afterwards.
+
+``bleach`` and ``markdown2`` are imported on first use, not at startup.
+"""
+import re
+import threading
+
+# Django template tokens ({% ... %} and {{ ... }}) must never reach storage
+TEMPLATE_TAG_RE = re.compile(r'\{%[\s\S]*?%\}|\{\{[\s\S]*?\}\}')
+
+_LINK_ATTRS = ['href', 'title', 'rel', 'target']
+
+PROFILES = {
+    # TinyMCE posts: headings and inline images (pasted images arrive as data: URLs)
+    'post': {
+        'tags': ['a', 'abbr', 'b', 'blockquote', 'code', 'em', 'i', 'li', 'ol', 'p', 'pre',
+                 'strong', 'ul', 'br', 'hr', 'h1', 'h2', 'h3', 'img'],
+        'attributes': {'a': _LINK_ATTRS, 'img': ['src', 'alt', 'title']},
+        'protocols': ['http', 'https', 'data', 'mailto'],
+    },
+    'comment': {
+        'tags': ['a', 'b', 'blockquote', 'code', 'em', 'i', 'li', 'ol', 'p', 'pre',
+                 'strong', 'ul', 'br'],
+        'attributes': {'a': _LINK_ATTRS},
+        'protocols': ['http', 'https', 'mailto'],
+    },
+    # Markdown rendered from chatbot / Gemini replies
+    'chat': {
+        'tags': ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code', 'em', 'i', 'li', 'ol', 'p', 'pre',
+                 'strong', 'ul', 'br', 'hr', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6'],
+        'attributes': {'a': _LINK_ATTRS},
+        'protocols': ['http', 'https', 'mailto'],
+    },
+}
+
+_local = threading.local()
+
+
+def _build_cleaner(profile):
+    import bleach
+    from bleach.linkifier import LinkifyFilter
+
+    options = PROFILES[profile]
+    return bleach.Cleaner(
+        tags=options['tags'],
+        attributes=options['attributes'],
+        protocols=options['protocols'],
+        filters=[LinkifyFilter],
+    )
+
+
+def get_cleaner(profile):
+    """This thread's prebuilt cleaner for ``profile``."""
+    cleaners = getattr(_local, 'cleaners', None)
+    if cleaners is None:
+        cleaners = _local.cleaners = {}
+    cleaner = cleaners.get(profile)
+    if cleaner is None:
+        cleaner = cleaners[profile] = _build_cleaner(profile)
+    return cleaner
+
+
+def strip_template_tags(text):
+    if not text:
+        return text
+    return TEMPLATE_TAG_RE.sub('', text)
+
+
+def clean_html(html, profile):
+    """Strip template tokens, then sanitize and linkify ``html`` for ``profile``."""
+    if not html:
+        return ''
+    return get_cleaner(profile).clean(strip_template_tags(html))
+
+
+def clean_post(html):
+    return clean_html(html, 'post')
+
+
+def clean_comment(html):
+    return clean_html(html, 'comment')
+
+
+def render_chat_reply(text):
+    """Render a Markdown chatbot reply to sanitized HTML."""
+    if not isinstance(text, str) or not text:
+        return ''
+    import markdown2
+    return clean_html(markdown2.markdown(text), 'chat')
@@ -0,0 +1,63 @@
+"""Local stand-ins for remote services.
+
+``StubGeminiServer`` is a small threaded HTTP server that answers like the
+Gemini HTTP endpoint (``GEMINI_API_URL``). Tests script its responses; the
+load-test command gives every reply a fixed delay to play a slow model.
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128  # load tests open many connections at once
+
+
+class StubGeminiServer:
+    """Local HTTP stand-in for GEMINI_API_URL.
+
+    Each POST pops the next ``(status, payload, delay)`` from ``script``;
+    once the script is empty it answers ``200 {"text": reply}`` after
+    ``delay`` seconds.
+    """
+
+    def __init__(self, delay=0.0, reply='ok'):
+        self.script = []
+        self.seen_ports = []
+        self.delay = delay
+        self.reply = reply
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive, so pooling is observable
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                stub.seen_ports.append(self.client_address[1])
+                if stub.script:
+                    status, payload, delay = stub.script.pop(0)
+                else:
+                    status, payload, delay = 200, {'text': stub.reply}, stub.delay
+                time.sleep(delay)
+                body = json.dumps(payload).encode('utf-8')
+                try:
+                    self.send_response(status)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # the client gave up (read timeout)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = _Server(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}/generate'
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -1,3 +1,1704 @@
-from django.test import TestCase
+import asyncio
+import base64
+import io
+import json
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image
+
+from . import (chat_cache, gemini, heatmaps, imaging, inference, jobs, metrics, pagination, prediction_cache, profiling,
+               sanitize, uploads, views, votes)
+from .models import Comment, Dermal_image, Post, PredictionCache, Profile
+from .stubs import StubGeminiServer
 
 # Create your tests here.
+
+MEDIA_ROOT = tempfile.mkdtemp(prefix='dermai-test-media-')
+
+FAKE_OUTPUT = {
+    'result': [{'class': 'Eczema', 'probability': 91.5}, {'class': 'Psoriasis', 'probability': 8.5}],
+    'heatmap_base64': 'aGVhdG1hcA==',
+}
+
+
+class FakeGradioClient:
+    """Stand-in for ``gradio_client.Client`` that records its calls."""
+
+    def __init__(self, src, fail_with=None, delay=0, endpoints=('predict', 'predict_with_gradcam')):
+        self.src = src
+        self.fail_with = fail_with
+        self.delay = delay
+        self.endpoints = endpoints
+        self.calls = []
+
+    def view_api(self, print_info=True, return_format=None):
+        return {'named_endpoints': {f'/{name}': {} for name in self.endpoints}, 'unnamed_endpoints': {}}
+
+    def predict(self, *args, api_name=None):
+        self.calls.append(api_name)
+        if self.delay:
+            time.sleep(self.delay)
+        if self.fail_with is not None:
+            raise self.fail_with
+        return dict(FAKE_OUTPUT)
+
+    def submit(self, *args, api_name=None):
+        return ThreadPoolExecutor(max_workers=1).submit(self.predict, *args, api_name=api_name)
+
+
+def install_fake_pool(testcase, **client_kwargs):
+    """Swap the process-wide Gradio pool for one built from FakeGradioClient."""
+    built = []
+
+    def factory(src):
+        built.append(FakeGradioClient(src, **client_kwargs))
+        return built[-1]
+
+    original, inference._pool = inference._pool, inference.GradioClientPool(client_factory=factory)
+    testcase.addCleanup(setattr, inference, '_pool', original)
+    return built
+
+
+def jpeg_bytes(size=(64, 48), seed=0, orientation=None, fmt='JPEG'):
+    """A small real image; ``seed`` varies the pixels so digests differ."""
+    img = Image.new('RGB', size, (200, 120 + seed % 100, 90))
+    img.putpixel((0, 0), (255, 255, 255))
+    out = io.BytesIO()
+    kwargs = {}
+    if orientation is not None:
+        exif = Image.Exif()
+        exif[0x0112] = orientation
+        kwargs['exif'] = exif
+    img.save(out, fmt, **kwargs)
+    return out.getvalue()
+
+
+def tearDownModule():
+    shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+
+
+class GradioClientPoolTests(TestCase):
+    def test_client_is_built_once_and_reused(self):
+        built = []
+        pool = inference.GradioClientPool(
+            client_factory=lambda src: built.append(FakeGradioClient(src)) or built[-1])
+        pool.warm_up()
+        for _ in range(3):
+            self.assertEqual(pool.predict(b'img', api_name='predict_with_gradcam'), FAKE_OUTPUT)
+        self.assertEqual(len(built), 1)
+        self.assertEqual(built[0].calls, ['predict_with_gradcam'] * 3)
+
+    def test_broken_client_is_rebuilt(self):
+        clients = [FakeGradioClient('x', fail_with=ConnectionError('reset')), FakeGradioClient('x')]
+        pool = inference.GradioClientPool(client_factory=lambda src: clients.pop(0))
+        self.assertEqual(pool.predict(b'img', api_name='predict_with_gradcam'), FAKE_OUTPUT)
+        self.assertEqual(pool.stats['built'], 2)
+        self.assertEqual(pool.stats['discarded'], 1)
+        self.assertEqual(pool.idle_count, 1)
+
+    def test_application_errors_keep_the_client(self):
+        pool = inference.GradioClientPool(
+            client_factory=lambda src: FakeGradioClient(src, fail_with=ValueError('bad image')))
+        with self.assertRaises(ValueError):
+            pool.predict(b'img', api_name='predict_with_gradcam')
+        self.assertEqual(pool.stats['built'], 1)
+        self.assertEqual(pool.idle_count, 1)
+
+    def test_concurrency_is_bounded(self):
+        pool = inference.GradioClientPool(
+            size=1, acquire_timeout=0.05,
+            client_factory=lambda src: FakeGradioClient(src, delay=0.3))
+        worker = threading.Thread(target=pool.predict, args=(b'img',),
+                                  kwargs={'api_name': 'predict_with_gradcam'})
+        worker.start()
+        time.sleep(0.05)
+        with self.assertRaises(inference.InferenceUnavailable):
+            pool.predict(b'img', api_name='predict_with_gradcam')
+        worker.join()
+        self.assertEqual(pool.stats['built'], 1)
+
+    def test_classify_falls_back_to_gradcam_when_the_space_has_no_plain_endpoint(self):
+        built = install_fake_pool(self, endpoints=('predict_with_gradcam',))
+        inference.get_pool().warm_up()
+        self.assertFalse(inference.get_pool().has_endpoint(inference.GRADIO_CLASSIFY_API))
+        self.assertEqual(inference.GradioBackend().classify(b'img'),
+                         (FAKE_OUTPUT['result'], FAKE_OUTPUT['heatmap_base64']))
+        self.assertEqual(built[0].calls, ['predict_with_gradcam'])
+
+    def test_stats_count_every_concurrent_prediction(self):
+        pool = inference.GradioClientPool(size=8, client_factory=FakeGradioClient)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lambda _: pool.predict(b'img', api_name='predict_with_gradcam'), range(400)))
+        self.assertEqual(pool.stats['predictions'], 400)
+        self.assertLessEqual(pool.stats['built'], 8)
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+@mock.patch.object(jobs, 'PREDICTION_EAGER', True)
+class UploadViewTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='alice', password='pw')
+        self.profile = Profile.objects.create(user=self.user)
+        self.client.force_login(self.user)
+        self.built = install_fake_pool(self)
+        prediction_cache.get_cache().clear()
+
+    def test_get_does_not_build_a_client(self):
+        self.assertEqual(self.client.get('/upload/').status_code, 405)
+        self.assertEqual(self.built, [])
+
+    def test_uploads_share_one_client(self):
+        for i, url in enumerate(('/upload/', '/upload/file/')):
+            image = SimpleUploadedFile('skin.jpg', jpeg_bytes(seed=i), content_type='image/jpeg')
+            response = self.client.post(url, {'image': image})
+            self.assertEqual(response.status_code, 302)
+        self.assertEqual(len(self.built), 1)
+        self.assertEqual(Dermal_image.objects.filter(user=self.profile).count(), 2)
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+@mock.patch.object(jobs, 'PREDICTION_RETRY_BACKOFF', 0)
+class PredictionJobTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='bob', password='pw')
+        self.profile = Profile.objects.create(user=self.user)
+        self.client.force_login(self.user)
+        prediction_cache.get_cache().clear()
+
+    def make_image(self, **kwargs):
+        image = SimpleUploadedFile('skin.jpg', b'\xff\xd8fake-jpeg', content_type='image/jpeg')
+        return Dermal_image.objects.create(image=image, user=self.profile, **kwargs)
+
+    def test_upload_returns_before_prediction_runs(self):
+        submitted = []
+        fake_queue = jobs.PredictionQueue(handler=submitted.append, workers=1, maxsize=5)
+        with mock.patch.object(jobs, '_queue', fake_queue):
+            image = SimpleUploadedFile('skin.jpg', jpeg_bytes(), content_type='image/jpeg')
+            response = self.client.post('/upload/file/', {'image': image})
+            fake_queue.join()
+        skin_img = Dermal_image.objects.get(user=self.profile)
+        self.assertRedirects(response, f'/result/{skin_img.id}/', fetch_redirect_response=False)
+        self.assertEqual(skin_img.status, Dermal_image.Status.PENDING)
+        self.assertEqual(submitted, [skin_img.id])
+
+    def test_full_queue_rejects_upload(self):
+        release = threading.Event()
+        fake_queue = jobs.PredictionQueue(handler=lambda image_id: release.wait(), workers=1, maxsize=1)
+        self.addCleanup(release.set)
+        fake_queue.submit(-1)
+        time.sleep(0.05)
+        fake_queue.submit(-2)
+        with mock.patch.object(jobs, '_queue', fake_queue):
+            image = SimpleUploadedFile('skin.jpg', jpeg_bytes(), content_type='image/jpeg')
+            response = self.client.post('/upload/file/', {'image': image})
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(Dermal_image.objects.exists())
+
+    def test_job_retries_then_succeeds(self):
+        install_fake_pool(self)
+        flaky = [ValueError('space restarting')]
+        original_classify = inference.classify
+
+        def classify(img_bytes, timeout=None):
+            if flaky:
+                raise flaky.pop()
+            return original_classify(img_bytes, timeout=timeout)
+
+        skin_img = self.make_image()
+        with mock.patch.object(inference, 'classify', classify):
+            jobs.run_prediction(skin_img.id)
+        skin_img.refresh_from_db()
+        self.assertEqual(skin_img.status, Dermal_image.Status.DONE)
+        self.assertEqual(skin_img.attempts, 2)
+        self.assertEqual(skin_img.result, FAKE_OUTPUT['result'])
+
+    @mock.patch.object(jobs, 'PREDICTION_TIMEOUT', 0.05)
+    @mock.patch.object(jobs, 'PREDICTION_MAX_RETRIES', 1)
+    def test_job_times_out_and_fails(self):
+        install_fake_pool(self, delay=0.3)
+        skin_img = self.make_image()
+        jobs.run_prediction(skin_img.id)
+        skin_img.refresh_from_db()
+        self.assertEqual(skin_img.status, Dermal_image.Status.FAILED)
+        self.assertEqual(skin_img.attempts, 2)
+        self.assertIn('timed out', skin_img.error)
+
+    def test_job_is_not_run_twice(self):
+        install_fake_pool(self)
+        skin_img = self.make_image(status=Dermal_image.Status.DONE)
+        with mock.patch.object(inference, 'classify') as classify:
+            jobs.run_prediction(skin_img.id)
+        classify.assert_not_called()
+
+    def test_status_endpoint_requeues_lost_job(self):
+        submitted = []
+        fake_queue = jobs.PredictionQueue(handler=submitted.append, workers=1, maxsize=5)
+        skin_img = self.make_image()
+        with mock.patch.object(jobs, '_queue', fake_queue):
+            data = self.client.get(f'/result/{skin_img.id}/status/').json()
+            fake_queue.join()
+        self.assertEqual(data['status'], 'pending')
+        self.assertFalse(data['ready'])
+        self.assertEqual(submitted, [skin_img.id])
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+@mock.patch.object(jobs, 'PREDICTION_EAGER', True)
+class PredictionCacheTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='carol', password='pw')
+        self.profile = Profile.objects.create(user=self.user)
+        self.client.force_login(self.user)
+        self.built = install_fake_pool(self)
+        prediction_cache.get_cache().clear()
+
+    def test_repeat_upload_is_served_from_cache(self):
+        image_bytes = jpeg_bytes()
+        self.client.post('/upload/file/', {'image': SimpleUploadedFile('a.jpg', image_bytes)})
+        # Same bytes again, this time as a base64 camera capture
+        data_url = 'data:image/jpeg;base64,' + base64.b64encode(image_bytes).decode()
+        response = self.client.post('/upload/', {'image': data_url})
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.built[0].calls, [inference.GRADIO_CLASSIFY_API])
+        second = Dermal_image.objects.latest('id')
+        self.assertEqual(second.status, Dermal_image.Status.DONE)
+        self.assertEqual(second.result, FAKE_OUTPUT['result'])
+        stats = prediction_cache.get_cache().stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    def test_entries_survive_a_new_process(self):
+        prediction_cache.store('a' * 64, FAKE_OUTPUT['result'], 'heat')
+        fresh = prediction_cache.PredictionResultCache()
+        self.assertEqual(fresh.get('a' * 64), (FAKE_OUTPUT['result'], 'heat'))
+        self.assertEqual(PredictionCache.objects.get().hits, 1)
+
+    def test_counters_keep_every_concurrent_lookup(self):
+        cache = prediction_cache.PredictionResultCache()
+        with mock.patch.object(cache, '_from_memory', return_value=None), \
+                mock.patch.object(PredictionCache.objects, 'filter') as rows:
+            rows.return_value.values_list.return_value.first.return_value = None
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                list(executor.map(cache.get, ['b' * 64] * 400))
+        self.assertEqual(cache.misses, 400)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = prediction_cache.PredictionResultCache(max_entries=2, memory_entries=0)
+        cache.set('a', [], None)
+        cache.set('b', [], None)
+        cache.get('a')
+        cache.set('c', [], None)
+        self.assertEqual(set(PredictionCache.objects.values_list('digest', flat=True)), {'a', 'c'})
+
+    def test_expired_entries_are_ignored(self):
+        cache = prediction_cache.PredictionResultCache(ttl=60, memory_entries=0)
+        cache.set('a', [], None)
+        PredictionCache.objects.update(created_at=timezone.now() - timedelta(seconds=120))
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.misses, 1)
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+@mock.patch.object(jobs, 'PREDICTION_EAGER', True)
+class LazyHeatmapTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='erin', password='pw')
+        self.profile = Profile.objects.create(user=self.user)
+        self.client.force_login(self.user)
+        self.built = install_fake_pool(self)
+        prediction_cache.get_cache().clear()
+
+    def upload(self, data):
+        self.client.post('/upload/file/', {'image': SimpleUploadedFile('a.jpg', data)})
+        return Dermal_image.objects.latest('id')
+
+    def test_upload_only_classifies_and_heatmap_is_computed_once(self):
+        skin_img = self.upload(jpeg_bytes())
+        self.assertEqual(self.built[0].calls, [inference.GRADIO_CLASSIFY_API])
+        self.assertFalse(skin_img.heatmap)
+        self.assertContains(self.client.get(f'/result/{skin_img.id}/'), 'data-heatmap-url=')
+
+        data = self.client.get(f'/result/{skin_img.id}/heatmap/').json()
+        skin_img.refresh_from_db()
+        self.assertEqual(data['url'], skin_img.heatmap_url)
+        with default_storage.open(skin_img.heatmap.name, 'rb') as fh:
+            self.assertEqual(fh.read(), b'heatmap')
+        self.client.get(f'/result/{skin_img.id}/heatmap/')
+        self.assertEqual(self.built[0].calls, [inference.GRADIO_CLASSIFY_API, 'predict_with_gradcam'])
+
+        # A repeat upload of the photo gets the stored heatmap with the cached result
+        again = self.upload(jpeg_bytes())
+        self.assertEqual(again.heatmap.name, skin_img.heatmap.name)
+        self.assertEqual(len(self.built[0].calls), 2)
+
+    def test_gradcam_fallback_keeps_the_heatmap_of_the_upload(self):
+        built = install_fake_pool(self, endpoints=('predict_with_gradcam',))
+        inference.get_pool().warm_up()
+        skin_img = self.upload(jpeg_bytes())
+        self.assertEqual(skin_img.status, Dermal_image.Status.DONE)
+        self.assertTrue(skin_img.heatmap)
+        self.assertEqual(prediction_cache.lookup(skin_img.digest, record=False)[1], skin_img.heatmap.name)
+
+        data = self.client.get(f'/result/{skin_img.id}/heatmap/').json()
+        self.assertEqual(data['url'], skin_img.heatmap_url)
+        self.assertEqual(built[0].calls, ['predict_with_gradcam'])
+
+    def test_heatmap_waits_for_the_classification(self):
+        skin_img = Dermal_image.objects.create(
+            image=SimpleUploadedFile('skin.jpg', jpeg_bytes()), user=self.profile)
+        self.assertEqual(self.client.get(f'/result/{skin_img.id}/heatmap/').status_code, 409)
+
+    def test_backend_errors_and_missing_support_are_reported(self):
+        skin_img = self.upload(jpeg_bytes())
+        with mock.patch.object(inference, 'explain', side_effect=TimeoutError('slow')), \
+                self.assertLogs('Dermal.views', 'WARNING'):
+            self.assertEqual(self.client.get(f'/result/{skin_img.id}/heatmap/').status_code, 503)
+        with mock.patch.object(inference, 'explain', return_value=None), \
+                self.assertLogs('Dermal.views', 'WARNING'):
+            self.assertEqual(self.client.get(f'/result/{skin_img.id}/heatmap/').status_code, 503)
+        # A backend that cannot explain is answered at once, without a job
+        with mock.patch.object(inference.GradioBackend, 'can_explain', False), \
+                mock.patch.object(heatmaps, 'run_heatmap') as run_heatmap:
+            self.assertEqual(self.client.get(f'/result/{skin_img.id}/heatmap/').status_code, 404)
+            self.assertEqual(self.client.get(f'/result/{skin_img.id}/heatmap/').status_code, 404)
+        run_heatmap.assert_not_called()
+        skin_img.refresh_from_db()
+        self.assertFalse(skin_img.heatmap)
+
+    def test_heatmap_is_computed_off_the_request_thread(self):
+        skin_img = self.upload(jpeg_bytes())
+        submitted, started, release = [], threading.Event(), threading.Event()
+
+        def handler(image_id):
+            submitted.append(image_id)
+            started.set()
+            release.wait(5)
+
+        fake_queue = jobs.PredictionQueue(handler=handler, workers=1, maxsize=1, name='heatmap')
+        self.addCleanup(release.set)
+        other = self.upload(jpeg_bytes(seed=1))
+        with mock.patch.object(jobs, 'PREDICTION_EAGER', False), mock.patch.object(heatmaps, '_queue', fake_queue):
+            response = self.client.get(f'/result/{skin_img.id}/heatmap/')
+            self.assertEqual((response.status_code, response.json()), (202, {'pending': True}))
+            self.assertNotIn('predict_with_gradcam', self.built[0].calls)
+            started.wait(5)
+            fake_queue.submit(-1)  # fills the queue while the first job runs
+            self.assertEqual(self.client.get(f'/result/{other.id}/heatmap/').status_code, 503)
+            release.set()
+            fake_queue.join()
+
+            heatmaps.run_heatmap(skin_img.id)  # what the heatmap worker does
+            data = self.client.get(f'/result/{skin_img.id}/heatmap/').json()
+        skin_img.refresh_from_db()
+        self.assertEqual(data['url'], skin_img.heatmap_url)
+        self.assertEqual(submitted, [skin_img.id, -1])
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class HeatmapFileTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='dave', password='pw')
+        self.profile = Profile.objects.create(user=self.user)
+        self.client.force_login(self.user)
+
+    def test_heatmap_is_stored_once_per_content(self):
+        encoded = base64.b64encode(b'\x89PNG fake heatmap').decode()
+        name = heatmaps.save_heatmap_base64(encoded)
+        self.assertTrue(name.startswith('heatmaps/'))
+        self.assertEqual(heatmaps.save_heatmap_base64('data:image/png;base64,' + encoded), name)
+        with default_storage.open(name, 'rb') as fh:
+            self.assertEqual(fh.read(), b'\x89PNG fake heatmap')
+
+    def test_heatmap_is_served_with_long_lived_cache_headers(self):
+        name = heatmaps.save_heatmap_bytes(b'\x89PNG served')
+        skin_img = Dermal_image.objects.create(
+            image=SimpleUploadedFile('skin.jpg', b'\xff\xd8'), user=self.profile,
+            status=Dermal_image.Status.DONE, result=[], heatmap=name)
+
+        page = self.client.get(f'/result/{skin_img.id}/')
+        self.assertContains(page, skin_img.heatmap_url)
+        self.assertNotContains(page, 'data:image/png;base64')
+
+        response = self.client.get(skin_img.heatmap_url)
+        self.assertEqual(b''.join(response.streaming_content), b'\x89PNG served')
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertIn('immutable', response['Cache-Control'])
+
+        revalidated = self.client.get(skin_img.heatmap_url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(revalidated.status_code, 304)
+
+    def test_other_users_cannot_fetch_heatmap(self):
+        other = Profile.objects.create(user=User.objects.create_user(username='eve', password='pw'))
+        skin_img = Dermal_image.objects.create(
+            image=SimpleUploadedFile('skin.jpg', b'\xff\xd8'), user=other,
+            heatmap=heatmaps.save_heatmap_bytes(b'\x89PNG private'))
+        self.assertEqual(self.client.get(f'/result/{skin_img.id}/heatmap.png').status_code, 404)
+
+
+class CommunityFeedQueryTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='frank', password='pw')
+        self.profile = Profile.objects.create(user=self.user)
+        self.client.force_login(self.user)
+        self.voters = [
+            Profile.objects.create(user=User.objects.create_user(username=f'voter{i}', password='pw'))
+            for i in range(3)
+        ]
+
+    def add_posts(self, count, comments_per_post=3):
+        for i in range(count):
+            post = Post.objects.create(author=self.voters[i % 3], title=f'p{i}', content=f'<p>post {i}</p>')
+            votes.toggle(post, self.voters[0], votes.UP)
+            votes.toggle(post, self.voters[1], votes.UP)
+            votes.toggle(post, self.voters[2], votes.DOWN)
+            for j in range(comments_per_post):
+                comment = Comment.objects.create(post=post, author=self.voters[j % 3], content=f'c{j}')
+                votes.toggle(comment, self.voters[0], votes.UP)
+
+    def render_feed(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/community/')
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_query_count_does_not_grow_with_feed_size(self):
+        self.add_posts(2)
+        _, small = self.render_feed()
+        self.add_posts(20, comments_per_post=5)
+        _, large = self.render_feed()
+        self.assertEqual(small, large)
+        self.assertLessEqual(large, 5)
+
+    def test_counts_are_rendered(self):
+        self.add_posts(1, comments_per_post=2)
+        response, _ = self.render_feed()
+        post = response.context['posts'][0]
+        self.assertEqual((post.upvote_count, post.downvote_count, post.comment_total), (2, 1, 2))
+        for comment in Comment.objects.all():
+            self.assertNotContains(response, f'data-comment-id="{comment.id}"')
+
+
+class PostCommentsEndpointTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='ivan', password='pw')
+        self.profile = Profile.objects.create(user=self.user)
+        self.client.force_login(self.user)
+        self.post = Post.objects.create(author=self.profile, title='t', content='c')
+        self.comments = [
+            Comment.objects.create(post=self.post, author=self.profile, content=f'c{i}') for i in range(5)
+        ]
+        votes.toggle(self.comments[-1], self.profile, votes.UP)
+
+    def fetch(self, **params):
+        response = self.client.get(f'/post/{self.post.id}/comments/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_comments_are_paged_newest_first(self):
+        first = self.fetch(limit=3)
+        second = self.fetch(limit=3, cursor=first['next_cursor'])
+        ids = [c['id'] for c in first['comments'] + second['comments']]
+        self.assertEqual(ids, [c.id for c in reversed(self.comments)])
+        self.assertIsNone(second['next_cursor'])
+        self.assertEqual(first['comments'][0]['author'], 'ivan')
+        self.assertEqual(first['comments'][0]['upvotes'], 1)
+
+    def test_query_count_does_not_grow_with_comments(self):
+        with CaptureQueriesContext(connection) as few:
+            self.fetch()
+        for i in range(15):
+            Comment.objects.create(post=self.post, author=self.profile, content=f'more{i}')
+        with CaptureQueriesContext(connection) as many:
+            self.fetch()
+        self.assertEqual(len(few), len(many))
+
+    def test_missing_post_and_bad_cursor(self):
+        self.assertEqual(self.client.get('/post/999/comments/').status_code, 404)
+        response = self.client.get(f'/post/{self.post.id}/comments/', {'cursor': '!!'})
+        self.assertEqual(response.status_code, 400)
+
+
+class VoteCounterTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='gina', password='pw')
+        self.profile = Profile.objects.create(user=self.user)
+        self.client.force_login(self.user)
+        self.post = Post.objects.create(author=self.profile, title='t', content='c')
+        self.comment = Comment.objects.create(post=self.post, author=self.profile, content='c')
+
+    def vote(self, url, action):
+        response = self.client.post(url, json.dumps({'action': action}), content_type='application/json')
+        return response.json()
+
+    def test_toggle_switch_and_remove(self):
+        url = f'/post/{self.post.id}/vote/'
+        self.assertEqual(self.vote(url, 'up'), {'upvotes': 1, 'downvotes': 0})
+        self.assertEqual(self.vote(url, 'down'), {'upvotes': 0, 'downvotes': 1})
+        self.assertEqual(self.vote(url, 'down'), {'upvotes': 0, 'downvotes': 0})
+        self.assertFalse(self.post.downvotes.exists())
+
+    def test_comment_votes_use_the_same_counters(self):
+        url = f'/comment/{self.comment.id}/vote/'
+        self.assertEqual(self.vote(url, 'down'), {'upvotes': 0, 'downvotes': 1})
+        self.assertEqual(self.vote(url, 'up'), {'upvotes': 1, 'downvotes': 0})
+        self.comment.refresh_from_db()
+        self.assertEqual((self.comment.upvote_count, self.comment.downvote_count), (1, 0))
+
+    def test_vote_cost_does_not_depend_on_popularity(self):
+        url = f'/post/{self.post.id}/vote/'
+        with CaptureQueriesContext(connection) as quiet:
+            self.vote(url, 'up')
+        self.vote(url, 'up')
+        fans = [Profile.objects.create(user=User.objects.create_user(username=f'fan{i}')) for i in range(30)]
+        for fan in fans:
+            votes.toggle(self.post, fan, votes.UP)
+        with CaptureQueriesContext(connection) as popular:
+            self.assertEqual(self.vote(url, 'up'), {'upvotes': 31, 'downvotes': 0})
+        self.assertEqual(len(quiet), len(popular))
+
+    def test_invalid_action_is_rejected(self):
+        response = self.client.post(f'/post/{self.post.id}/vote/', json.dumps({'action': 'sideways'}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_reconcile_command_repairs_drift(self):
+        self.post.upvotes.add(self.profile)
+        Comment.objects.filter(id=self.comment.id).update(downvote_count=7)
+        out = io.StringIO()
+        call_command('reconcile_vote_counts', stdout=out)
+        self.post.refresh_from_db()
+        self.comment.refresh_from_db()
+        self.assertEqual(self.post.upvote_count, 1)
+        self.assertEqual(self.comment.downvote_count, 0)
+        self.assertIn('Post: 1 row(s) corrected', out.getvalue())
+        self.assertIn('Comment: 1 row(s) corrected', out.getvalue())
+
+
+class FeedPaginationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='hana', password='pw')
+        self.profile = Profile.objects.create(user=self.user)
+        self.client.force_login(self.user)
+        # Same timestamp for several posts exercises the id tie-breaker
+        same_moment = timezone.now()
+        for i in range(7):
+            post = Post.objects.create(author=self.profile, title=f'p{i}', content=f'<p>{i}</p>')
+            if i < 4:
+                Post.objects.filter(id=post.id).update(created_at=same_moment)
+
+    def fetch(self, cursor=None, limit=3):
+        params = {'limit': limit}
+        if cursor:
+            params['cursor'] = cursor
+        response = self.client.get('/api/feed/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_pages_cover_every_post_once_in_order(self):
+        seen, cursor = [], None
+        while True:
+            page = self.fetch(cursor)
+            seen += [p['id'] for p in page['posts']]
+            cursor = page['next_cursor']
+            if not cursor:
+                break
+        expected = list(Post.objects.order_by('-created_at', '-id').values_list('id', flat=True))
+        self.assertEqual(seen, expected)
+
+    def test_invalid_cursor_is_rejected(self):
+        response = self.client.get('/api/feed/', {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_deep_pages_cost_the_same_queries(self):
+        first = self.fetch()
+        with CaptureQueriesContext(connection) as shallow:
+            second = self.fetch(first['next_cursor'])
+        with CaptureQueriesContext(connection) as deep:
+            self.fetch(second['next_cursor'])
+        self.assertEqual(len(shallow), len(deep))
+
+    def test_community_page_renders_first_page_with_cursor(self):
+        for i in range(20):
+            Post.objects.create(author=self.profile, title=f'extra{i}', content='x')
+        response = self.client.get('/community/')
+        self.assertEqual(len(response.context['posts']), pagination.DEFAULT_PAGE_SIZE)
+        self.assertContains(response, f'data-next-cursor="{response.context["next_cursor"]}"')
+
+
+class SanitizeTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='jin', password='pw')
+        self.profile = Profile.objects.create(user=self.user)
+        self.client.force_login(self.user)
+
+    def test_profiles(self):
+        dirty = '<p onclick="x()">{% load x %}hi https://example.com<script>1</script></p><img src="data:image/png;base64,AA"><h1>t</h1>'
+        post = sanitize.clean_post(dirty)
+        self.assertEqual(post, '<p>hi <a href="https://example.com" rel="nofollow">https://example.com</a>'
+                               '&lt;script&gt;1&lt;/script&gt;</p><img src="data:image/png;base64,AA"><h1>t</h1>')
+        comment = sanitize.clean_comment(dirty)
+        self.assertNotIn('<img', comment)
+        self.assertNotIn('<h1>', comment)
+        self.assertEqual(sanitize.render_chat_reply('**đậm** {{ x }}'), '<p><strong>đậm</strong> </p>\n')
+
+    def test_each_thread_gets_its_own_cleaner(self):
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            other = pool.submit(sanitize.get_cleaner, 'post').result()
+        self.assertIs(sanitize.get_cleaner('post'), sanitize.get_cleaner('post'))
+        self.assertIsNot(sanitize.get_cleaner('post'), other)
+
+    def test_content_is_sanitized_on_write_and_rendered_as_stored(self):
+        self.client.post('/create-post/', {'content': '<p>{{ secret }}xin chào<script>x</script></p>'})
+        post = Post.objects.get()
+        self.assertEqual(post.content, '<p>xin chào&lt;script&gt;x&lt;/script&gt;</p>')
+        with mock.patch.object(sanitize, 'clean_html') as clean:
+            response = self.client.get('/community/')
+        clean.assert_not_called()
+        self.assertContains(response, post.content)
+
+    def test_benchmark_command_runs(self):
+        out = io.StringIO()
+        call_command('benchmark_sanitize', blocks=2, iterations=1, stdout=out)
+        self.assertIn('shared cleaner', out.getvalue())
+
+
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'chatbot': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'chatbot-tests'},
+})
+class ChatbotReplyCacheTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='kim', password='pw')
+        self.client.force_login(self.user)
+        chat_cache._cache().clear()
+        env = mock.patch.dict('os.environ', {'GEMINI_API_URL': 'http://gemini.test', 'GEMINI_API_KEY': 'k',
+                                             'GEMINI_MODEL': 'model-a'})
+        env.start()
+        self.addCleanup(env.stop)
+        gemini = mock.patch.object(views, 'call_gemini', return_value='**Chàm** là bệnh viêm da.')
+        self.call_gemini = gemini.start()
+        self.addCleanup(gemini.stop)
+
+    def ask(self, message):
+        return self.client.post('/chatbot/api/', json.dumps({'message': message}), content_type='application/json')
+
+    def test_repeated_question_is_served_from_cache(self):
+        first = self.ask('Bệnh chàm là gì?')
+        second = self.ask('  bệnh   CHÀM là gì ')
+        self.assertEqual(first['X-Cache'], 'MISS')
+        self.assertEqual(second['X-Cache'], 'HIT')
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(second.json()['reply_html'], '<p><strong>Chàm</strong> là bệnh viêm da.</p>\n')
+        self.assertEqual(self.call_gemini.call_count, 1)
+
+    def test_cache_is_per_model(self):
+        self.ask('bệnh chàm là gì')
+        with mock.patch.dict('os.environ', {'GEMINI_MODEL': 'model-b'}):
+            self.assertEqual(self.ask('bệnh chàm là gì')['X-Cache'], 'MISS')
+        self.assertEqual(self.call_gemini.call_count, 2)
+
+    def test_fallback_and_dev_replies_are_not_cached(self):
+        self.call_gemini.return_value = gemini.GEMINI_FALLBACK_REPLY
+        self.assertEqual(self.ask('xin chào')['X-Cache'], 'BYPASS')
+        self.assertEqual(self.ask('xin chào')['X-Cache'], 'BYPASS')
+        with mock.patch.dict('os.environ', {'GEMINI_API_URL': ''}):
+            self.assertEqual(self.ask('chào bạn')['X-Cache'], 'BYPASS')
+        self.assertIsNone(chat_cache.lookup('chào bạn', 'model-a'))
+
+
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'chatbot': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'chatbot-stream-tests'},
+})
+class StreamingChatbotTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='lan', password='pw')
+        self.client.force_login(self.user)
+        chat_cache._cache().clear()
+        self.backend = gemini.FakeStreamingBackend(['**Chàm** ', 'là bệnh ', 'viêm da.'])
+        for name, value in (('CHATBOT_STREAM_BACKEND', 'fake'), ('fake_backend', self.backend)):
+            patcher = mock.patch.object(gemini, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def ask(self, message):
+        return self.client.post('/chatbot/stream/', json.dumps({'message': message}),
+                                content_type='application/json')
+
+    def events(self, response):
+        body = b''.join(response.streaming_content).decode('utf-8')
+        events = []
+        for block in body.strip().split('\n\n'):
+            event, data = block.split('\n')
+            events.append((event[len('event: '):], json.loads(data[len('data: '):])))
+        return events
+
+    def test_reply_is_streamed_then_completed_with_sanitized_html(self):
+        response = self.ask('bệnh chàm là gì')
+        self.assertEqual(response['Content-Type'], 'text/event-stream; charset=utf-8')
+        events = self.events(response)
+        self.assertEqual([data['text'] for event, data in events if event == 'delta'],
+                         ['**Chàm** ', 'là bệnh ', 'viêm da.'])
+        self.assertEqual(events[-1], ('done', {
+            'reply': '**Chàm** là bệnh viêm da.',
+            'reply_html': '<p><strong>Chàm</strong> là bệnh viêm da.</p>\n',
+        }))
+
+    def test_first_chunk_is_sent_before_generation_finishes(self):
+        produced = []
+
+        def slow_backend(prompt):
+            for chunk in ('một ', 'hai ', 'ba'):
+                produced.append(chunk)
+                yield chunk
+
+        with mock.patch.object(gemini, 'fake_backend', slow_backend):
+            first = next(iter(self.ask('đếm').streaming_content))
+        self.assertIn('một', first.decode('utf-8'))
+        self.assertEqual(produced, ['một '])
+
+    def test_completed_stream_fills_the_reply_cache(self):
+        with mock.patch.dict('os.environ', {'GEMINI_API_URL': 'http://gemini.test', 'GEMINI_API_KEY': 'k'}):
+            first = self.ask('bệnh chàm là gì')
+            self.assertEqual(first['X-Cache'], 'MISS')
+            self.events(first)
+            second = self.ask('Bệnh chàm là gì?')
+        self.assertEqual(second['X-Cache'], 'HIT')
+        self.assertEqual(self.events(second)[-1][1]['reply'], '**Chàm** là bệnh viêm da.')
+
+    def test_interrupted_stream_is_reported_and_not_cached(self):
+        def broken_stream(*args):
+            yield '**Chàm** '
+            raise ConnectionError('reset')
+
+        patches = [
+            mock.patch.dict('os.environ', {'GEMINI_API_URL': 'http://gemini.test', 'GEMINI_API_KEY': 'k'}),
+            mock.patch.object(gemini, 'CHATBOT_STREAM_BACKEND', ''),
+            mock.patch.object(gemini, '_sdk_available', return_value=False),
+            mock.patch.object(gemini, '_stream_http', broken_stream),
+            mock.patch.object(gemini, 'breaker', gemini.CircuitBreaker()),
+            mock.patch.dict(gemini.stats, {key: 0 for key in gemini.stats}),
+        ]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        with self.assertLogs('Dermal.gemini', 'WARNING'):
+            events = self.events(self.ask('bệnh chàm là gì'))
+        self.assertEqual(events[0], ('delta', {'text': '**Chàm** '}))
+        self.assertEqual(events[-1][0], 'error')
+        self.assertEqual(events[-1][1]['reply'], '**Chàm** ')
+        self.assertIsNone(chat_cache.lookup('bệnh chàm là gì', gemini.gemini_model()))
+        self.assertEqual((gemini.stats['successes'], gemini.stats['failures']), (0, 1))
+
+    def test_ttfb_command_reports_both_endpoints(self):
+        out = io.StringIO()
+        call_command('chatbot_ttfb', chunks=3, delay=0.001, runs=1, stdout=out)
+        self.assertIn('streaming (chatbot/stream/) first byte', out.getvalue())
+
+
+class GeminiClientLayerTests(SimpleTestCase):
+    def setUp(self):
+        self.stub = StubGeminiServer()
+        self.addCleanup(self.stub.close)
+        gemini.reset_clients()
+        self.addCleanup(gemini.reset_clients)
+        self.breaker = gemini.CircuitBreaker(threshold=2, reset_timeout=60)
+        patches = [
+            mock.patch.dict('os.environ', {'GEMINI_API_URL': self.stub.url, 'GEMINI_API_KEY': 'k',
+                                           'GEMINI_MODEL': 'stub-model'}),
+            mock.patch.object(gemini, '_sdk_available', return_value=False),
+            mock.patch.object(gemini, 'GEMINI_RETRY_BACKOFF', 0),
+            mock.patch.object(gemini, 'GEMINI_READ_TIMEOUT', 0.3),
+            mock.patch.object(gemini, 'breaker', self.breaker),
+            mock.patch.dict(gemini.stats, {key: 0 for key in gemini.stats}),
+        ]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_connections_are_reused(self):
+        self.stub.script = [(200, {'text': 'một'}, 0), (200, {'reply': 'hai'}, 0)]
+        self.assertEqual(gemini.generate_reply('a'), 'một')
+        self.assertEqual(gemini.generate_reply('b'), 'hai')
+        self.assertEqual(len(set(self.stub.seen_ports)), 1)
+
+    def test_transient_errors_are_retried(self):
+        self.stub.script = [(503, {}, 0), (429, {}, 0), (200, {'text': 'xong'}, 0)]
+        self.assertEqual(gemini.generate_reply('a'), 'xong')
+        self.assertEqual((gemini.stats['retries'], gemini.stats['successes']), (2, 1))
+
+    def test_client_errors_and_timeouts_fall_back(self):
+        self.stub.script = [(400, {}, 0)]
+        with self.assertLogs('Dermal.gemini', 'WARNING'):
+            self.assertEqual(gemini.generate_reply('a'), gemini.GEMINI_FALLBACK_REPLY)
+        self.assertEqual(len(self.stub.seen_ports), 1)
+        self.stub.script = [(200, {'text': 'muộn'}, 0.6)] * 3
+        started = time.monotonic()
+        with self.assertLogs('Dermal.gemini', 'WARNING') as logs:
+            self.assertEqual(gemini.generate_reply('b'), gemini.GEMINI_FALLBACK_REPLY)
+        self.assertLess(time.monotonic() - started, 2.5)
+        self.assertIn('ReadTimeout', logs.output[0])
+
+    def test_transports_share_one_attempt_budget(self):
+        sdk_calls = []
+
+        def sdk_timeout(*args):
+            sdk_calls.append(args)
+            raise TimeoutError('sdk')
+
+        self.stub.script = [(503, {}, 0)] * 6
+        with mock.patch.object(gemini, '_sdk_available', return_value=True), \
+                mock.patch.object(gemini, '_generate_sdk', sdk_timeout), \
+                self.assertLogs('Dermal.gemini', 'WARNING'):
+            self.assertEqual(gemini.generate_reply('a'), gemini.GEMINI_FALLBACK_REPLY)
+        self.assertEqual(len(sdk_calls) + len(self.stub.seen_ports), gemini.GEMINI_MAX_RETRIES + 1)
+
+    def test_retries_stop_at_the_total_deadline(self):
+        self.stub.script = [(200, {'text': 'muộn'}, 0.6)] * 3
+        started = time.monotonic()
+        with mock.patch.object(gemini, 'GEMINI_TOTAL_TIMEOUT', 0.5), self.assertLogs('Dermal.gemini', 'WARNING'):
+            self.assertEqual(gemini.generate_reply('a'), gemini.GEMINI_FALLBACK_REPLY)
+        self.assertLess(time.monotonic() - started, 0.9)
+        self.assertEqual(len(self.stub.seen_ports), 2)
+
+    def test_sdk_client_has_the_configured_timeout(self):
+        client = gemini.get_sdk_client('k')
+        expected = int((gemini.GEMINI_CONNECT_TIMEOUT + gemini.GEMINI_READ_TIMEOUT) * 1000)
+        self.assertEqual(client._api_client._http_options.timeout, expected)
+
+    def test_async_clients_are_closed_with_their_loop(self):
+        async def clients():
+            return gemini.get_async_client(), gemini.get_async_client()
+
+        first, again = asyncio.run(clients())
+        second, _ = asyncio.run(clients())
+        self.assertIs(first, again)
+        self.assertIsNot(first, second)
+        self.assertTrue(first.is_closed and second.is_closed)
+        self.assertEqual(len(gemini._loop_clients), 0)
+
+    def test_dead_event_loop_is_not_treated_as_an_outage(self):
+        async def closed_loop(*args):
+            raise RuntimeError('Event loop is closed')
+
+        with mock.patch.object(gemini, '_sdk_available', return_value=True), \
+                mock.patch.object(gemini, '_agenerate_sdk', closed_loop), \
+                self.assertRaisesMessage(RuntimeError, 'Event loop is closed'):
+            asyncio.run(gemini.agenerate_reply('a'))
+        self.assertEqual(self.stub.seen_ports, [])
+
+    def test_response_without_reply_text_is_a_failure(self):
+        self.stub.script = [(200, {'candidates': [{'content': {'parts': []}}]}, 0),
+                            (200, {'choices': [{'finish_reason': 'stop'}]}, 0)]
+        with self.assertLogs('Dermal.gemini', 'WARNING'):
+            self.assertEqual(gemini.generate_reply('a'), gemini.GEMINI_FALLBACK_REPLY)
+            self.assertEqual(gemini.generate_reply('b'), gemini.GEMINI_FALLBACK_REPLY)
+        self.assertEqual((gemini.stats['successes'], gemini.stats['failures']), (0, 2))
+
+    def test_breaker_fails_fast_then_recovers(self):
+        self.stub.script = [(500, {}, 0)] * 6
+        with self.assertLogs('Dermal.gemini', 'WARNING'):
+            gemini.generate_reply('a')
+            gemini.generate_reply('b')
+        self.assertEqual(self.breaker.state, gemini.CircuitBreaker.OPEN)
+        hits = len(self.stub.seen_ports)
+        self.assertEqual(gemini.generate_reply('c'), gemini.GEMINI_FALLBACK_REPLY)
+        self.assertEqual(len(self.stub.seen_ports), hits)
+        self.assertEqual(gemini.stats['short_circuited'], 1)
+
+        self.breaker.reset_timeout = 0
+        self.stub.script = [(200, {'text': 'khỏe lại'}, 0)]
+        self.assertEqual(gemini.generate_reply('d'), 'khỏe lại')
+        self.assertEqual(self.breaker.state, gemini.CircuitBreaker.CLOSED)
+
+    def assert_trial_released(self):
+        # Still half-open, and the next call is let through as a new trial
+        self.assertEqual(self.breaker.state, gemini.CircuitBreaker.HALF_OPEN)
+        self.assertTrue(self.breaker.allow())
+        self.breaker.release()
+
+    def test_abandoned_stream_is_neither_success_nor_failure(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.breaker.reset_timeout = 0
+
+        self.stub.script = [(200, {'text': 'dòng'}, 0)]
+        stream = gemini.stream_reply('a')
+        self.assertEqual(next(stream), 'dòng')
+        stream.close()  # the client disconnected
+        self.assert_trial_released()
+
+        async def read_first_chunk():
+            stream = gemini.astream_reply('b')
+            text = await stream.__anext__()
+            await stream.aclose()
+            return text
+
+        self.stub.script = [(200, {'text': 'dòng'}, 0)]
+        self.assertEqual(asyncio.run(read_first_chunk()), 'dòng')
+        self.assert_trial_released()
+        self.assertEqual((gemini.stats['successes'], gemini.stats['failures']), (0, 0))
+
+    def test_stream_uses_the_pooled_session(self):
+        self.stub.script = [(200, {'text': 'dòng'}, 0)]
+        self.assertEqual(list(gemini.stream_reply('a')), ['dòng'])
+        self.assertIs(gemini.get_session(), gemini.get_session())
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        self.stub = StubGeminiServer(delay=0.3, reply='**Chàm** là bệnh viêm da.')
+        self.addCleanup(self.stub.close)
+        self.user = User.objects.create_user(username='mai', password='pw')
+        self.profile = Profile.objects.create(user=self.user)
+        patches = [
+            mock.patch.dict('os.environ', {'GEMINI_API_URL': self.stub.url, 'GEMINI_API_KEY': 'k'}),
+            mock.patch.object(gemini, 'GEMINI_TRANSPORT', 'http'),
+            mock.patch.object(gemini, 'breaker', gemini.CircuitBreaker()),
+            mock.patch.object(chat_cache, 'CHATBOT_CACHE_ENABLED', False),
+        ]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def test_concurrent_chat_requests_share_one_event_loop(self):
+        await self.async_client.aforce_login(self.user)
+
+        async def ask(n):
+            return await self.async_client.post('/chatbot/api/', json.dumps({'message': f'câu {n}'}),
+                                                content_type='application/json')
+
+        started = time.monotonic()
+        responses = await asyncio.gather(*(ask(n) for n in range(10)))
+        elapsed = time.monotonic() - started
+        self.assertEqual({response.status_code for response in responses}, {200})
+        self.assertEqual(json.loads(responses[0].content)['reply'], '**Chàm** là bệnh viêm da.')
+        # Ten 0.3 s calls served one after another would take 3 s
+        self.assertLess(elapsed, 1.5)
+
+    async def test_predict_saves_explanation_and_redirects(self):
+        image = await Dermal_image.objects.acreate(
+            image=SimpleUploadedFile('skin.jpg', b'\xff\xd8fake-jpeg', content_type='image/jpeg'), user=self.profile)
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.post(f'/predict/{image.id}', {'age': '30', 'symptom': 'ngứa'})
+        self.assertRedirects(response, f'/result/{image.id}/', fetch_redirect_response=False)
+        await image.arefresh_from_db()
+        self.assertEqual(image.symptom, 'ngứa')
+        self.assertIn('<strong>Chàm</strong>', image.explain)
+
+    def test_wsgi_requests_use_the_sync_clients(self):
+        self.client.force_login(self.user)
+        with mock.patch.object(gemini, 'get_async_client', side_effect=AssertionError('async client under WSGI')):
+            response = self.client.post('/chatbot/api/', json.dumps({'message': 'câu hỏi'}),
+                                        content_type='application/json')
+        self.assertEqual(response.json()['reply'], '**Chàm** là bệnh viêm da.')
+
+    def test_loadtest_command_reports_both_profiles(self):
+        out = io.StringIO()
+        call_command('loadtest_chatbot', requests=4, delay=0.05, stdout=out)
+        self.assertIn('sync, 2 threads', out.getvalue())
+        self.assertIn('async view', out.getvalue())
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class ImagePreprocessingTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='linh', password='pw')
+        self.profile = Profile.objects.create(user=self.user)
+        self.client.force_login(self.user)
+        prediction_cache.get_cache().clear()
+        fake_queue = jobs.PredictionQueue(handler=lambda image_id: None, workers=1, maxsize=5)
+        patcher = mock.patch.object(jobs, '_queue', fake_queue)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def upload(self, data, name='skin.jpg'):
+        return self.client.post('/upload/file/', {'image': SimpleUploadedFile(name, data)})
+
+    def test_format_is_sniffed_from_header_bytes(self):
+        self.assertEqual(imaging.sniff_format(jpeg_bytes()), 'jpeg')
+        self.assertEqual(imaging.sniff_format(jpeg_bytes(fmt='PNG')), 'png')
+        self.assertEqual(imaging.sniff_format(jpeg_bytes(fmt='WEBP')), 'webp')
+        self.assertIsNone(imaging.sniff_format(b'GIF89a' + b'\0' * 20))
+
+    def test_non_images_are_rejected(self):
+        for data in (b'<?php echo 1;', b'\xff\xd8\xfftruncated'):
+            response = self.upload(data)
+            self.assertEqual(response.status_code, 400)
+        self.assertFalse(Dermal_image.objects.exists())
+
+    def test_upload_is_rotated_downscaled_and_reencoded(self):
+        # Orientation 6: stored sideways, displayed rotated by 90 degrees
+        response = self.upload(jpeg_bytes(size=(2000, 1000), orientation=6))
+        self.assertEqual(response.status_code, 302)
+        skin_img = Dermal_image.objects.get()
+        self.assertTrue(skin_img.image.name.endswith('.jpg'))
+        with skin_img.image.open('rb') as fh:
+            stored = Image.open(io.BytesIO(fh.read()))
+            self.assertEqual((stored.format, stored.size), ('JPEG', (384, 768)))
+            self.assertNotIn(0x0112, stored.getexif())
+        self.assertFalse(skin_img.original)
+
+    def test_transparent_png_is_flattened(self):
+        img = Image.new('RGBA', (40, 40), (0, 0, 0, 0))
+        out = io.BytesIO()
+        img.save(out, 'PNG')
+        processed = Image.open(io.BytesIO(imaging.preprocess(out.getvalue())))
+        self.assertEqual(processed.getpixel((5, 5)), (255, 255, 255))
+
+    @mock.patch.object(imaging, 'IMAGE_KEEP_ORIGINAL', True)
+    def test_original_is_kept_when_enabled(self):
+        data = jpeg_bytes(size=(1600, 1200))
+        self.upload(data, name='photo.jpeg')
+        skin_img = Dermal_image.objects.get()
+        with skin_img.original.open('rb') as fh:
+            self.assertEqual(fh.read(), data)
+        self.assertLess(skin_img.image.size, len(data))
+
+    def test_benchmark_command_reports_savings(self):
+        path = f'{MEDIA_ROOT}/bench.jpg'
+        with open(path, 'wb') as fh:
+            fh.write(jpeg_bytes(size=(1600, 1200)))
+        out = io.StringIO()
+        call_command('benchmark_preprocess', path, iterations=1, stdout=out)
+        self.assertIn('x smaller', out.getvalue())
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class ImageVariantTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='hoa', password='pw')
+        self.profile = Profile.objects.create(user=self.user)
+        self.client.force_login(self.user)
+        prediction_cache.get_cache().clear()
+        fake_queue = jobs.PredictionQueue(handler=lambda image_id: None, workers=1, maxsize=5)
+        patcher = mock.patch.object(jobs, '_queue', fake_queue)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def stored_size(self, field_file):
+        with field_file.open('rb') as fh:
+            return Image.open(io.BytesIO(fh.read())).size
+
+    def test_upload_renders_variants_used_by_history(self):
+        self.client.post('/upload/file/', {'image': SimpleUploadedFile('skin.jpg', jpeg_bytes(size=(1600, 1200)))})
+        skin_img = Dermal_image.objects.get()
+        self.assertEqual(self.stored_size(skin_img.image_thumb), (200, 150))
+        self.assertEqual(self.stored_size(skin_img.image_medium), (600, 450))
+
+        html = self.client.get('/profile/').content.decode()
+        self.assertIn(f'src="{skin_img.image_thumb.url}"', html)
+        self.assertIn(f'{skin_img.image_medium.url} 600w', html)
+        self.assertIn('loading="lazy"', html)
+
+    def test_srcset_uses_stored_widths(self):
+        self.client.post('/upload/file/', {'image': SimpleUploadedFile('tall.jpg', jpeg_bytes(size=(1200, 1600)))})
+        portrait = Dermal_image.objects.get()
+        self.assertEqual(portrait.image_srcset, ', '.join([
+            f'{portrait.image_thumb.url} 150w', f'{portrait.image_medium.url} 450w', f'{portrait.image.url} 576w']))
+
+        self.client.post('/upload/file/', {'image': SimpleUploadedFile('small.jpg', jpeg_bytes(seed=1))})
+        small = Dermal_image.objects.exclude(pk=portrait.pk).get()
+        # Nothing is upscaled, so one 64 px candidate stands for all three files
+        self.assertEqual(small.image_srcset, f'{small.image_thumb.url} 64w')
+
+    def test_profile_page_opens_no_image_files(self):
+        for seed in range(3):
+            self.client.post('/upload/file/', {'image': SimpleUploadedFile('skin.jpg', jpeg_bytes(seed=seed))})
+        with mock.patch.object(FileSystemStorage, '_open', side_effect=AssertionError('file opened')):
+            html = self.client.get('/profile/').content.decode()
+        self.assertEqual(html.count(' 64w"'), 3)
+
+    def test_backfill_fills_rows_without_variants(self):
+        skin_img = Dermal_image.objects.create(
+            image=SimpleUploadedFile('old.jpg', jpeg_bytes(size=(900, 900))), user=self.profile)
+        broken = Dermal_image.objects.create(
+            image=SimpleUploadedFile('broken.jpg', b'\xff\xd8'), user=self.profile)
+        self.profile.avatar = SimpleUploadedFile('me.png', jpeg_bytes(size=(400, 400), fmt='PNG'))
+        self.profile.save()
+        self.assertEqual(skin_img.thumbnail_url, skin_img.image.url)
+
+        out, err = io.StringIO(), io.StringIO()
+        call_command('backfill_image_variants', stdout=out, stderr=err)
+        self.assertIn('Dermal_image: 1 row(s) backfilled, 1 skipped', out.getvalue())
+        self.assertIn(f'Dermal_image {broken.pk}', err.getvalue())
+        skin_img.refresh_from_db()
+        self.profile.refresh_from_db()
+        self.assertEqual(self.stored_size(skin_img.image_thumb), (200, 200))
+        self.assertEqual(skin_img.image_widths, {'image': 900, 'image_thumb': 200, 'image_medium': 600})
+        self.assertEqual(self.profile.avatar_thumb_url, self.profile.avatar_thumb.url)
+        self.assertEqual(self.profile.avatar_widths, {'avatar_thumb': 200, 'avatar_medium': 400})
+
+        out = io.StringIO()
+        call_command('backfill_image_variants', dry_run=True, stdout=out)
+        self.assertIn('Profile: 0 row(s) without variants', out.getvalue())
+
+    def test_backfill_records_widths_of_existing_variants(self):
+        self.client.post('/upload/file/', {'image': SimpleUploadedFile('tall.jpg', jpeg_bytes(size=(300, 400)))})
+        skin_img = Dermal_image.objects.get()
+        thumb_name = skin_img.image_thumb.name
+        Dermal_image.objects.update(image_widths={})
+        skin_img.refresh_from_db()
+        self.assertEqual(skin_img.image_srcset, '')
+
+        call_command('backfill_image_variants', stdout=io.StringIO())
+        skin_img.refresh_from_db()
+        self.assertEqual(skin_img.image_thumb.name, thumb_name)  # not rendered again
+        self.assertEqual(skin_img.image_widths, {'image': 300, 'image_thumb': 150, 'image_medium': 300})
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class BatchUploadTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='clinic', password='pw')
+        self.profile = Profile.objects.create(user=self.user)
+        self.client.force_login(self.user)
+        prediction_cache.get_cache().clear()
+        self.built = install_fake_pool(self)
+
+    def post(self, files, **data):
+        images = [SimpleUploadedFile(name, content) for name, content in files]
+        return self.client.post('/upload/batch/', {'images': images, **data})
+
+    @mock.patch.object(jobs, 'PREDICTION_EAGER', True)
+    def test_batch_is_stored_in_one_insert_with_per_item_status(self):
+        files = [('a.jpg', jpeg_bytes(seed=1)), ('notes.txt', b'not an image'), ('b.png', jpeg_bytes(seed=2, fmt='PNG'))]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.post(files)
+        self.assertEqual(response.status_code, 200)
+        items = response.json()['items']
+        self.assertEqual([item['status'] for item in items], ['done', 'invalid', 'done'])
+        self.assertIn('error', items[1])
+        self.assertEqual(items[0]['status_url'], f"/result/{items[0]['id']}/status/")
+        inserts = [q for q in queries if q['sql'].startswith('INSERT INTO "Dermal_dermal_image"')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(Dermal_image.objects.filter(user=self.profile).count(), 2)
+        self.assertTrue(Dermal_image.objects.get(id=items[2]['id']).image_thumb)
+
+    @mock.patch.object(jobs, 'PREDICTION_EAGER', True)
+    @mock.patch.object(uploads, 'BATCH_ITEM_TIMEOUT', 0.2)
+    def test_slow_item_times_out_without_failing_the_batch(self):
+        original = imaging.preprocess
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def preprocess(data, max_side=None):
+            if data == b'\xff\xd8\xffslow':
+                release.wait(5)
+            return original(data, max_side)
+
+        with mock.patch.object(imaging, 'preprocess', preprocess):
+            items = self.post([('slow.jpg', b'\xff\xd8\xffslow'), ('ok.jpg', jpeg_bytes())]).json()['items']
+        self.assertEqual([item['status'] for item in items], ['timeout', 'done'])
+
+    @mock.patch.object(jobs, 'PREDICTION_EAGER', True)
+    @mock.patch.object(uploads, 'BATCH_ITEM_TIMEOUT', 0.2)
+    @mock.patch.object(uploads, 'BATCH_WORKERS', 2)
+    def test_stuck_items_share_one_batch_deadline(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        executor = ThreadPoolExecutor(max_workers=2)
+        self.addCleanup(executor.shutdown, wait=False, cancel_futures=True)
+
+        def preprocess(data, max_side=None):
+            release.wait(5)
+            return data
+
+        started = time.monotonic()
+        with mock.patch.object(imaging, 'preprocess', preprocess), \
+                mock.patch.object(uploads, 'get_executor', return_value=executor):
+            items = self.post([(f'{n}.jpg', jpeg_bytes(seed=n)) for n in range(4)]).json()['items']
+        # Two rounds of the pool (0.4 s), not one timeout per item (0.8 s)
+        self.assertLess(time.monotonic() - started, 0.7)
+        self.assertEqual({item['status'] for item in items}, {'timeout'})
+
+    def test_wait_blocks_until_the_batch_is_predicted(self):
+        finished = []
+
+        def handler(image_id):
+            time.sleep(0.1)
+            finished.append(image_id)
+
+        fake_queue = jobs.PredictionQueue(handler=handler, workers=2, maxsize=5)
+        with mock.patch.object(jobs, '_queue', fake_queue):
+            items = self.post([('a.jpg', jpeg_bytes(seed=3)), ('b.jpg', jpeg_bytes(seed=4))], wait='1').json()['items']
+        self.assertEqual(sorted(finished), sorted(item['id'] for item in items))
+
+    def test_batch_size_is_limited(self):
+        files = [(f'{n}.jpg', jpeg_bytes(seed=n)) for n in range(uploads.BATCH_UPLOAD_MAX + 1)]
+        self.assertEqual(self.post(files).status_code, 400)
+        self.assertFalse(Dermal_image.objects.exists())
+
+
+class FakeRunner:
+    """Stand-in for an onnxruntime/tflite runner returning fixed logits."""
+
+    def __init__(self, path, threads):
+        self.inputs = []
+
+    def __call__(self, img):
+        self.inputs.append((img.mode, img.size))
+        return [0.0, 3.0, 0.0, 1.0, 0.0, 0.0, 0.0]
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class InferenceBackendTests(TestCase):
+    def local_backend(self):
+        runners = []
+        backend = inference.LocalBackend(
+            '/models/skin.onnx', runner_factory=lambda *args: runners.append(FakeRunner(*args)) or runners[-1])
+        return backend, runners
+
+    def test_backend_is_selected_by_settings(self):
+        self.assertIsInstance(inference.build_backend(), inference.GradioBackend)
+        with self.settings(INFERENCE_BACKEND='local', INFERENCE_MODEL_PATH='/models/skin.tflite'):
+            backend = inference.build_backend()
+        self.assertIsInstance(backend, inference.LocalBackend)
+        self.assertEqual(backend.model_path, '/models/skin.tflite')
+        with self.settings(INFERENCE_BACKEND='keras'), self.assertRaises(ImproperlyConfigured):
+            inference.build_backend()
+
+    def test_gradio_backend_unpacks_the_space_output(self):
+        install_fake_pool(self)
+        self.assertEqual(inference.GradioBackend().predict(b'img'),
+                         (FAKE_OUTPUT['result'], FAKE_OUTPUT['heatmap_base64']))
+
+    def test_local_backend_ranks_classes_without_heatmap(self):
+        backend, runners = self.local_backend()
+        backend.warm_up()
+        backend.predict(jpeg_bytes(size=(640, 480)))
+        result, heatmap = backend.predict(jpeg_bytes(size=(640, 480)))
+        self.assertIsNone(heatmap)
+        self.assertEqual(len(runners), 1)
+        self.assertEqual(runners[0].inputs[0], ('RGB', (300, 300)))
+        self.assertEqual([item['class'] for item in result[:2]],
+                         ['Eczema Photos', 'Psoriasis pictures Lichen Planus and related diseases'])
+        self.assertAlmostEqual(sum(item['probability'] for item in result), 100, delta=0.1)
+
+    def test_local_backend_reports_missing_model_or_runtime(self):
+        with self.assertRaisesMessage(inference.InferenceUnavailable, 'Model file not found'):
+            inference.LocalBackend('/nonexistent/skin.onnx').warm_up()
+        with self.assertRaisesMessage(inference.InferenceUnavailable, 'Unsupported model format'):
+            inference.LocalBackend('/models/skin.keras').warm_up()
+
+    def test_jobs_use_the_configured_backend(self):
+        user = User.objects.create_user(username='duc', password='pw')
+        skin_img = Dermal_image.objects.create(
+            image=SimpleUploadedFile('skin.jpg', jpeg_bytes()), user=Profile.objects.create(user=user))
+        backend, _ = self.local_backend()
+        with mock.patch.object(inference, '_backend', backend):
+            jobs.run_prediction(skin_img.id)
+        skin_img.refresh_from_db()
+        self.assertEqual(skin_img.status, Dermal_image.Status.DONE)
+        self.assertEqual(skin_img.result[0]['class'], 'Eczema Photos')
+        self.assertFalse(skin_img.heatmap)
+
+
+class HealthAndMetricsTests(TestCase):
+    def setUp(self):
+        metrics.reset()
+        self.built = install_fake_pool(self)
+        patcher = mock.patch.object(inference, '_backend', inference.GradioBackend())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_liveness_is_cheap_and_verbose_on_request(self):
+        with self.assertNumQueries(0):
+            response = self.client.get('/health/')
+        self.assertEqual(response.content, b'ok')
+        data = self.client.get('/health/?verbose=1').json()
+        self.assertEqual((data['inference_backend'], data['backend_warm']), ('gradio', False))
+        self.assertGreater(data['rss_mb'], 0)
+
+    def test_readiness_waits_for_a_warm_backend(self):
+        response = self.client.get('/ready/')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json()['checks'], {
+            'database': True, 'inference_backend': False, 'prediction_queue': True})
+        inference.warm_up().join()  # the probe already started it; this joins the same thread
+        self.assertEqual(len(self.built), 1)
+        self.assertEqual(self.client.get('/ready/').status_code, 200)
+
+    def test_metrics_cover_views_queries_and_remote_calls(self):
+        user = User.objects.create_user(username='ops', password='pw')
+        Profile.objects.create(user=user)
+        self.client.force_login(user)
+        self.client.get('/health/')
+        self.client.get('/community/')
+        inference.get_pool().predict(b'img', api_name='predict')
+
+        with self.settings(DEBUG=True):
+            body = self.client.get('/metrics').content.decode()
+        self.assertIn('# TYPE dermai_http_request_duration_seconds histogram', body)
+        self.assertIn('dermai_http_requests_total{view="health",method="GET",status="200"} 1', body)
+        self.assertIn('dermai_http_request_duration_seconds_count{view="community",method="GET"} 1', body)
+        self.assertIn('dermai_remote_calls_total{service="gradio",outcome="successes"} 1', body)
+        self.assertIn('dermai_remote_call_duration_seconds_bucket{service="gradio",le="+Inf"} 1', body)
+        self.assertRegex(body, r'dermai_process_resident_memory_bytes \d+')
+        self.assertEqual(metrics.db_queries.count(view='community'), 1)
+        self.assertGreater(metrics.db_queries._values[('community',)]['sum'], 0)
+
+    async def test_async_view_queries_are_counted(self):
+        user = await User.objects.acreate_user(username='ops', password='pw')
+        profile = await Profile.objects.acreate(user=user)
+        image = await Dermal_image.objects.acreate(image='images/skin.jpg', user=profile)
+        await self.async_client.aforce_login(user)
+        response = await self.async_client.get(f'/predict/{image.id}')
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(metrics.db_queries.count(view='predict'), 1)
+        # The user and image lookups run in sync_to_async's worker thread
+        self.assertEqual(metrics.db_queries._values[('predict',)]['sum'], 2)
+
+    def test_gemini_outcomes_are_counted(self):
+        gemini._count('failures')
+        gemini._record_latency(0.2)
+        self.assertEqual(metrics.remote_calls.value(service='gemini', outcome='failures'), 1)
+        self.assertEqual(metrics.remote_call_duration.count(service='gemini'), 1)
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = metrics.Histogram('test_seconds', 'Test.', ('view',), buckets=(0.1, 1))
+        self.addCleanup(metrics.REGISTRY.remove, histogram)
+        for value in (0.05, 0.5, 5):
+            histogram.observe(value, view='a"b')
+        self.assertEqual(list(histogram.samples()), [
+            'test_seconds_bucket{view="a\\"b",le="0.1"} 1',
+            'test_seconds_bucket{view="a\\"b",le="1.0"} 2',
+            'test_seconds_bucket{view="a\\"b",le="+Inf"} 3',
+            'test_seconds_sum{view="a\\"b"} 5.55',
+            'test_seconds_count{view="a\\"b"} 3',
+        ])
+
+    @mock.patch.dict('os.environ', {'METRICS_TOKEN': 's3cret'})
+    def test_metrics_token_is_enforced_when_set(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer s3cret').status_code, 200)
+
+    @mock.patch.dict('os.environ', {'METRICS_TOKEN': ''})
+    def test_metrics_are_hidden_without_a_token_in_production(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+
+
+class ProfilingMiddlewareTests(TestCase):
+    def setUp(self):
+        profiling.clear()
+        self.addCleanup(profiling.clear)
+        self.user = User.objects.create_user(username='dev', password='pw')
+        Profile.objects.create(user=self.user)
+        self.client.force_login(self.user)
+
+    def test_disabled_middleware_is_not_loaded(self):
+        self.client.get('/community/')
+        self.assertEqual(profiling.records(), [])
+
+    @mock.patch.object(profiling, 'PROFILING_ENABLED', True)
+    def test_records_sql_accounting_without_profiling(self):
+        response = self.client.get('/community/')
+        [record] = profiling.records()
+        self.assertEqual((record['view'], record['status']), ('community', response.status_code))
+        self.assertGreater(record['queries'], 0)
+        self.assertGreaterEqual(record['ms'], record['sql_ms'])
+        self.assertLessEqual(len(record['slowest']), profiling.PROFILING_TOP_QUERIES)
+        self.assertIn('SELECT', record['slowest'][0]['sql'])
+        self.assertIsNone(record['profile'])
+
+    @mock.patch.object(profiling, 'PROFILING_ENABLED', True)
+    async def test_async_view_sql_is_accounted_for(self):
+        profile = await Profile.objects.aget(user=self.user)
+        image = await Dermal_image.objects.acreate(image='images/skin.jpg', user=profile)
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(f'/predict/{image.id}')
+        [record] = profiling.records()
+        self.assertEqual((record['view'], record['status']), ('predict', response.status_code))
+        # The image lookup runs in sync_to_async's worker thread
+        self.assertGreater(record['queries'], 0)
+        self.assertTrue(any('Dermal_dermal_image' in query['sql'] for query in record['slowest']))
+
+    @mock.patch.object(profiling, 'PROFILING_ENABLED', True)
+    def test_header_capture_is_for_staff_only(self):
+        self.client.get('/community/', HTTP_X_PROFILE='1')
+        self.assertIsNone(profiling.records()[0]['profile'])
+
+        self.user.is_staff = True
+        self.user.save()
+        self.client.get('/community/', HTTP_X_PROFILE='1')
+        record = profiling.records()[0]
+        self.assertEqual(record['trigger'], 'header')
+        self.assertIn('function calls', record['profile'])
+        self.assertIn('community_view', record['profile'])
+
+    @mock.patch.object(profiling, 'PROFILING_ENABLED', True)
+    @mock.patch.object(profiling, 'PROFILING_SAMPLE_RATE', 1.0)
+    def test_sampling_rate_and_bounded_buffer(self):
+        with mock.patch.object(profiling, '_records', profiling.deque(maxlen=3)):
+            for _ in range(5):
+                self.client.get('/health/')
+            recorded = profiling.records()
+        self.assertEqual(len(recorded), 3)
+        self.assertEqual(recorded[0]['id'] - recorded[-1]['id'], 2)
+        self.assertTrue(all(record['trigger'] == 'sampled' for record in recorded))
+
+    def test_timer_keeps_the_slowest_statements(self):
+        timer = profiling._QueryTimer(keep=2)
+        for sql, seconds in (('a', 0.01), ('b', 0.03), ('c', 0.02)):
+            with mock.patch.object(profiling.time, 'perf_counter', side_effect=[0, seconds]):
+                timer(lambda *args: None, sql, (), False, {})
+        self.assertEqual(timer.count, 3)
+        self.assertEqual([query['sql'] for query in timer.slowest()], ['b', 'c'])
+
+    @mock.patch.object(profiling, 'PROFILING_ENABLED', True)
+    def test_page_is_staff_only(self):
+        self.client.get('/community/')
+        self.assertEqual(self.client.get('/profiling/').status_code, 302)
+        self.user.is_staff = True
+        self.user.save()
+        record_id = profiling.records()[0]['id']
+        response = self.client.get(f'/profiling/?id={record_id}')
+        self.assertContains(response, '/community/')
+        self.assertContains(response, 'Slowest queries')
+
+
+class SqliteProfileTests(TestCase):
+    def test_connections_get_the_production_pragmas(self):
+        database = settings.DATABASES['default']
+        self.assertGreater(database['CONN_MAX_AGE'], 0)
+        self.assertFalse(hasattr(settings, 'CONN_MAX_AGE'))
+        self.assertEqual(database['OPTIONS']['transaction_mode'], 'IMMEDIATE')
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], settings.SQLITE_BUSY_TIMEOUT_MS)
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)  # NORMAL
+
+    def _run(self, options):
+        from Dermal.management.commands.sqlite_concurrency import ALIAS, run_workload
+        # The workload's connection alias only exists while it runs
+        with tempfile.TemporaryDirectory() as tmp, \
+                mock.patch.object(type(self), 'databases', self.databases | {ALIAS}):
+            return run_workload(f'{tmp}/concurrency.sqlite3', options, readers=4, writers=3, seconds=0.5)
+
+    def test_threaded_reads_and_writes_do_not_lock(self):
+        from Dermal.management.commands.sqlite_concurrency import tuned_options
+        stats = self._run(tuned_options())
+        self.assertEqual(stats['journal_mode'], 'wal')
+        self.assertEqual(stats['errors'], 0)
+        self.assertGreater(stats['writes'], 0)
+        self.assertGreater(stats['reads'], stats['writes'])
+
+    def test_default_pragmas_fail_read_then_write_transactions(self):
+        # The baseline the production profile fixes: deferred transactions that
+        # read then write can't upgrade their lock and fail immediately.
+        stats = self._run({})
+        self.assertEqual(stats['journal_mode'], 'delete')
+        self.assertGreater(stats['errors'], 0)
+
+
+class QueryPlanTests(TestCase):
+    """Every SELECT of the hot views must be answered from an index.
+
+    Runs ``EXPLAIN QUERY PLAN`` on the statements each view executes and fails
+    on a full table scan or a temp B-tree sort.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='plan', password='pw')
+        self.profile = Profile.objects.create(user=self.user)
+        self.client.force_login(self.user)
+        for i in range(3):
+            post = Post.objects.create(author=self.profile, title=f'p{i}', content='<p>x</p>')
+            comment = Comment.objects.create(post=post, author=self.profile, content='c')
+            votes.toggle(post, self.profile, votes.UP)
+            votes.toggle(comment, self.profile, votes.DOWN)
+            Dermal_image.objects.create(user=self.profile, image=f'images/{i}.jpg', status=Dermal_image.Status.DONE)
+        self.post, self.comment = post, comment
+
+    def plan_problems(self, sql):
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+            details = [row[-1] for row in cursor.fetchall()]
+        problems = [d for d in details if 'TEMP B-TREE' in d or (d.startswith('SCAN ') and ' INDEX ' not in d)]
+        return problems, details
+
+    def assert_indexed(self, method, url, **extra):
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(self.client, method)(url, **extra)
+        self.assertLess(response.status_code, 400, url)
+        selects = [q['sql'] for q in queries if q['sql'].startswith('SELECT')]
+        self.assertTrue(selects)
+        for sql in selects:
+            problems, details = self.plan_problems(sql)
+            self.assertEqual(problems, [], f'{url}: {sql}\n' + '\n'.join(details))
+
+    def cursor_after(self, obj):
+        return pagination.encode_cursor(obj)
+
+    def test_profile_page(self):
+        self.assert_indexed('get', '/profile/')
+
+    def test_community_feed(self):
+        self.assert_indexed('get', '/community/')
+        self.assert_indexed('get', f'/api/feed/?limit=1&cursor={self.cursor_after(self.post)}')
+
+    def test_post_comments(self):
+        self.assert_indexed('get', f'/post/{self.post.id}/comments/')
+        self.assert_indexed('get', f'/post/{self.post.id}/comments/?cursor={self.cursor_after(self.comment)}')
+
+    def test_votes(self):
+        for url in (f'/post/{self.post.id}/vote/', f'/comment/{self.comment.id}/vote/'):
+            self.assert_indexed('post', url, data={'action': 'down'}, content_type='application/json')
+
+
+class StartupBudgetTests(SimpleTestCase):
+    def test_fresh_worker_defers_heavy_imports(self):
+        # Wall-clock time is left to `manage.py startup_report --check`: it is too noisy for the suite
+        out, err = io.StringIO(), io.StringIO()
+        try:
+            call_command('startup_report', '--check', '--skip-timing', '--top', '5', stdout=out, stderr=err)
+        except Exception:
+            self.fail(f'{out.getvalue()}\n{err.getvalue()}')
+        self.assertIn('first request (200 OK)', out.getvalue())
+        self.assertIn('Dermal.views', out.getvalue())
+
+    def test_budget_reports_eager_imports_and_slow_starts(self):
+        from Dermal.management.commands.startup_report import budget_violations
+        budget = {'time_to_first_request_ms': 500, 'deferred_modules': ['bleach', 'requests']}
+        report = {'total_ms': 650, 'modules': ['django', 'bleach']}
+        self.assertEqual(budget_violations(report, budget), [
+            'time to first request 650 ms > budget 500 ms',
+            'bleach is imported before the first request is served',
+        ])
+        self.assertEqual(budget_violations(report, budget, timing=False),
+                         ['bleach is imported before the first request is served'])
+
+
+class SessionCacheTests(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        self.user = User.objects.create_user(username='sess', password='pw')
+        Profile.objects.create(user=self.user)
+
+    def session_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return [q['sql'] for q in queries if 'django_session' in q['sql']]
+
+    def test_authenticated_requests_read_the_session_from_cache(self):
+        self.assertTrue(settings.SESSION_ENGINE.endswith('cached_db'))
+        self.client.login(username='sess', password='pw')
+        self.assertEqual(self.session_queries('/chatbot/'), [])
+        # A cold cache (e.g. after a restart) falls back to the row once
+        caches['default'].clear()
+        self.assertEqual(len(self.session_queries('/chatbot/')), 1)
+        self.assertEqual(self.session_queries('/chatbot/'), [])
+
+    def test_logout_removes_the_cached_session(self):
+        self.client.login(username='sess', password='pw')
+        session_key = self.client.session.session_key
+        self.client.logout()
+        self.assertFalse(caches['default'].has_key(f'django.contrib.sessions.cached_db{session_key}'))
+        self.assertEqual(self.client.get('/chatbot/').status_code, 302)
+
+    def test_local_cache_is_per_process_memory(self):
+        self.assertEqual(settings.CACHES['local']['BACKEND'], 'django.core.cache.backends.locmem.LocMemCache')
+
+    def test_measure_command_reports_queries_saved(self):
+        out = io.StringIO()
+        call_command('measure_session_queries', '/chatbot/', requests=2, stdout=out)
+        self.assertIn('cached_db saves 1.0 query/request', out.getvalue())
+        self.assertFalse(User.objects.filter(username__startswith='__measure').exists())
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class ResultPageCachingTests(TestCase):
+    def setUp(self):
+        caches['local'].clear()
+        self.user = User.objects.create_user(username='cond', password='pw')
+        self.profile = Profile.objects.create(user=self.user)
+        self.client.force_login(self.user)
+        self.image = Dermal_image.objects.create(
+            user=self.profile, image=SimpleUploadedFile('a.jpg', jpeg_bytes()), status=Dermal_image.Status.DONE,
+            result=[{'class': 'Eczema', 'probability': 91.5}])
+        self.url = f'/result/{self.image.id}/'
+        self.client.get(self.url)  # first visit sets the CSRF cookie the page embeds
+
+    def test_revalidation_returns_304_without_rendering(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response['Cache-Control'], 'private, no-cache')
+        self.assertContains(response, 'Eczema')
+        with self.assertTemplateNotUsed('result.html'):
+            not_modified = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified.content, b'')
+        self.assertEqual(not_modified['Cache-Control'], 'private, no-cache')
+        # Only the ETag covers the CSRF token and the template, so dates never revalidate
+        self.assertNotIn('Last-Modified', response)
+        since = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE='Wed, 01 Jan 2098 00:00:00 GMT')
+        self.assertEqual(since.status_code, 200)
+
+    def test_row_changes_invalidate_etag_and_fragment(self):
+        response = self.client.get(self.url)
+        self.assertEqual(len(caches['local']._cache), 1)
+        Dermal_image.objects.filter(id=self.image.id).update(
+            result=[{'class': 'Psoriasis', 'probability': 80.0}], updated_at=timezone.now())
+        changed = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed['ETag'], response['ETag'])
+        self.assertContains(changed, 'Psoriasis')
+        self.assertNotContains(changed, 'Eczema')
+
+    def test_fragment_is_served_from_cache(self):
+        self.client.get(self.url)
+        # Same content version: the cached fragment is reused even if the
+        # in-memory row were to differ
+        Dermal_image.objects.filter(id=self.image.id).update(result=[{'class': 'Acne', 'probability': 1.0}])
+        self.assertContains(self.client.get(self.url), 'Eczema')
+
+    def test_new_session_gets_a_new_etag(self):
+        etag = self.client.get(self.url)['ETag']
+        self.client.logout()
+        self.client.force_login(self.user)
+        self.client.cookies.pop('csrftoken', None)
+        self.client.get(self.url)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_finished_prediction_changes_the_etag(self):
+        Dermal_image.objects.filter(id=self.image.id).update(status=Dermal_image.Status.PENDING, result=None)
+        pending = self.client.get(self.url)
+        melanoma = [{'class': 'Melanoma', 'probability': 60.0}]
+        with mock.patch.object(inference, 'classify', return_value=(melanoma, None)):
+            jobs.run_prediction(self.image.id)
+        done = self.client.get(self.url, HTTP_IF_NONE_MATCH=pending['ETag'])
+        self.assertEqual(done.status_code, 200)
+        self.assertContains(done, 'Melanoma')
+
+    def test_backfilled_variants_change_the_etag(self):
+        response = self.client.get(self.url)
+        self.assertNotContains(response, 'srcset=')
+        call_command('backfill_image_variants', stdout=io.StringIO())
+        changed = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(changed.status_code, 200)
+        self.assertContains(changed, 'srcset=')
+
+    def test_other_users_get_404(self):
+        other = User.objects.create_user(username='other', password='pw')
+        Profile.objects.create(user=other)
+        self.client.force_login(other)
+        self.assertEqual(self.client.get(self.url).status_code, 404)
@@ -0,0 +1,147 @@
+"""Turning uploaded bytes into ``Dermal_image`` rows, one at a time or in batches.
+
+``prepare`` runs the CPU-heavy part of an upload (validation, downscaling,
+display variants, digest) and returns the field values of the new row.
+
+``submit_batch`` serves the batch endpoint used by clinics that classify
+several lesion photos at once:
+
+- the photos are prepared concurrently on a small process-wide thread pool
+  (``BATCH_WORKERS``). The batch waits ``BATCH_ITEM_TIMEOUT`` per round of
+  the pool, against one deadline, and photos left over are reported as
+  timed out. A photo already being prepared cannot be cancelled: it keeps
+  its worker until it returns, and only photos not yet started are dropped,
+- every photo that survived is written with a single ``bulk_create``,
+- predictions go through the usual background queue (``jobs.py``), which
+  already runs them on bounded worker threads with a per-attempt timeout;
+  repeat photos are answered from the prediction cache,
+- with ``wait`` the request blocks until the batch is done or
+  ``BATCH_WAIT_TIMEOUT`` passes; unfinished items are reported as pending.
+
+Every item gets its own status, so one bad file never fails the batch.
+"""
+import math
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from django.core.files.base import ContentFile
+
+from . import imaging, jobs, prediction_cache
+
+BATCH_UPLOAD_MAX = int(os.getenv('BATCH_UPLOAD_MAX', '10'))
+BATCH_WORKERS = int(os.getenv('BATCH_WORKERS', '2'))
+BATCH_ITEM_TIMEOUT = float(os.getenv('BATCH_ITEM_TIMEOUT', '20'))
+BATCH_WAIT_TIMEOUT = float(os.getenv('BATCH_WAIT_TIMEOUT', '60'))
+
+# Per-item statuses besides the Dermal_image.Status values
+INVALID = 'invalid'
+TIMEOUT = 'timeout'
+ERROR = 'error'
+
+
+def prepare(img_bytes, file_name):
+    """Return the ``Dermal_image`` field values for an upload.
+
+    Raises ``imaging.InvalidImage`` if ``img_bytes`` is not a usable image.
+    """
+    processed = imaging.preprocess(img_bytes)
+    name = imaging.processed_name(file_name)
+    fields = {
+        'image': ContentFile(processed, name=name),
+        # Keyed by the processed bytes: that is what the classifier sees
+        'digest': prediction_cache.image_digest(processed),
+        'image_widths': {'image': imaging.image_width(processed)},
+    }
+    from .models import Dermal_image
+    for variant, (data, width) in imaging.make_variants(processed).items():
+        field = Dermal_image.VARIANT_FIELDS[variant]
+        fields[field] = ContentFile(data, name=imaging.variant_name(name, variant))
+        fields['image_widths'][field] = width
+    if imaging.IMAGE_KEEP_ORIGINAL:
+        fields['original'] = ContentFile(img_bytes, name=file_name)
+    return fields
+
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """The process-wide pool that prepares batch items (rebuilt after fork)."""
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=max(1, BATCH_WORKERS), thread_name_prefix='batch-upload')
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def _prepare_all(files):
+    """Prepare ``[(name, bytes)]`` concurrently; yields ``(name, fields, error_status, message)``."""
+    executor = get_executor()
+    futures = [(name, executor.submit(prepare, data, name)) for name, data in files]
+    # One deadline for the batch: BATCH_ITEM_TIMEOUT for each round of the pool
+    timeout = BATCH_ITEM_TIMEOUT * math.ceil(len(futures) / max(1, BATCH_WORKERS))
+    wait([future for _, future in futures], timeout=timeout)
+    for name, future in futures:
+        if not future.done():
+            # Drops the item if it has not started; a running one cannot be interrupted
+            future.cancel()
+            yield name, None, TIMEOUT, f'Xử lý ảnh quá {timeout:g}s'
+            continue
+        try:
+            yield name, future.result(), None, None
+        except imaging.InvalidImage as e:
+            yield name, None, INVALID, str(e)
+        except Exception as e:
+            yield name, None, ERROR, str(e) or type(e).__name__
+
+
+def submit_batch(profile, files, wait=False):
+    """Store and queue a batch of ``[(name, bytes)]`` uploads for ``profile``.
+
+    Returns one dict per file, in order, with ``name`` and ``status`` plus
+    ``id`` for stored images or ``error`` for rejected ones.
+    """
+    from .models import Dermal_image
+    Status = Dermal_image.Status
+
+    items, rows = [], []
+    for name, fields, error_status, message in _prepare_all(files):
+        item = {'name': name}
+        items.append(item)
+        if error_status:
+            item.update(status=error_status, error=message)
+            continue
+        cached = prediction_cache.lookup(fields['digest'])
+        if cached is not None:
+            fields.update(result=cached[0], heatmap=cached[1], status=Status.DONE)
+        else:
+            fields['status'] = Status.PENDING
+        rows.append((item, Dermal_image(user=profile, **fields)))
+
+    created = Dermal_image.objects.bulk_create([row for _, row in rows])
+    pending = []
+    for (item, _), row in zip(rows, created):
+        item.update(id=row.id, status=row.status)
+        if row.status == Status.PENDING:
+            pending.append(row.id)
+            try:
+                jobs.enqueue(row.id)
+            except jobs.QueueFull:
+                pass  # stays pending; result_status re-queues it when polled
+
+    if wait and pending and not jobs.PREDICTION_EAGER:
+        jobs.get_queue().wait_for(pending, timeout=BATCH_WAIT_TIMEOUT)
+    if pending:
+        outcome = {row['id']: row for row in Dermal_image.objects.filter(id__in=pending)
+                   .values('id', 'status', 'error')}
+        for item in items:
+            row = outcome.get(item.get('id'))
+            if row is not None:
+                item['status'] = row['status']
+                if row['status'] == Status.FAILED:
+                    item['error'] = row['error']
+    return items
@@ -1,27 +1,37 @@
-from .views import *
 from django.urls import path
 
+from . import views
+
 urlpatterns = [
-    path('', home_view, name='home'),
-    path('upload/', upload_image, name='upload_image'),
-    path('login/', login_view, name='login'),
-    path('signup/', signup_view, name='signup'),
-    path('chatbot/', chatbot_view, name='chatbot'),
-    path('community/', community_view, name='community'),
-    path('create-post/', create_post, name='create_post'),
-    path('edit-post/<int:post_id>/', edit_post, name='edit_post'),
-    path('delete-post/<int:post_id>/', delete_post, name='delete_post'),
-    path('post/<int:post_id>/vote/', toggle_vote, name='toggle_vote'),
-    path('post/<int:post_id>/comment/', post_comment, name='post_comment'),
+    path('', views.home_view, name='home'),
+    path('upload/', views.upload_image, name='upload_image'),
+    path('login/', views.login_view, name='login'),
+    path('signup/', views.signup_view, name='signup'),
+    path('chatbot/', views.chatbot_view, name='chatbot'),
+    path('community/', views.community_view, name='community'),
+    path('api/feed/', views.feed_api, name='feed_api'),
+    path('create-post/', views.create_post, name='create_post'),
+    path('edit-post/<int:post_id>/', views.edit_post, name='edit_post'),
+    path('delete-post/<int:post_id>/', views.delete_post, name='delete_post'),
+    path('post/<int:post_id>/vote/', views.toggle_vote, name='toggle_vote'),
+    path('post/<int:post_id>/comment/', views.post_comment, name='post_comment'),
+    path('post/<int:post_id>/comments/', views.post_comments, name='post_comments'),
     path('comment/<int:comment_id>/vote/',
-         toggle_comment_vote, name='toggle_comment_vote'),
-    path('chatbot/api/', chatbot_api, name='chatbot_api'),
-    path('result/<int:image_id>/', result_view, name='result'),
-    path('pharmacy/', pharmacy, name='pharmacy'),
-    path('profile/', your_profile, name='your_profile'),
-    path('upload/file/', upload_file, name='upload_file'),
-    # path('edit_profile/', edit_profile, name='edit_profile'),
-    path('predict/<int:id>', predict, name="predict"),
-    #path('health/', health, name='health'),
-    #path('memory/', memory_status, name='memory_status'),
+         views.toggle_comment_vote, name='toggle_comment_vote'),
+    path('chatbot/api/', views.chatbot_api, name='chatbot_api'),
+    path('chatbot/stream/', views.chatbot_stream, name='chatbot_stream'),
+    path('result/<int:image_id>/', views.result_view, name='result'),
+    path('result/<int:image_id>/status/', views.result_status, name='result_status'),
+    path('result/<int:image_id>/heatmap.png', views.heatmap_image, name='heatmap'),
+    path('result/<int:image_id>/heatmap/', views.heatmap_api, name='heatmap_api'),
+    path('pharmacy/', views.pharmacy, name='pharmacy'),
+    path('profile/', views.your_profile, name='your_profile'),
+    path('upload/file/', views.upload_file, name='upload_file'),
+    path('upload/batch/', views.upload_batch, name='upload_batch'),
+    # path('edit_profile/', views.edit_profile, name='edit_profile'),
+    path('predict/<int:id>', views.predict, name="predict"),
+    path('health/', views.health, name='health'),
+    path('ready/', views.ready, name='ready'),
+    path('metrics', views.metrics_view, name='metrics'),
+    path('profiling/', views.profiling_view, name='profiling'),
 ]
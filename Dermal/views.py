@@ -1,32 +1,100 @@
 from django.shortcuts import render, redirect, get_object_or_404
 import base64
+import functools
+import hashlib
+import logging
 import re
 import json
-from django.http import JsonResponse, HttpResponse
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.conf import settings
+from django.http import FileResponse, Http404, JsonResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.crypto import constant_time_compare
+from django.utils.http import quote_etag
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.csrf import csrf_exempt
 from django.core.files.base import ContentFile
 from django.contrib.auth import authenticate, login
 from .models import *
-#from .AI_detection import predict_skin_with_explanation
-from gradio_client import Client
+from . import (chat_cache, gemini, heatmaps, imaging, inference, jobs, metrics, pagination, prediction_cache,
+               profiling, sanitize, uploads, votes)
 import os
-import requests
-import markdown2
-import bleach
-from django.views.decorators.http import require_http_methods, require_POST
+from django.views.decorators.http import require_GET, require_http_methods, require_POST
 from django.core.files.storage import default_storage
 from django.urls import reverse
+from django.db import connection
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils.formats import date_format
+from django.utils.timezone import localtime
 # Create your views here.
 # def user
 
+logger = logging.getLogger(__name__)
 
+HEATMAP_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+# Result pages: only the owner's browser may keep a copy, and it must revalidate
+RESULT_CACHE_CONTROL = 'private, no-cache'
+# Rendered result fragments live in the per-process "local" cache, keyed by
+# the row's content version, so a change never serves a stale fragment
+RESULT_FRAGMENT_TTL = int(os.getenv('RESULT_FRAGMENT_TTL', str(24 * 3600)))
+
+
+@functools.cache
+def _result_template_version():
+    from django.template.loader import get_template
+    return hashlib.sha256(get_template('result.html').template.source.encode()).hexdigest()[:12]
+
+
+def _submit_upload(request, img_bytes, file_name):
+    """Preprocess and save an uploaded image, then start its prediction.
+
+    A repeat upload of identical bytes is answered from the prediction cache
+    and the row is created already done. Otherwise the row is saved pending
+    and queued; if the queue filled up in the meantime the row stays pending
+    and ``result_status`` re-queues it on a later poll.
+    """
+    try:
+        fields = uploads.prepare(img_bytes, file_name)
+    except imaging.InvalidImage as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    profile = Profile.objects.get(user=request.user)
+    digest = fields['digest']
+
+    cached = prediction_cache.lookup(digest)
+    if cached is not None:
+        result, heatmap = cached
+        skin_img = Dermal_image.objects.create(
+            result=result,
+            heatmap=heatmap,
+            status=Dermal_image.Status.DONE,
+            user=profile,
+            **fields
+        )
+        return redirect('result', image_id=skin_img.id)
+
+    if jobs.is_saturated():
+        return JsonResponse({"error": "Hệ thống đang bận, vui lòng thử lại sau"}, status=503)
+
+    # Lưu vào DB ở trạng thái chờ, dự đoán chạy nền (xem jobs.py)
+    skin_img = Dermal_image.objects.create(
+        status=Dermal_image.Status.PENDING,
+        user=profile,
+        **fields
+    )
+    try:
+        jobs.enqueue(skin_img.id)
+    except jobs.QueueFull:
+        pass
+
+    return redirect('result', image_id=skin_img.id)
 
 
 @csrf_exempt
 @login_required
 def upload_file(request):
-    client = Client("https://codedr-skin-detection.hf.space")
     if request.method == "POST":
         try:
             uploaded_file = request.FILES.get("image")
@@ -36,21 +104,7 @@ def upload_file(request):
             img_bytes = uploaded_file.read()
             file_name = uploaded_file.name
 
-            image_file = ContentFile(img_bytes, name=file_name)
-
-            # Gọi model dự đoán với giải thích heatmap
-            #results, heatmap_base64 = predict_skin_with_explanation(img_bytes)
-            output = client.predict(img_bytes, api_name="predict_with_gradcam")
-
-            # Lưu vào DB
-            skin_img = Dermal_image.objects.create(
-                image=image_file,
-                result=output['result'],
-                heatmap=output['heatmap_base64'],
-                user=Profile.objects.get(user=request.user)
-            )
-
-            return redirect('result', image_id=skin_img.id)
+            return _submit_upload(request, img_bytes, file_name)
 
         except Exception as e:
             return JsonResponse({"error": str(e)}, status=500)
@@ -58,68 +112,109 @@ def upload_file(request):
     return JsonResponse({"error": "Chỉ hỗ trợ POST"}, status=405)
 
 
-"""
-def health(request):
+@csrf_exempt
+@login_required
+@require_POST
+def upload_batch(request):
+    """Classify several photos in one request.
+
+    POST multipart ``images`` (repeated), optional ``wait=1`` to block until
+    the predictions finish. Answers ``{"items": [...]}`` with one entry per
+    file, in order: ``name``, ``status`` (``pending``/``processing``/
+    ``done``/``failed`` or ``invalid``/``timeout``/``error`` for files that
+    were not stored), and ``id``/``result_url``/``status_url`` or ``error``.
     """
-    Enhanced health check that shows if model is pre-loaded.
-    
-    Render can use this endpoint to:
-    1. Check if service is alive
-    2. Verify model is loaded in memory (fast inference ready)
+    files = request.FILES.getlist('images')
+    if not files:
+        return JsonResponse({"error": "Không có dữ liệu ảnh"}, status=400)
+    if len(files) > uploads.BATCH_UPLOAD_MAX:
+        return JsonResponse({"error": f"Tối đa {uploads.BATCH_UPLOAD_MAX} ảnh mỗi lần"}, status=400)
+    profile = Profile.objects.get(user=request.user)
+    wait = request.POST.get('wait', '').lower() in ('1', 'true', 'yes')
+    items = uploads.submit_batch(profile, [(f.name, f.read()) for f in files], wait=wait)
+    for item in items:
+        if 'id' in item:
+            item['result_url'] = reverse('result', args=[item['id']])
+            item['status_url'] = reverse('result_status', args=[item['id']])
+    return JsonResponse({"items": items})
+
+
+def health(request):
+    """Liveness: the process is up and serving requests.
+
+    Render's ``healthCheckPath`` points here, so it must stay cheap and must
+    not depend on the Space or the database. ``?verbose=1`` adds details.
     """
-    from . import AI_detection
-    model_loaded = AI_detection._loaded_model is not None
-    
-    # Return simple text for basic health checks, or JSON with ?verbose=1
-    if request.GET.get('verbose'):
-        return JsonResponse({
-            'status': 'ok',
-            'model_loaded': model_loaded,
-            'message': 'Model pre-loaded, ready for inference' if model_loaded else 'Model will load on first request'
-        })
-    
-    # Simple response for Render health checks
-    return HttpResponse(f"ok (model: {'loaded' if model_loaded else 'lazy'})", status=200)
+    if not request.GET.get('verbose'):
+        return HttpResponse("ok", content_type="text/plain")
+    backend = inference.get_backend()
+    return JsonResponse({
+        'status': 'ok',
+        'inference_backend': backend.name,
+        'backend_warm': backend.is_warm,
+        'rss_mb': round(metrics.resident_memory_bytes() / (1024 * 1024), 1),
+        'pid': os.getpid(),
+    })
 
 
-def memory_status(request):
-    """Monitor memory usage - useful for debugging on Render"""
-    import psutil
-    import sys
-    
+def ready(request):
+    """Readiness: 200 once this worker can serve an upload without cold starts.
+
+    Checks the database, that the inference backend is warm (a cold one is
+    warmed up in the background) and that the prediction queue has room.
+    """
+    checks = {}
     try:
-        process = psutil.Process()
-        mem_info = process.memory_info()
-        
-        # Check if model is loaded
-        from . import AI_detection
-        model_loaded = AI_detection._loaded_model is not None
-        
-        return JsonResponse({
-            'status': 'ok',
-            'memory': {
-                'rss_mb': round(mem_info.rss / (1024 * 1024), 2),
-                'vms_mb': round(mem_info.vms / (1024 * 1024), 2),
-                'percent': round(process.memory_percent(), 2),
-            },
-            'model_loaded': model_loaded,
-            'python_version': sys.version,
-            'gradcam_enabled': AI_detection.ENABLE_GRADCAM,
-        })
-    except ImportError:
-        # psutil not installed
-        return JsonResponse({
-            'status': 'ok',
-            'message': 'Install psutil for memory monitoring',
-            'model_loaded': AI_detection._loaded_model is not None,
-            'gradcam_enabled': AI_detection.ENABLE_GRADCAM,
-        })
-"""
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        checks['database'] = True
+    except Exception as e:
+        logger.warning('Readiness database check failed: %r', e)
+        checks['database'] = False
+    backend = inference.get_backend()
+    checks['inference_backend'] = backend.is_warm
+    if not backend.is_warm:
+        inference.warm_up()
+    checks['prediction_queue'] = not jobs.is_saturated()
+    ok = all(checks.values())
+    return JsonResponse({'status': 'ok' if ok else 'unavailable', 'backend': backend.name, 'checks': checks},
+                        status=200 if ok else 503)
+
+
+def metrics_view(request):
+    """Prometheus scrape endpoint (text format, this worker's values).
+
+    Scrapers must send ``Authorization: Bearer <METRICS_TOKEN>``. Without a
+    token the endpoint only exists with ``DEBUG`` on, so a deploy that forgot
+    it does not publish its traffic and error counts.
+    """
+    token = os.getenv('METRICS_TOKEN')
+    if not token and not settings.DEBUG:
+        raise Http404
+    if token and not constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return HttpResponse(status=401)
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@staff_member_required
+@require_GET
+def profiling_view(request):
+    """Requests recorded by ``ProfilingMiddleware`` in this worker; ``?id=`` shows one in full."""
+    selected = None
+    if request.GET.get('id', '').isdigit():
+        selected = profiling.get_record(int(request.GET['id']))
+    return render(request, 'profiling.html', {
+        'enabled': profiling.PROFILING_ENABLED,
+        'sample_rate': profiling.PROFILING_SAMPLE_RATE,
+        'records': profiling.records(),
+        'selected': selected,
+        'pid': os.getpid(),
+    })
+
 
 @csrf_exempt
 @login_required
 def upload_image(request):
-    client = Client("https://codedr-skin-detection.hf.space")
     if request.method == "POST":
         try:
             # Check for file upload (from modal)
@@ -139,22 +234,8 @@ def upload_image(request):
                 img_bytes = base64.b64decode(img_str)
                 file_name = "skin_capture.jpg"
 
-            # Lưu ảnh vào ImageField
-            image_file = ContentFile(img_bytes, name=file_name)
-
-            # Gọi model dự đoán với giải thích heatmap
-            #results, heatmap_base64 = predict_skin_with_explanation(img_bytes)
-            output = client.predict(img_bytes, api_name="predict_with_gradcam")
-
-            # Lưu vào DB
-            skin_img = Dermal_image.objects.create(
-                image=image_file,
-                result=output['result'],
-                heatmap=output['heatmap_base64'],
-                user=Profile.objects.get(user=request.user)
-            )
-
-            return redirect('result', image_id=skin_img.id)
+            # Lưu ảnh và đưa vào hàng đợi dự đoán
+            return _submit_upload(request, img_bytes, file_name)
 
             """
             return JsonResponse({
@@ -173,13 +254,37 @@ def upload_image(request):
     return JsonResponse({"error": "Chỉ hỗ trợ POST"}, status=405)
 
 
+CHAT_REPLY_MAX_LEN = 16000
+CHAT_STREAM_INTERRUPTED = "Câu trả lời bị gián đoạn, vui lòng thử lại."
+
+
+def _render_reply(reply):
+    """Truncate a very long reply and convert its Markdown to sanitized HTML."""
+    # Truncate very long replies to a reasonable size (avoid huge payloads)
+    if isinstance(reply, str) and len(reply) > CHAT_REPLY_MAX_LEN:
+        reply = reply[:CHAT_REPLY_MAX_LEN] + "\n\n...[truncated]"
+    try:
+        clean_html = sanitize.render_chat_reply(reply)
+    except Exception:
+        clean_html = ''
+    return reply, clean_html
+
+
+def _cacheable(reply):
+    # Only real Gemini answers are cached, never dev/fallback placeholders
+    return (gemini.gemini_configured() and isinstance(reply, str) and bool(reply)
+            and reply != gemini.GEMINI_FALLBACK_REPLY)
+
+
 @csrf_exempt
 @login_required
-def chatbot_api(request):
+async def chatbot_api(request):
     """Simple endpoint for chatbot.html to POST a message and receive a reply.
 
     Expects JSON: { "message": "..." }
-    Returns JSON: { "reply": "..." }
+    Returns JSON: { "reply": "...", "reply_html": "..." }
+
+    Async: under ASGI the worker is free while Gemini is thinking.
     """
     if request.method != 'POST':
         return JsonResponse({"error": "Chỉ hỗ trợ POST"}, status=405)
@@ -190,109 +295,181 @@ def chatbot_api(request):
         if not message:
             return JsonResponse({"error": "Thiếu trường 'message'"}, status=400)
 
-        # Call helper to get a reply from Gemini (or fallback)
-        reply = call_gemini(message, user=request.user)
+        # Repeated questions are answered from the reply cache
+        model = gemini.gemini_model()
+        cached = await chat_cache.alookup(message, model)
+        if cached is not None:
+            response = JsonResponse(cached)
+            response['X-Cache'] = chat_cache.HIT
+            return response
 
-        # Truncate very long replies to a reasonable size (avoid huge payloads)
-        max_len = 16000
-        if isinstance(reply, str) and len(reply) > max_len:
-            reply = reply[:max_len] + "\n\n...[truncated]"
+        # Call helper to get a reply from Gemini (or fallback)
+        reply = await _gemini_reply(request, message, user=await request.auser())
+        reply, clean_html = _render_reply(reply)
 
-        # Convert Markdown (if any) to HTML and sanitize it for safe rendering in client
-        try:
-            raw_html = markdown2.markdown(
-                reply) if isinstance(reply, str) else ''
-            allowed_tags = [
-                'a', 'abbr', 'acronym', 'b', 'blockquote', 'code', 'em', 'i', 'li', 'ol', 'p', 'pre',
-                'strong', 'ul', 'br', 'hr', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6'
-            ]
-            allowed_attrs = {
-                'a': ['href', 'title', 'rel', 'target']
-            }
-            clean_html = bleach.clean(raw_html, tags=allowed_tags, attributes=allowed_attrs, protocols=[
-                                      'http', 'https', 'mailto'])
-            clean_html = bleach.linkify(clean_html)
-        except Exception:
-            clean_html = ''
+        if _cacheable(reply):
+            await chat_cache.astore(message, model, reply, clean_html)
+            cache_status = chat_cache.MISS
+        else:
+            cache_status = chat_cache.BYPASS
 
-        return JsonResponse({"reply": reply, "reply_html": clean_html})
+        response = JsonResponse({"reply": reply, "reply_html": clean_html})
+        response['X-Cache'] = cache_status
+        return response
     except Exception as e:
         return JsonResponse({"error": str(e)}, status=500)
 
 
-def call_gemini(prompt, user=None):
-    """Call Gemini-like API using environment variables.
+def _sse(event, data):
+    return f'event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'
 
-    This helper tries to call an external Gemini endpoint configured via:
-      - GEMINI_API_URL (full URL)
-      - GEMINI_API_KEY (auth header: Bearer)
 
-    If those are not set, return a safe canned response.
-    """
-    api_url = os.getenv('GEMINI_API_URL')
-    api_key = os.getenv('GEMINI_API_KEY')
+class _ReplyStream:
+    """Collects streamed reply chunks, capped at CHAT_REPLY_MAX_LEN."""
 
-    # Basic canned fallback reply (useful for local dev)
-    fallback = (
-        "Xin chào! Mình hiện đang chạy ở môi trường phát triển nên chưa kết nối được với dịch vụ Gemini.")
+    def __init__(self):
+        self.parts = []
+        self.length = 0
+        self.truncated = False
 
-    if not api_url or not api_key:
-        # Return a simple echo-like placeholder for now
-        return f"[DEV REPLY] Mình đã nhận: {prompt[:400]}"
+    def add(self, text):
+        """Record ``text``; return its SSE ``delta`` event, or None if nothing is left to send."""
+        if self.length + len(text) > CHAT_REPLY_MAX_LEN:
+            text = text[:CHAT_REPLY_MAX_LEN - self.length]
+            self.truncated = True
+        if not text:
+            return None
+        self.parts.append(text)
+        self.length += len(text)
+        return _sse('delta', {'text': text})
 
-    try:
-        # Prefer the official Google Generative AI Python client when available.
+    def finish(self):
+        reply = ''.join(self.parts)
+        if self.truncated:
+            reply += "\n\n...[truncated]"
         try:
-            from google import genai  # type: ignore
+            clean_html = sanitize.render_chat_reply(reply)
         except Exception:
-            genai = None
+            clean_html = ''
+        return reply, clean_html
 
-        model = os.getenv('GEMINI_MODEL') or os.getenv(
-            'GEMINI_DEFAULT_MODEL') or 'gemini-2.5-flash-lite'
+    def interrupted(self):
+        """The SSE ``error`` event ending a reply cut off mid-stream; partial replies are never cached."""
+        reply, clean_html = self.finish()
+        return _sse('error', {'error': CHAT_STREAM_INTERRUPTED, 'reply': reply, 'reply_html': clean_html})
 
-        if genai is not None and api_key:
-            # configure client if possible
-            try:
-                client = genai.Client(api_key=api_key)
-                response = client.models.generate_content(
-                    model="gemini-2.5-flash-lite", contents=prompt)
-                return response.text if response and hasattr(response, 'text') else fallback
-
-            except Exception:
-                # If the SDK call fails, we'll try an HTTP fallback below
-                pass
-
-        # If we have an api_url, try a simple HTTP POST (backward compatible)
-        if api_url:
-            headers = {
-                'Authorization': f'Bearer {api_key}',
-                'Content-Type': 'application/json',
-            }
-            payload = {
-                'prompt': prompt,
-                'max_tokens': 512,
-                'model': model,
-            }
-            resp = requests.post(api_url, headers=headers,
-                                 json=payload, timeout=15)
-            resp.raise_for_status()
-            data = resp.json()
-
-            # Attempt to pull the reply from common shapes
-            if isinstance(data, dict):
-                for key in ('reply', 'text', 'output', 'message'):
-                    if key in data and isinstance(data[key], str):
-                        return data[key]
-                if 'choices' in data and isinstance(data['choices'], list) and data['choices']:
-                    first = data['choices'][0]
-                    if isinstance(first, dict):
-                        return first.get('text') or first.get('message') or json.dumps(first)
-
-            return json.dumps(data)
 
+def _chat_events(message, model):
+    """SSE events for one chatbot reply: ``delta`` chunks, then ``done`` with the sanitized HTML."""
+    stream = _ReplyStream()
+    try:
+        for text in gemini.stream_reply(message):
+            event = stream.add(text)
+            if event:
+                yield event
+            if stream.truncated:
+                break
+    except gemini.StreamInterrupted:
+        yield stream.interrupted()
+        return
+    reply, clean_html = stream.finish()
+    if _cacheable(reply):
+        chat_cache.store(message, model, reply, clean_html)
+    yield _sse('done', {'reply': reply, 'reply_html': clean_html})
+
+
+async def _achat_events(message, model):
+    """``_chat_events`` for ASGI servers."""
+    stream = _ReplyStream()
+    try:
+        async for text in gemini.astream_reply(message):
+            event = stream.add(text)
+            if event:
+                yield event
+            if stream.truncated:
+                break
+    except gemini.StreamInterrupted:
+        yield stream.interrupted()
+        return
+    reply, clean_html = stream.finish()
+    if _cacheable(reply):
+        await chat_cache.astore(message, model, reply, clean_html)
+    yield _sse('done', {'reply': reply, 'reply_html': clean_html})
+
+
+async def _aiter(events):
+    for event in events:
+        yield event
+
+
+@csrf_exempt
+@login_required
+@require_POST
+async def chatbot_stream(request):
+    """Streaming variant of chatbot_api (Server-Sent Events over a POST).
+
+    Expects JSON: { "message": "..." }
+    Streams:  event: delta  data: {"text": "..."}      (repeated, as text arrives)
+              event: done   data: {"reply": "...", "reply_html": "..."}
+          or, if Gemini fails mid-reply,
+              event: error  data: {"error": "...", "reply": "<partial>", "reply_html": "..."}
+
+    Django buffers a streaming body whose iterator kind does not match the
+    server, so ASGI gets an async event generator and WSGI a sync one.
+    """
+    try:
+        body = json.loads(request.body.decode('utf-8'))
     except Exception:
-        # final fallback (dev-friendly)
-        return fallback
+        body = {}
+    message = (body.get('message') or '').strip()
+    if not message:
+        return JsonResponse({"error": "Thiếu trường 'message'"}, status=400)
+
+    is_asgi = isinstance(request, ASGIRequest)
+    model = gemini.gemini_model()
+    cached = await chat_cache.alookup(message, model)
+    if cached is not None:
+        events = [_sse('delta', {'text': cached['reply']}), _sse('done', cached)]
+        events = _aiter(events) if is_asgi else iter(events)
+        cache_status = chat_cache.HIT
+    else:
+        events = _achat_events(message, model) if is_asgi else _chat_events(message, model)
+        cache_status = chat_cache.MISS if gemini.gemini_configured() else chat_cache.BYPASS
+
+    response = StreamingHttpResponse(events, content_type='text/event-stream; charset=utf-8')
+    response['Cache-Control'] = 'no-cache'
+    # Tell nginx-style proxies not to buffer the stream
+    response['X-Accel-Buffering'] = 'no'
+    response['X-Cache'] = cache_status
+    return response
+
+
+def call_gemini(prompt, user=None):
+    """Call Gemini using environment variables.
+
+    Configured via GEMINI_API_URL, GEMINI_API_KEY and GEMINI_MODEL. The
+    pooled clients, retries and circuit breaker live in gemini.py. If the
+    API is not configured, return a dev placeholder; if it is unavailable,
+    return the canned fallback reply.
+    """
+    return gemini.generate_reply(prompt)
+
+
+async def acall_gemini(prompt, user=None):
+    """``call_gemini`` for async views."""
+    return await gemini.agenerate_reply(prompt)
+
+
+async def _gemini_reply(request, prompt, user=None):
+    """Gemini's reply from an async view, through the client layer that fits the server.
+
+    Under WSGI (gunicorn) Django runs each async view on a new event loop
+    that is closed after the request, so loop-bound async clients cannot be
+    reused; the pooled sync clients run on the request's own thread instead.
+    """
+    if isinstance(request, ASGIRequest):
+        return await acall_gemini(prompt, user=user)
+    return await sync_to_async(call_gemini)(prompt, user=user)
 
 
 def login_view(request):
@@ -320,6 +497,11 @@ def signup_view(request):
         profile = Profile.objects.create(user=user, birth_date=birth_date)
         if avatar:
             profile.avatar = avatar
+            try:
+                imaging.save_variants(profile, 'avatar', Profile.VARIANT_FIELDS, 'avatar_widths',
+                                      data=avatar.read())
+            except imaging.InvalidImage:
+                pass  # the full-size avatar is still shown
             profile.save()
         login(request, user)  # Đăng nhập tự động sau khi đăng ký
         # Chuyển hướng đến trang chính sau khi đăng ký
@@ -334,12 +516,103 @@ def home_view(request):
 
 @login_required
 def result_view(request, image_id):
+    """Result page of one upload, revalidated with its ETag.
+
+    A result rarely changes once written, so a browser that already has the
+    current version gets a 304 without the page being rendered. The ETag
+    also covers the CSRF secret (the page embeds a token) and the template
+    source (a deploy that changes the page invalidates old copies). There is
+    no Last-Modified: a date cannot express those two inputs, and a client
+    revalidating with If-Modified-Since alone would get a stale page.
+    """
+    skin_image = Dermal_image.objects.filter(id=image_id, user__user=request.user).first()
+    if skin_image is None:
+        return JsonResponse({"error": "Ảnh không tồn tại hoặc không có quyền truy cập"}, status=404)
+    etag = quote_etag(hashlib.sha256('|'.join((
+        skin_image.content_version, request.META.get('CSRF_COOKIE', ''), _result_template_version(),
+    )).encode()).hexdigest()[:32])
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = render(request, 'result.html', {
+            'skin_image': skin_image,
+            'fragment_ttl': RESULT_FRAGMENT_TTL,
+        })
+        response['ETag'] = etag
+    response['Cache-Control'] = RESULT_CACHE_CONTROL
+    return response
+
+
+@login_required
+def heatmap_image(request, image_id):
+    """Serve a heatmap file with long-lived private cache headers.
+
+    Heatmap files are content-addressed, so the bytes behind a given name
+    never change; browsers may keep them for a year and revalidate by ETag.
+    """
+    name = Dermal_image.objects.filter(
+        id=image_id, user__user=request.user).values_list('heatmap', flat=True).first()
+    if not name:
+        return JsonResponse({"error": "Heatmap không tồn tại"}, status=404)
+    etag = quote_etag(name.rsplit('/', 1)[-1].split('.')[0])
+    not_modified = get_conditional_response(request, etag=etag)
+    if not_modified is not None:
+        not_modified['Cache-Control'] = HEATMAP_CACHE_CONTROL
+        return not_modified
+    try:
+        fh = default_storage.open(name, 'rb')
+    except OSError:
+        return JsonResponse({"error": "Heatmap không tồn tại"}, status=404)
+    response = FileResponse(fh, content_type='image/png')
+    response['ETag'] = etag
+    response['Cache-Control'] = HEATMAP_CACHE_CONTROL
+    return response
+
+
+@login_required
+def heatmap_api(request, image_id):
+    """Grad-CAM heatmap of a finished result, computed the first time it is asked for.
+
+    Answers ``{"url": ...}`` once the heatmap file exists. Until then a
+    heatmap worker computes it and the page polls on 202 ``{"pending": true}``.
+    """
+    skin_image = Dermal_image.objects.filter(
+        id=image_id, user__user=request.user).only(
+            'id', 'image', 'digest', 'result', 'status', 'heatmap').first()
+    if skin_image is None:
+        return JsonResponse({"error": "Ảnh không tồn tại hoặc không có quyền truy cập"}, status=404)
+    if skin_image.status != Dermal_image.Status.DONE:
+        return JsonResponse({"error": "Ảnh chưa được phân tích xong"}, status=409)
+    if not skin_image.heatmap and not inference.get_backend().can_explain:
+        return JsonResponse({"error": "Heatmap không khả dụng với mô hình hiện tại"}, status=404)
     try:
-        skin_image = Dermal_image.objects.get(
-            id=image_id, user__user=request.user)
-        return render(request, 'result.html', {'skin_image': skin_image})
-    except Dermal_image.DoesNotExist:
+        name = heatmaps.request_heatmap(skin_image)
+    except jobs.QueueFull as e:
+        return JsonResponse({"error": str(e)}, status=503)
+    except Exception as e:
+        logger.warning('Heatmap for image %s failed: %r', image_id, e)
+        return JsonResponse({"error": "Không tạo được heatmap, vui lòng thử lại sau"}, status=503)
+    if name == heatmaps.PENDING:
+        return JsonResponse({"pending": True}, status=202)
+    skin_image.heatmap = name
+    return JsonResponse({"url": skin_image.heatmap_url})
+
+
+@login_required
+def result_status(request, image_id):
+    """Polled by result.html while the prediction job is still running."""
+    skin_image = Dermal_image.objects.filter(
+        id=image_id, user__user=request.user).only(
+            'id', 'status', 'error', 'job_started_at').first()
+    if skin_image is None:
         return JsonResponse({"error": "Ảnh không tồn tại hoặc không có quyền truy cập"}, status=404)
+    if skin_image.is_pending:
+        jobs.ensure_queued(skin_image)
+    return JsonResponse({
+        "status": skin_image.status,
+        "ready": skin_image.status == Dermal_image.Status.DONE,
+        "error": skin_image.error,
+        "queue_depth": jobs.get_queue().depth,
+    })
 
 
 @login_required
@@ -347,39 +620,127 @@ def chatbot_view(request):
     return render(request, 'chatbot.html')
 
 
+def _count_subquery(queryset, group_by):
+    """Correlated ``COUNT(*)`` subquery, usable in ``annotate()``.
+
+    Used instead of ``Count()`` over joins so several counts on one row don't
+    multiply each other's join rows.
+    """
+    counted = queryset.order_by().values(group_by).annotate(n=Count('*')).values('n')
+    return Coalesce(Subquery(counted), 0)
+
+
+def comments_queryset():
+    """Comments with their author's username resolved in the same query.
+
+    Only the columns the comment cards show are loaded; vote counts are
+    stored on the row (see votes.py).
+    """
+    return Comment.objects.select_related('author__user').only(
+        'id', 'post_id', 'content', 'created_at', 'upvote_count', 'downvote_count',
+        'author__user__username',
+    )
+
+
+def feed_queryset():
+    """Posts for the community feed, newest first.
+
+    Vote counts are stored on the row and the comment count is annotated, so
+    rendering the feed costs a fixed number of queries no matter how many
+    posts, comments or votes there are. Comments themselves are not loaded
+    here; the comments modal fetches them from post_comments on demand.
+    """
+    return Post.objects.select_related('author__user').annotate(
+        comment_total=_count_subquery(
+            Comment.objects.filter(post=OuterRef('pk')), 'post'),
+    ).order_by('-created_at')
+
+
+def _display_time(value):
+    return date_format(localtime(value), 'd M Y H:i')
+
+
+def _serialize_comment(comment):
+    return {
+        'id': comment.id,
+        'author': comment.author.user.username,
+        'created_at': _display_time(comment.created_at),
+        'content_html': comment.content,
+        'upvotes': comment.upvote_count,
+        'downvotes': comment.downvote_count,
+    }
+
+
+def _serialize_post(post, user):
+    author = post.author
+    return {
+        'id': post.id,
+        'title': post.title,
+        'content_html': post.content,
+        'created_at': _display_time(post.created_at),
+        'author': {
+            'username': author.user.username,
+            'avatar_url': author.avatar_thumb_url,
+        },
+        'is_owner': author.user_id == user.id,
+        'upvotes': post.upvote_count,
+        'downvotes': post.downvote_count,
+        'comment_count': post.comment_total,
+    }
+
+
 @login_required
 def community_view(request):
-    # Render community feed (latest posts first)
+    # Render the first page of the community feed (latest posts first);
+    # later pages are fetched from feed_api as the user scrolls
     profile = Profile.objects.get(user=request.user)
-    posts = Post.objects.select_related(
-        'author__user').order_by('-created_at')[:50]
-    # Normalize posts for template: provide image_url if Post has an image field in future
-    # Defensive: strip any accidental Django template tags that might be stored in post content
-
-    def strip_template_tags(html_text):
-        if not html_text:
-            return html_text
-        # Remove common Django template tokens like {% ... %} and {{ ... }}
-        cleaned = re.sub(r"\{\%[\s\S]*?\%\}", '', html_text)
-        cleaned = re.sub(r"\{\{[\s\S]*?\}\}", '', cleaned)
-        return cleaned
-
-    cleaned_posts = []
-    for p in posts:
-        p_safe = p
-        try:
-            p_safe.content = strip_template_tags(p_safe.content)
-        except Exception:
-            p_safe.content = ''
-        # attach image_url if set earlier in code paths
-        if not hasattr(p_safe, 'image_url') and getattr(p_safe, 'image', None):
-            try:
-                p_safe.image_url = p_safe.image.url
-            except Exception:
-                p_safe.image_url = None
-        cleaned_posts.append(p_safe)
+    posts, next_cursor = pagination.keyset_page(feed_queryset())
+    return render(request, 'post.html', {
+        'posts': posts,
+        'profile': profile,
+        'next_cursor': next_cursor,
+    })
+
+
+@login_required
+def feed_api(request):
+    """Cursor-paginated community feed.
+
+    GET ?cursor=<next_cursor>&limit=<n>
+    Returns JSON: { "posts": [...], "next_cursor": "..." | null }
+    """
+    try:
+        posts, next_cursor = pagination.keyset_page(
+            feed_queryset(), request.GET.get('cursor'),
+            pagination.page_size(request.GET.get('limit')))
+    except pagination.InvalidCursor as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse({
+        'posts': [_serialize_post(p, request.user) for p in posts],
+        'next_cursor': next_cursor,
+    })
+
 
-    return render(request, 'post.html', {'posts': cleaned_posts, 'profile': profile})
+@login_required
+@require_GET
+def post_comments(request, post_id):
+    """Cursor-paginated comments of one post, newest first.
+
+    GET ?cursor=<next_cursor>&limit=<n>
+    Returns JSON: { "comments": [...], "next_cursor": "..." | null }
+    """
+    if not Post.objects.filter(id=post_id).exists():
+        return JsonResponse({'error': 'Post not found'}, status=404)
+    try:
+        comments, next_cursor = pagination.keyset_page(
+            comments_queryset().filter(post_id=post_id), request.GET.get('cursor'),
+            pagination.page_size(request.GET.get('limit')))
+    except pagination.InvalidCursor as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse({
+        'comments': [_serialize_comment(c) for c in comments],
+        'next_cursor': next_cursor,
+    })
 
 
 @login_required
@@ -394,22 +755,8 @@ def create_post(request):
     title = request.POST.get('title') or (
         request.POST.get('content') or '')[:80]
     content_html = request.POST.get('content') or ''
-    # Remove Django template tags from user-submitted content to avoid raw template injection
-    content_html = re.sub(r"\{\%[\s\S]*?\%\}", '', content_html)
-    content_html = re.sub(r"\{\{[\s\S]*?\}\}", '', content_html)
-
-    # Basic sanitize to ensure saved HTML is safe (server-side)
-    allowed_tags = [
-        'a', 'abbr', 'b', 'blockquote', 'code', 'em', 'i', 'li', 'ol', 'p', 'pre',
-        'strong', 'ul', 'br', 'hr', 'h1', 'h2', 'h3', 'img'
-    ]
-    allowed_attrs = {
-        'a': ['href', 'title', 'rel', 'target'],
-        'img': ['src', 'alt', 'title']
-    }
-    safe_html = bleach.clean(content_html, tags=allowed_tags, attributes=allowed_attrs, protocols=[
-                             'http', 'https', 'data', 'mailto'])
-    safe_html = bleach.linkify(safe_html)
+    # Strip template tags and sanitize once, on write; the feed renders it as stored
+    safe_html = sanitize.clean_post(content_html)
 
     post = Post.objects.create(
         author=profile, title=title[:200], content=safe_html)
@@ -433,25 +780,13 @@ def toggle_vote(request, post_id):
     except Exception:
         body = {}
     action = body.get('action')
-    profile = get_object_or_404(Profile, user=request.user)
-    post = get_object_or_404(Post, id=post_id)
-
-    if action == 'up':
-        if profile in post.upvotes.all():
-            post.upvotes.remove(profile)
-        else:
-            post.upvotes.add(profile)
-            post.downvotes.remove(profile)
-    elif action == 'down':
-        if profile in post.downvotes.all():
-            post.downvotes.remove(profile)
-        else:
-            post.downvotes.add(profile)
-            post.upvotes.remove(profile)
-    else:
+    if action not in (votes.UP, votes.DOWN):
         return JsonResponse({'error': 'Invalid action'}, status=400)
+    profile = get_object_or_404(Profile.objects.only('id'), user=request.user)
+    post = get_object_or_404(Post.objects.only('id'), id=post_id)
 
-    return JsonResponse({'upvotes': post.upvotes.count(), 'downvotes': post.downvotes.count()})
+    upvotes, downvotes = votes.toggle(post, profile, action)
+    return JsonResponse({'upvotes': upvotes, 'downvotes': downvotes})
 
 
 @login_required
@@ -463,8 +798,7 @@ def post_comment(request, post_id):
         body = {}
     content = (body.get('content') or '').strip()
     # Strip Django template tags from comment content as well
-    content = re.sub(r"\{\%[\s\S]*?\%\}", '', content)
-    content = re.sub(r"\{\{[\s\S]*?\}\}", '', content)
+    content = sanitize.strip_template_tags(content)
     if not content:
         return JsonResponse({'error': 'Empty content'}, status=400)
 
@@ -472,22 +806,12 @@ def post_comment(request, post_id):
     post = get_object_or_404(Post, id=post_id)
 
     # sanitize incoming HTML/text
-    allowed_tags = ['a', 'b', 'blockquote', 'code', 'em',
-                    'i', 'li', 'ol', 'p', 'pre', 'strong', 'ul', 'br']
-    allowed_attrs = {'a': ['href', 'title', 'rel', 'target']}
-    safe_html = bleach.clean(content, tags=allowed_tags, attributes=allowed_attrs, protocols=[
-                             'http', 'https', 'mailto'])
-    safe_html = bleach.linkify(safe_html)
+    safe_html = sanitize.clean_comment(content)
 
     comment = Comment.objects.create(
         post=post, author=profile, content=safe_html)
 
-    return JsonResponse({
-        'id': comment.id,
-        'author': comment.author.user.username,
-        'created_at': comment.created_at.strftime('%d %b %Y %H:%M'),
-        'content_html': comment.content,
-    })
+    return JsonResponse(_serialize_comment(comment))
 
 
 @login_required
@@ -498,25 +822,13 @@ def toggle_comment_vote(request, comment_id):
     except Exception:
         body = {}
     action = body.get('action')
-    profile = get_object_or_404(Profile, user=request.user)
-    comment = get_object_or_404(Comment, id=comment_id)
-
-    if action == 'up':
-        if profile in comment.upvotes.all():
-            comment.upvotes.remove(profile)
-        else:
-            comment.upvotes.add(profile)
-            comment.downvotes.remove(profile)
-    elif action == 'down':
-        if profile in comment.downvotes.all():
-            comment.downvotes.remove(profile)
-        else:
-            comment.downvotes.add(profile)
-            comment.upvotes.remove(profile)
-    else:
+    if action not in (votes.UP, votes.DOWN):
         return JsonResponse({'error': 'Invalid action'}, status=400)
+    profile = get_object_or_404(Profile.objects.only('id'), user=request.user)
+    comment = get_object_or_404(Comment.objects.only('id'), id=comment_id)
 
-    return JsonResponse({'upvotes': comment.upvotes.count(), 'downvotes': comment.downvotes.count()})
+    upvotes, downvotes = votes.toggle(comment, profile, action)
+    return JsonResponse({'upvotes': upvotes, 'downvotes': downvotes})
 
 
 @login_required
@@ -534,22 +846,8 @@ def edit_post(request, post_id):
         title = request.POST.get('title') or (
             request.POST.get('content') or '')[:80]
         content_html = request.POST.get('content') or ''
-        # Remove Django template tags from user-submitted content
-        content_html = re.sub(r"\{\%[\s\S]*?\%\}", '', content_html)
-        content_html = re.sub(r"\{\{[\s\S]*?\}\}", '', content_html)
-
-        # Basic sanitize
-        allowed_tags = [
-            'a', 'abbr', 'b', 'blockquote', 'code', 'em', 'i', 'li', 'ol', 'p', 'pre',
-            'strong', 'ul', 'br', 'hr', 'h1', 'h2', 'h3', 'img'
-        ]
-        allowed_attrs = {
-            'a': ['href', 'title', 'rel', 'target'],
-            'img': ['src', 'alt', 'title']
-        }
-        safe_html = bleach.clean(content_html, tags=allowed_tags, attributes=allowed_attrs, protocols=[
-                                 'http', 'https', 'data', 'mailto'])
-        safe_html = bleach.linkify(safe_html)
+        # Strip template tags and sanitize once, on write
+        safe_html = sanitize.clean_post(content_html)
 
         post.title = title[:200]
         post.content = safe_html
@@ -582,10 +880,10 @@ def your_profile(request):
 
 @login_required
 @csrf_exempt
-def predict(request, id):
-    try:
-        image = Dermal_image.objects.get(id=id, user__user=request.user)
-    except Dermal_image.DoesNotExist:
+async def predict(request, id):
+    user = await request.auser()
+    image = await Dermal_image.objects.filter(id=id, user__user=user).afirst()
+    if image is None:
         return JsonResponse({'error': 'Image not found'}, status=404)
     if request.method == "POST":
         drug_history = request.POST.get('drug_history')
@@ -600,37 +898,12 @@ def predict(request, id):
         image.gender = gender
         image.symptom = symptom
 
-        try:
-            from google import genai
-        except Exception:
-            genai = None
-
         prompt = f"Hello world"
 
-        if genai:
-            reply = call_gemini(prompt, user=request.user)
-
-        # Truncate very long replies to a reasonable size (avoid huge payloads)
-        max_len = 16000
-        if isinstance(reply, str) and len(reply) > max_len:
-            reply = reply[:max_len] + "\n\n...[truncated]"
-
-        # Convert Markdown (if any) to HTML and sanitize it for safe rendering in client
-        try:
-            raw_html = markdown2.markdown(
-                reply) if isinstance(reply, str) else ''
-            allowed_tags = [
-                'a', 'abbr', 'acronym', 'b', 'blockquote', 'code', 'em', 'i', 'li', 'ol', 'p', 'pre',
-                'strong', 'ul', 'br', 'hr', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6'
-            ]
-            allowed_attrs = {
-                'a': ['href', 'title', 'rel', 'target']
-            }
-            clean_html = bleach.clean(raw_html, tags=allowed_tags, attributes=allowed_attrs, protocols=[
-                                      'http', 'https', 'mailto'])
-            clean_html = bleach.linkify(clean_html)
-        except Exception:
-            clean_html = ''
+        # call_gemini picks the SDK or the HTTP fallback itself
+        reply = await _gemini_reply(request, prompt, user=user)
+        reply, clean_html = _render_reply(reply)
 
         image.explain = clean_html
-        image.save()
+        await image.asave()
+    return redirect('result', image_id=image.id)
@@ -0,0 +1,78 @@
+"""Up/down votes on posts and comments with denormalized counters.
+
+``Post`` and ``Comment`` keep ``upvote_count``/``downvote_count`` columns next
+to the ``upvotes``/``downvotes`` M2M tables. Votes go through ``toggle()``,
+which checks membership with an indexed lookup on the M2M through table and
+adjusts the counters with ``F()`` expressions inside one transaction, so a
+vote costs the same few queries however popular the post is.
+
+Anything that edits the M2M tables directly (admin, shell, fixtures) can
+leave the counters stale; ``manage.py reconcile_vote_counts`` recomputes
+them from the M2M tables.
+"""
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+
+UP = 'up'
+DOWN = 'down'
+
+
+def _through(model, field):
+    """The M2M through model and the FK name pointing back at ``model``."""
+    return getattr(model, field).through, model._meta.model_name
+
+
+def toggle(obj, profile, action):
+    """Toggle ``profile``'s ``action`` vote on ``obj`` (a Post or Comment).
+
+    Voting the same way twice removes the vote; voting the other way moves
+    it. Returns the new ``(upvote_count, downvote_count)``.
+    """
+    if action not in (UP, DOWN):
+        raise ValueError(f'Invalid action: {action!r}')
+    model = type(obj)
+    same, other = ('upvotes', 'downvotes') if action == UP else ('downvotes', 'upvotes')
+    same_count, other_count = same[:-1] + '_count', other[:-1] + '_count'
+    SameThrough, fk = _through(model, same)
+    OtherThrough, _ = _through(model, other)
+    key = {f'{fk}_id': obj.pk, 'profile_id': profile.pk}
+
+    with transaction.atomic():
+        changes = {}
+        if SameThrough.objects.filter(**key).exists():
+            SameThrough.objects.filter(**key).delete()
+            changes[same_count] = F(same_count) - 1
+        else:
+            SameThrough.objects.create(**key)
+            changes[same_count] = F(same_count) + 1
+            if OtherThrough.objects.filter(**key).delete()[0]:
+                changes[other_count] = F(other_count) - 1
+        model.objects.filter(pk=obj.pk).update(**changes)
+        return model.objects.filter(pk=obj.pk).values_list('upvote_count', 'downvote_count').get()
+
+
+def _actual_count(model, field):
+    Through, fk = _through(model, field)
+    counted = Through.objects.filter(**{fk: OuterRef('pk')}).order_by() \
+        .values(fk).annotate(n=Count('*')).values('n')
+    return Coalesce(Subquery(counted), 0)
+
+
+def reconcile(model):
+    """Recompute ``model``'s vote counters from the M2M tables.
+
+    Returns the number of rows whose counters were wrong.
+    """
+    with transaction.atomic():
+        stale = model.objects.annotate(
+            actual_up=_actual_count(model, 'upvotes'),
+            actual_down=_actual_count(model, 'downvotes'),
+        ).filter(~Q(upvote_count=F('actual_up')) | ~Q(downvote_count=F('actual_down')))
+        stale_ids = list(stale.values_list('pk', flat=True))
+        if stale_ids:
+            model.objects.filter(pk__in=stale_ids).update(
+                upvote_count=_actual_count(model, 'upvotes'),
+                downvote_count=_actual_count(model, 'downvotes'),
+            )
+    return len(stale_ids)
@@ -3,6 +3,16 @@ ASGI config for dermai project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+The chatbot and predict views are async: while a Gemini reply is pending
+they await on the event loop instead of holding a worker thread. Serve
+them from one uvicorn worker (``GEMINI_ASYNC_POOL_SIZE`` caps the
+connections of the shared httpx client)::
+
+    uvicorn dermai.asgi:application --host 0.0.0.0 --port $PORT --workers 1
+
+``python manage.py loadtest_chatbot`` compares this profile with the
+gthread WSGI one against a local stand-in Gemini server.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
@@ -47,11 +47,15 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so latency and query counts cover every other middleware too
+    'Dermal.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    # Opt-in (PROFILING_ENABLED); after auth so staff can request a cProfile capture
+    'Dermal.profiling.ProfilingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -79,10 +83,40 @@ WSGI_APPLICATION = 'dermai.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
+# SQLite production profile (SQLITE_TUNED, on by default), applied on every
+# new connection:
+# - WAL: readers no longer block on a writer (nor the writer on readers),
+# - synchronous=NORMAL: no fsync per commit in WAL mode, still crash-safe,
+# - busy_timeout: wait for the write lock instead of "database is locked",
+# - mmap_size / cache_size: serve hot pages from memory,
+# - BEGIN IMMEDIATE: atomic() blocks take the write lock up front, so a
+#   read-then-write transaction can't fail to upgrade its lock mid-way
+#   (SQLite reports that instantly, without honouring busy_timeout).
+SQLITE_TUNED = os.getenv('SQLITE_TUNED', 'true').lower() in ('true', '1', 'yes')
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', str(64 * 1024 * 1024)))
+SQLITE_CACHE_KB = int(os.getenv('SQLITE_CACHE_KB', str(16 * 1024)))
+SQLITE_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}',
+    f'PRAGMA mmap_size={SQLITE_MMAP_SIZE}',
+    f'PRAGMA cache_size=-{SQLITE_CACHE_KB}',
+    'PRAGMA temp_store=MEMORY',
+)
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / str(os.getenv("DB_NAME", "db.sqlite3")),
+        # Keep each thread's connection (and its pragmas/page cache) across requests
+        'CONN_MAX_AGE': int(os.getenv('CONN_MAX_AGE', '60')),
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'init_command': ';'.join(SQLITE_PRAGMAS),
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': SQLITE_BUSY_TIMEOUT_MS / 1000,
+        } if SQLITE_TUNED else {},
     }
 }
 
@@ -139,10 +173,61 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 DATA_UPLOAD_MAX_MEMORY_SIZE = 5242880  # 5MB max upload size
 FILE_UPLOAD_MAX_MEMORY_SIZE = 5242880  # 5MB max file size in memory
 
+# Caches
+# "default" is shared when CACHE_URL is set and per-process otherwise:
+#   CACHE_URL=redis://host:6379/0  Redis or a Redis-compatible server (needs redis-py)
+#   CACHE_URL=/var/cache/dermai    a directory for FileBasedCache (shared by the
+#                                  workers of one instance)
+# "local" is always this process's memory: for hot, cheap-to-rebuild values
+# whose keys carry their own version, so other workers can't make them stale.
+# "chatbot" holds cached chatbot replies (see Dermal/chat_cache.py). It is
+# file based so every gunicorn worker on the instance shares it; MAX_ENTRIES
+# bounds its size (the oldest third is culled when full).
+CACHE_URL = os.getenv('CACHE_URL', '')
+CACHE_TIMEOUT = int(os.getenv('CACHE_TIMEOUT', '300'))
+
+
+def _shared_cache(url):
+    if not url:
+        return {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'default'}
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': url}
+    return {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': url.removeprefix('file://'),
+        'OPTIONS': {'MAX_ENTRIES': int(os.getenv('CACHE_MAX_ENTRIES', '5000'))},
+    }
+
+
+CACHES = {
+    'default': dict(_shared_cache(CACHE_URL), TIMEOUT=CACHE_TIMEOUT),
+    'local': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'local',
+        'TIMEOUT': CACHE_TIMEOUT,
+        'OPTIONS': {'MAX_ENTRIES': int(os.getenv('LOCAL_CACHE_MAX_ENTRIES', '1000'))},
+    },
+    'chatbot': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.getenv('CHATBOT_CACHE_DIR', str(BASE_DIR / '.cache' / 'chatbot')),
+        'TIMEOUT': int(os.getenv('CHATBOT_CACHE_TTL', str(24 * 3600))),
+        'OPTIONS': {'MAX_ENTRIES': int(os.getenv('CHATBOT_CACHE_MAX_ENTRIES', '1000'))},
+    },
+}
+
+# Skin classifier backend (see Dermal/inference.py)
+# "gradio": the Hugging Face Space over the network (classification + Grad-CAM)
+# "local": an int8-quantized .onnx or .tflite model run on this CPU (no network hop)
+INFERENCE_BACKEND = os.getenv('INFERENCE_BACKEND', 'gradio')
+INFERENCE_MODEL_PATH = os.getenv('INFERENCE_MODEL_PATH', str(BASE_DIR / 'Dermal' / 'models' / 'dermatology_int8.onnx'))
+INFERENCE_THREADS = int(os.getenv('INFERENCE_THREADS', '1'))
+
 # Session optimization
-SESSION_ENGINE = 'django.contrib.sessions.backends.db'
+# cached_db reads sessions from the "default" cache and only falls back to
+# the database on a miss; writes go to both. With more than one worker, set
+# CACHE_URL so a logout in one worker is seen by the others.
+# manage.py measure_session_queries compares the engines.
+SESSION_ENGINE = os.getenv('SESSION_ENGINE', 'django.contrib.sessions.backends.cached_db')
+SESSION_CACHE_ALIAS = 'default'
 SESSION_COOKIE_AGE = 86400  # 1 day
 SESSION_SAVE_EVERY_REQUEST = False
-
-# Database connection optimization
-CONN_MAX_AGE = 60  # Keep connections for 60 seconds